@@ -1,25 +1,47 @@
+// null (json) or NaN (binary) entries mark gaps
+export type Values = (number | null)[] | Float64Array | Float32Array;
+export type Series = { timestamps: Values; values: Values; min?: Values; max?: Values };
+
+function isGap(x: number | null): boolean {
+  return x === null || Number.isNaN(x);
+}
+
 // Data in struct of arrays format since plotly expects it this way
-// Should also be more efficient than array of objects due to how json encodes it
+// fetchData gets it in the binary format of the backend (see columnar.py), so the arrays are typed arrays there
 export interface Data {
-  solar: { timestamps: number[]; values: number[] };
-  solar_by_minute: { timestamps: number[]; values: number[] };
-  meter_power: { timestamps: number[]; values: number[] };
-  meter_reading: { timestamps: number[]; values: number[] };
-  load: { timestamps: number[]; values: number[] };
-  savings: { timestamps: number[]; values: number[] };
+  solar: Series;
+  solar_by_minute: Series;
+  meter_power: Series;
+  meter_reading: Series;
+  load: Series;
+  savings: Series;
   latest_meter_energy: { timestamp: number; value: number };
+  interval: number | null; // bucket size in ms if data was downsampled (solar and meter_power then also contain min and max)
+  gap_thres?: { solar: number; meter_power: number }; // ms between new rows that count as a gap, bigger for compressed channels
+  last?: Record<LiveSeries, number>; // timestamp of the last row of each series, with buckets not the timestamp of the last bucket
+  open?: Partial<Record<LiveSeries, OpenBucket>>; // newest bucket live points are added to (see appendLive)
+  cursor: string; // pass to fetchDataSince to only get what is new
 }
+
+const LIVE_SERIES = ['solar', 'meter_power', 'load', 'savings'] as const;
+type LiveSeries = typeof LIVE_SERIES[number];
+
+// time weighted sum and duration of the live points in the bucket from start, and its part from the backend, with their min and max
+interface OpenBucket { start: number; sum: number; duration: number; min: number; max: number }
 //export const EMPTY_DATA: Data = {
 //  power: { timestamps: [], values: [] },
 //  by_minute: { timestamps: [], values: [] },
 //  meter: { timestamps: [], values: [] },
 //};
 
-export async function fetchData(start?: number, end?: number): Promise<Data> {
+// points: max number of points per series, backend downsamples to min/max/avg buckets if the range contains more data than that
+export async function fetchData(start?: number, end?: number, points?: number): Promise<Data> {
   let url = new URL('http://localhost:8000/data');
 
   if (start !== undefined) url.searchParams.append('start', start.toString());
   if (end !== undefined) url.searchParams.append('end', end.toString());
+  if (points !== undefined) url.searchParams.append('points', Math.round(points).toString());
+  url.searchParams.append('format', 'bin');
 
   console.log('fetch(%s)', url.toString());
   const response = await fetch(url.toString());
@@ -27,5 +49,238 @@ export async function fetchData(start?: number, end?: number): Promise<Data> {
   if (!response.ok) {
     throw new Error('Failed to fetch data');
   }
-  return await response.json(); // Convert json response to Data object with native arrays
+  return decodeData(await response.arrayBuffer());
+}
+
+// u32 header length, json header, then per series f64 timestamps and f32 fields, each series padded to 8 bytes
+// header is padded so the arrays are aligned and can be used directly as views into the buffer
+// (typed arrays use the platform byte order, which is little endian everywhere we care about)
+function decodeData(buffer: ArrayBuffer): Data {
+  const headerLength = new DataView(buffer).getUint32(0, true);
+  const header = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 4, headerLength)));
+
+  const data = { ...header };
+  delete data.series;
+
+  let offset = 4 + headerLength;
+  for (const s of header.series as { name: string; length: number; fields: string[] }[]) {
+    const series: any = { timestamps: new Float64Array(buffer, offset, s.length) };
+    offset += s.length * 8;
+
+    for (const field of s.fields) {
+      series[field] = new Float32Array(buffer, offset, s.length);
+      offset += s.length * 4;
+    }
+    offset += -offset & 7;
+
+    data[s.name] = series;
+  }
+  return data as Data;
+}
+
+// Incremental update: solar and meter_power only contain new points to append,
+// load and savings contain a tail that replaces existing points from its first timestamp on
+// interval: of the data the update is for, the update then has buckets of that size from the one with the last row on,
+// which replace the last bucket like the load/savings tail
+export async function fetchDataSince(cursor: string, interval: number | null): Promise<Data> {
+  let url = new URL('http://localhost:8000/data');
+  url.searchParams.append('since', cursor);
+  if (interval !== null) url.searchParams.append('interval', interval.toString());
+
+  const response = await fetch(url.toString());
+
+  if (!response.ok) {
+    throw new Error('Failed to fetch data');
+  }
+  return await response.json();
+}
+
+// Append new points to a series, replacing existing points at or after from (the first new timestamp if not given)
+export function appendSeries(old: Series, add: Series, from?: number): Series {
+  if (add.timestamps.length === 0) return old;
+
+  let first = 0;
+  while (isGap(add.timestamps[first])) first++;
+  const firstTimestamp = from ?? add.timestamps[first]!;
+
+  let keep = old.timestamps.length;
+  while (keep > 0 && (isGap(old.timestamps[keep - 1]) || old.timestamps[keep - 1]! >= firstTimestamp)) keep--;
+
+  // old may be typed arrays from fetchData, those can't grow, so this turns them into plain arrays
+  const concat = (a: Values, b: Values): (number | null)[] =>
+    Array.prototype.slice.call(a, 0, keep).concat(Array.from(b));
+
+  const res: Series = {
+    timestamps: concat(old.timestamps, add.timestamps),
+    values: concat(old.values, add.values),
+  };
+  // downsampled series have min and max too, points without them count with their value
+  if (old.min && old.max) {
+    res.min = concat(old.min, add.min ?? add.values);
+    res.max = concat(old.max, add.max ?? add.values);
+  }
+  return res;
+}
+
+// Incremental update from fetchDataSince appended to data, with downsampled data its buckets replace the last one
+export function appendUpdate(data: Data, update: Data): Data {
+  return {
+    ...data,
+    solar: appendSeries(data.solar, update.solar),
+    meter_power: appendSeries(data.meter_power, update.meter_power),
+    load: appendSeries(data.load, update.load),
+    savings: appendSeries(data.savings, update.savings),
+    latest_meter_energy: update.latest_meter_energy ?? data.latest_meter_energy,
+    gap_thres: update.gap_thres ?? data.gap_thres,
+    last: update.last ?? data.last,
+    open: {}, // the buckets from the backend already have what live points added to them
+    cursor: update.cursor,
+  };
+}
+
+// Energy per day/week/month/year in kWh, from the totals the backend stores per day
+export type StatsPeriod = 'day' | 'week' | 'month' | 'year';
+export interface Stats {
+  period: StatsPeriod;
+  start: string[]; // first day of each period (YYYY-MM-DD)
+  solar: number[];
+  import: number[];
+  export: number[];
+  load: number[];
+  savings: number[];
+  self_consumption: (number | null)[]; // savings / solar
+  autarky: (number | null)[]; // savings / load
+  days: number[]; // days with data
+  complete: boolean[]; // false if the period includes today
+  total: { solar: number; import: number; export: number; load: number; savings: number; self_consumption: number | null; autarky: number | null };
+}
+
+// start/end: local days as YYYY-MM-DD
+export async function fetchStats(period: StatsPeriod, start?: string, end?: string): Promise<Stats> {
+  let url = new URL('http://localhost:8000/stats');
+  url.searchParams.append('period', period);
+  if (start !== undefined) url.searchParams.append('start', start);
+  if (end !== undefined) url.searchParams.append('end', end);
+
+  const response = await fetch(url.toString());
+
+  if (!response.ok) {
+    throw new Error('Failed to fetch stats');
+  }
+  return await response.json();
+}
+
+// Live stream of new measurements and load/savings intervals from the backend
+export interface LivePoint {
+  series: 'solar' | 'meter_power' | 'load' | 'savings' | 'meter_reading';
+  t: number;
+  v: number;
+}
+
+// Returns function to close the stream, EventSource reconnects by itself on errors
+export function subscribeLive(onPoint: (point: LivePoint) => void, onActive: (active: boolean) => void): () => void {
+  const source = new EventSource('http://localhost:8000/live');
+  source.onopen = () => onActive(true);
+  source.onerror = () => onActive(false);
+  source.onmessage = e => onPoint(JSON.parse(e.data));
+  return () => source.close();
+}
+
+const LIVE_GAP_THRES = 3000; // same as backend gap_thres_power, for responses without gap_thres
+
+function lastTimestamp(series: Series): number | null {
+  for (let i = series.timestamps.length - 1; i >= 0; i--) {
+    if (!isGap(series.timestamps[i])) return series.timestamps[i];
+  }
+  return null;
+}
+
+function lastValue(series: Series): number | null {
+  for (let i = series.values.length - 1; i >= 0; i--) {
+    if (!isGap(series.values[i])) return series.values[i];
+  }
+  return null;
+}
+
+// Append live points to data, with gaps marked like the backend does (solar gets its zero fill for plotly fills)
+// downsampled data gets them as buckets of its interval instead, averaged by the time each point stands for like the backend's buckets,
+// the newest bucket (which may be the backend's last one) is updated until the points move on to the next
+export function appendLive(data: Data, points: LivePoint[]): Data {
+  const res = { ...data, open: { ...data.open } };
+  const last = { ...data.last } as Record<LiveSeries, number | null>;
+  const interval = data.interval;
+
+  for (const name of LIVE_SERIES) {
+    const add: { timestamps: (number | null)[]; values: (number | null)[]; min: (number | null)[]; max: (number | null)[] } =
+      { timestamps: [], values: [], min: [], max: [] };
+    if (!(name in last)) last[name] = lastTimestamp(data[name]);
+    // load and savings are written for every interval, their gaps are not marked
+    let gapThres = name === 'solar' || name === 'meter_power' ? (data.gap_thres ? data.gap_thres[name] : LIVE_GAP_THRES) : Infinity;
+    if (interval !== null) gapThres = Math.max(gapThres, interval); // like the backend, gaps within a bucket can't be shown
+
+    let replaceFrom = Infinity; // the points are only appended, unless they update the last bucket
+    const push = (t: number | null, v: number | null, min = v, max = v) => {
+      add.timestamps.push(t);
+      add.values.push(v);
+      add.min.push(min);
+      add.max.push(max);
+    };
+
+    for (const p of points) {
+      if (p.series !== name) continue;
+      const prev = last[name];
+      if (prev !== null && p.t <= prev) continue;
+      const gap = prev !== null && p.t - prev > gapThres;
+
+      if (gap) {
+        if (name === 'solar') {
+          push(null, null);
+          push(prev, 0);
+          push(p.t, 0);
+          push(null, null);
+        } else {
+          push(null, null);
+        }
+      }
+
+      if (interval === null) {
+        add.timestamps.push(p.t);
+        add.values.push(p.v);
+      } else {
+        const start = Math.floor(p.t / interval) * interval;
+        const center = start + interval / 2;
+        let open = res.open[name];
+        if (add.timestamps.length === 0 && lastTimestamp(data[name]) === center) {
+          replaceFrom = center;
+          // the backend's bucket the last row is in goes on with the part of the bucket it had
+          const series = data[name];
+          const value = lastValue(series);
+          if ((open === undefined || open.start !== start) && value !== null && prev !== null && prev > start) {
+            const min = series.min ? lastValue({ timestamps: series.timestamps, values: series.min }) : null;
+            const max = series.max ? lastValue({ timestamps: series.timestamps, values: series.max }) : null;
+            open = { start, sum: value * (prev - start), duration: prev - start, min: min ?? value, max: max ?? value };
+          }
+        }
+        if (open === undefined || open.start !== start) {
+          open = { start, sum: 0, duration: 0, min: p.v, max: p.v };
+        }
+        const duration = Math.max(prev === null || gap ? 0 : p.t - Math.max(prev, start), 1);
+        open = { start, sum: open.sum + p.v * duration, duration: open.duration + duration, min: Math.min(open.min, p.v), max: Math.max(open.max, p.v) };
+        res.open[name] = open;
+
+        if (add.timestamps[add.timestamps.length - 1] === center) {
+          add.timestamps.pop();
+          add.values.pop();
+          add.min.pop();
+          add.max.pop();
+        }
+        push(center, open.sum / open.duration, open.min, open.max);
+      }
+      last[name] = p.t;
+    }
+
+    res[name] = appendSeries(data[name], add, replaceFrom);
+  }
+  res.last = last as Record<LiveSeries, number>;
+  return res;
 }
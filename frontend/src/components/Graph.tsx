@@ -1,8 +1,10 @@
 import React, { useEffect, useRef, useState } from "react";
 import Plotly from "plotly.js/dist/plotly";
-import { fetchData } from "../api";
-import type { Data } from "../api";
+import { fetchData, fetchDataSince, appendUpdate, subscribeLive, appendLive } from "../api";
+import type { Data, LivePoint, Series } from "../api";
 
+// indices in plotData, the min/max bands take two traces each
+const METER_BAND = 0, SOLAR_BAND = 2, METER = 4, LOAD = 5, SOLAR = 6, SAVINGS = 7;
 
 interface GraphProps {
   updateTrigger: number;
@@ -16,6 +18,11 @@ const Graph: React.FC<GraphProps> = ({ updateTrigger, setIsLoading, autoUpdating
   const layout = useRef<Plotly.Layout | null>(null);
   const plotData = useRef<Plotly.Data[] | null>(null);
   const [error, setError] = useState<string | null>(null);
+  // Currently displayed data and the view range it was loaded for, to only fetch new data while auto updating
+  const loadedData = useRef<Data | null>(null);
+  const loadedRange = useRef<number[] | null>(null);
+  // Live stream connected, new data arrives through it instead of polling
+  const liveActive = useRef(false);
 
   // Could not find a better way of doing this, and this still does not give me the range while panning happens, only when mouse is released
   const getXRange = () => {
@@ -90,7 +97,15 @@ const Graph: React.FC<GraphProps> = ({ updateTrigger, setIsLoading, autoUpdating
       uirevision: 0,
     } as Plotly.Layout;
     
+    // min/max band of downsampled data: an invisible max line and the min line filled up to it, before the other traces so it's behind them
+    const band = (fillcolor: string, name: string): Plotly.Data[] => [
+      { x: [], y: [], type: "scatter", mode: "lines", line: { width: 0 }, connectgaps: false, hoverinfo: "skip", showlegend: false, name },
+      { x: [], y: [], type: "scatter", mode: "lines", line: { width: 0 }, connectgaps: false, fill: "tonexty", fillcolor, hoverinfo: "skip", showlegend: false, name },
+    ];
+
     plotData.current = [
+      ...band("#1F303E30", "Zähler min/max"),
+      ...band("#F3D70050", "Solar min/max"),
       {
         x: [],
         y: [],
@@ -160,7 +175,7 @@ const Graph: React.FC<GraphProps> = ({ updateTrigger, setIsLoading, autoUpdating
     //});
   }, []);
 
-  useEffect(() => {
+  const showData = (data: Data, autoUpdating: boolean) => {
     const oldLatest = getLatestDataTime();
 
     const autopan = () => {
@@ -186,6 +201,37 @@ const Graph: React.FC<GraphProps> = ({ updateTrigger, setIsLoading, autoUpdating
       }
     }
 
+    // Really unsure how I'm supposed to do this with Plotly.restyle, which if I understand correctly is supposed to be used for changing parts of the data
+    
+    const showBand = (i: number, series: Series) => {
+      // only downsampled data has min and max, raw data has nothing to show there
+      const timestamps = series.min && series.max ? series.timestamps : [];
+      plotData.current![i].x = timestamps;
+      plotData.current![i].y = series.max ?? [];
+      plotData.current![i + 1].x = timestamps;
+      plotData.current![i + 1].y = series.min ?? [];
+    };
+    showBand(METER_BAND, data.meter_power);
+    showBand(SOLAR_BAND, data.solar);
+    plotData.current![METER].x = data.meter_power.timestamps;
+    plotData.current![METER].y = data.meter_power.values;
+    plotData.current![LOAD].x = data.load.timestamps;
+    plotData.current![LOAD].y = data.load.values;
+    //plotData.current![SOLAR].x = data.solar_by_minute.timestamps;
+    //plotData.current![SOLAR].y = data.solar_by_minute.values;
+    plotData.current![SOLAR].x = data.solar.timestamps;
+    plotData.current![SOLAR].y = data.solar.values;
+    plotData.current![SAVINGS].x = data.savings.timestamps;
+    plotData.current![SAVINGS].y = data.savings.values;
+    
+    setLatestMeter?.(data.latest_meter_energy);
+
+    autopan();
+
+    Plotly.react(div.current, plotData.current, layout.current);
+  };
+
+  useEffect(() => {
     async function loadGraphData() {
       setIsLoading?.(true);
       setError(null);
@@ -193,36 +239,37 @@ const Graph: React.FC<GraphProps> = ({ updateTrigger, setIsLoading, autoUpdating
       const startTime = Date.now();
       
       try {
-        let data;
+        let data: Data;
+
+        // No point in loading more than one point per pixel, backend downsamples to this
+        const points = div.current!.clientWidth - leftMargin;
 
         const timeRange = getXRange();
-        if (timeRange !== null) {
+
+        // While auto updating only fetch new data, unless the view was panned left or zoomed (autopan keeps the width)
+        const loaded = loadedRange.current;
+        const incremental = autoUpdating && loadedData.current !== null && timeRange !== null && loaded !== null
+          && timeRange[0] >= loaded[0]
+          && Math.abs((timeRange[1] - timeRange[0]) - (loaded[1] - loaded[0])) < 1000;
+
+        if (incremental) {
+          if (liveActive.current) return; // live stream is already appending new data
+
+          const old = loadedData.current!;
+          data = appendUpdate(old, await fetchDataSince(old.cursor, old.interval));
+        } else if (timeRange !== null) {
           // If autoupdating: always load data up to present
           // TODO: only if panned to the right (ie only if autopan would even happen)?
-          data = await fetchData(timeRange[0], autoUpdating ? undefined : timeRange[1]);
+          data = await fetchData(timeRange[0], autoUpdating ? undefined : timeRange[1], points);
+          loadedRange.current = timeRange;
         } else {
-          data = await fetchData();
+          data = await fetchData(undefined, undefined, points);
+          loadedRange.current = null;
         }
+        loadedData.current = data;
         //console.log('Received data:', data);
 
-        // Really unsure how I'm supposed to do this with Plotly.restyle, which if I understand correctly is supposed to be used for changing parts of the data
-        
-        plotData.current![0].x = data.meter_power.timestamps;
-        plotData.current![0].y = data.meter_power.values;
-        plotData.current![1].x = data.load.timestamps;
-        plotData.current![1].y = data.load.values;
-        //plotData.current![2].x = data.solar_by_minute.timestamps;
-        //plotData.current![2].y = data.solar_by_minute.values;
-        plotData.current![2].x = data.solar.timestamps;
-        plotData.current![2].y = data.solar.values;
-        plotData.current![3].x = data.savings.timestamps;
-        plotData.current![3].y = data.savings.values;
-        
-        setLatestMeter?.(data.latest_meter_energy);
-
-        autopan();
-
-        Plotly.react(div.current, plotData.current, layout.current);
+        showData(data, autoUpdating);
         
       } catch (err) {
         setError("Failed to load data.");
@@ -239,6 +286,30 @@ const Graph: React.FC<GraphProps> = ({ updateTrigger, setIsLoading, autoUpdating
     loadGraphData();
   }, [updateTrigger, setIsLoading]);
 
+  // Live stream while auto updating, points are collected and added to the plot once a second
+  useEffect(() => {
+    if (!autoUpdating) return;
+
+    const pending: LivePoint[] = [];
+    const close = subscribeLive(
+      point => pending.push(point),
+      active => { liveActive.current = active; }
+    );
+
+    const flush = window.setInterval(() => {
+      if (pending.length === 0 || loadedData.current === null) return;
+
+      loadedData.current = appendLive(loadedData.current, pending.splice(0));
+      showData(loadedData.current, true);
+    }, 1000);
+
+    return () => {
+      close();
+      window.clearInterval(flush);
+      liveActive.current = false;
+    };
+  }, [autoUpdating]);
+
   // pan/scroll x on main plot, but y while hovering y axis by toggling yaxis.fixedrange
   useEffect(() => {
     if (!div.current) return;
@@ -0,0 +1,344 @@
+import json
+import os
+import struct
+import time
+import traceback
+import zlib
+from datetime import datetime, timezone
+import numpy as np
+import database as db
+import derived
+import partitions
+import retention
+import rollups
+
+# Archive files of the raw data, one per channel and month (DIR/channel/YYYY-MM.sma), for backups, offline analysis
+# and moving the database, much smaller and faster than going through /data or inserting rows one by one
+# layout (little endian):
+#   magic, u32 header length, json header { "channel", "type", "unit", "start", "end", "compacted_until" }
+#   blocks of up to BLOCK_ROWS rows: u32 rows, u32 bytes, u8 timestamp width, then zlib compressed:
+#     i64 first timestamp, zigzag delta-of-delta timestamps (width bytes each), float32 values xor the previous value
+#     both byte planes (all first bytes, all second bytes, ...), with ~1 Hz samples nearly all planes are zeros
+#   an empty block (rows = 0) at the end, so truncated files are noticed
+# compacted_until is the retention state of the channel (see retention.py) when the month was exported, None if raw
+MAGIC = b'SMA1'
+EXTENSION = '.sma'
+BLOCK_ROWS = 65536
+ZLIB_LEVEL = 6
+
+BLOCK_HEADER = struct.Struct('<IIB')
+END_BLOCK = BLOCK_HEADER.pack(0, 0, 0)
+
+# rows per insert statement when importing without LOAD DATA
+INSERT_ROWS = 10000
+
+def header_bytes(header):
+    header = json.dumps(header).encode()
+    return MAGIC + struct.pack('<I', len(header)) + header
+
+def byte_planes(arr):
+    return arr.view(np.uint8).reshape(len(arr), arr.itemsize).T.tobytes()
+
+def from_byte_planes(data, dtype, n):
+    dtype = np.dtype(dtype)
+    planes = np.frombuffer(data, np.uint8, n*dtype.itemsize).reshape(dtype.itemsize, n)
+    return np.ascontiguousarray(planes.T).view(dtype).reshape(n)
+
+def encode_block(timestamps, values):
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    deltas = np.diff(timestamps, prepend=timestamps[0])
+    dod = np.diff(deltas, prepend=0)
+    zigzag = ((dod << 1) ^ (dod >> 63)).view(np.uint64)
+
+    width = 8
+    for w in (1, 2, 4):
+        if int(zigzag.max()) < 1 << (8*w):
+            width = w
+            break
+
+    bits = np.asarray(values, dtype='<f4').view('<u4')
+    xored = bits ^ np.concatenate([[0], bits[:-1]]).astype('<u4')
+
+    payload = struct.pack('<q', timestamps[0]) + byte_planes(zigzag.astype(f'<u{width}')) + byte_planes(xored)
+    data = zlib.compress(payload, ZLIB_LEVEL)
+    return BLOCK_HEADER.pack(len(timestamps), len(data), width) + data
+
+def decode_block(n, width, data):
+    payload = zlib.decompress(data)
+    first, = struct.unpack_from('<q', payload)
+    zigzag = from_byte_planes(payload[8:8 + n*width], f'<u{width}', n).astype(np.uint64)
+    xored = from_byte_planes(payload[8 + n*width:], '<u4', n)
+
+    dod = (zigzag >> np.uint64(1)).view(np.int64) ^ -(zigzag & np.uint64(1)).view(np.int64)
+    timestamps = first + np.cumsum(np.cumsum(dod))
+    values = np.bitwise_xor.accumulate(xored).view('<f4')
+    return timestamps, values
+
+# header and a generator of (timestamps, values) blocks, the file has to stay open while the blocks are read
+def read_archive(f):
+    if f.read(4) != MAGIC:
+        raise ValueError(f"{getattr(f, 'name', 'archive')} is not an archive file")
+    size, = struct.unpack('<I', f.read(4))
+    header = json.loads(f.read(size))
+
+    def blocks():
+        while True:
+            block = f.read(BLOCK_HEADER.size)
+            if len(block) < BLOCK_HEADER.size:
+                raise ValueError(f"{getattr(f, 'name', 'archive')} is truncated")
+            n, size, width = BLOCK_HEADER.unpack(block)
+            if n == 0: return
+            yield decode_block(n, width, f.read(size))
+
+    return header, blocks()
+
+def month_name(start):
+    t = datetime.fromtimestamp(start / 1000, timezone.utc)
+    return f"{t.year:04d}-{t.month:02d}"
+
+def time_name(timestamp):
+    return f"{datetime.fromtimestamp(int(timestamp) / 1000, timezone.utc):%Y-%m-%d %H:%M:%S}"
+
+# 'YYYY-MM' -> (start, end) timestamps of the month (utc, like the partitions), ValueError if malformed
+def month_range(month):
+    year, month = (int(part) for part in month.split('-'))
+    if not 1 <= month <= 12: raise ValueError(f"invalid month {month}")
+    return partitions.month_start(year, month), partitions.month_start(*partitions.next_month(year, month))
+
+def file_path(dir, channel, start):
+    return os.path.join(dir, channel, month_name(start) + EXTENSION)
+
+def make_header(name, type, unit, start, end, compacted_until):
+    if compacted_until is not None and compacted_until <= start: compacted_until = None
+    return {
+        'channel': name, 'type': type, 'unit': unit, 'start': start, 'end': end,
+        'compacted_until': min(compacted_until, end) if compacted_until is not None else None,
+    }
+
+RANGE_QUERY = """SELECT timestamp, value FROM data
+                WHERE channel_id = %s and timestamp >= %s and timestamp < %s
+                ORDER BY timestamp"""
+
+def rows_to_block(rows):
+    arr = np.array(rows, dtype=np.float64) # float64 is exact for ms timestamps
+    return encode_block(arr[:, 0].astype(np.int64), arr[:, 1])
+
+# Writes one month of a channel, reading the rows a block at a time, returns the row count (0 = no file written)
+# written to a temporary file first, so an existing archive is only replaced by a complete one
+def export_month(conn, channel_id, header, path):
+    cur = conn.cursor()
+    tmp = path + '.tmp'
+    rows = 0
+    try:
+        cur.execute(RANGE_QUERY, (channel_id, header['start'], header['end']))
+        with open(tmp, 'wb') as f:
+            f.write(header_bytes(header))
+            while block := cur.fetchmany(BLOCK_ROWS):
+                f.write(rows_to_block(block))
+                rows += len(block)
+            f.write(END_BLOCK)
+    finally:
+        cur.close()
+
+    if rows:
+        os.replace(tmp, path)
+    else:
+        os.remove(tmp)
+    return rows
+
+# Same as a response of the backend (GET /archive), cur is a db.LazyCursor
+async def stream_month(cur, channel_id, header):
+    yield header_bytes(header)
+    async for block in cur.stream(RANGE_QUERY, (channel_id, header['start'], header['end']), BLOCK_ROWS):
+        yield rows_to_block(block)
+    yield END_BLOCK
+
+# names: channel names to export, None for all, first/last: months 'YYYY-MM', None for everything there is
+def export(conn, dir, names=None, first=None, last=None):
+    cur = conn.cursor()
+    retention.create_tables(cur)
+    cur.execute("SELECT channel_id, name, type, unit FROM channels")
+    channels = [c for c in cur.fetchall() if names is None or c[1] in names]
+    cur.execute("SELECT channel_id, compacted_until FROM retention")
+    compacted = dict(cur.fetchall())
+
+    total = 0
+    for channel_id, name, type, unit in channels:
+        cur.execute("SELECT min(timestamp), max(timestamp) FROM data WHERE channel_id = %s", (channel_id,))
+        lo, hi = cur.fetchone()
+        if lo is None: continue
+        conn.commit() # don't keep a snapshot open
+        if first is not None: lo = max(lo, month_range(first)[0])
+        if last is not None: hi = min(hi, month_range(last)[1] - 1)
+        if lo > hi: continue
+
+        os.makedirs(os.path.join(dir, name), exist_ok=True)
+        t0 = time.perf_counter()
+        rows = 0
+        files = 0
+        for partition, start, end in partitions.months(lo, hi):
+            header = make_header(name, type, unit, start, end, compacted.get(channel_id))
+            path = file_path(dir, name, start)
+            n = export_month(conn, channel_id, header, path)
+            if n:
+                rows += n
+                files += 1
+        t1 = time.perf_counter()
+        total += rows
+        print(f"Exported {rows} rows of {name} into {files} files in {t1 - t0:.1f} s ({rows / max(t1 - t0, 1e-9):.0f} rows/s)")
+
+    cur.close()
+    return total
+
+def values_sql(channel_id, timestamps, values):
+    return ",".join(f"({channel_id},{t},{v:.9g})" for t, v in zip(timestamps.tolist(), values.astype(np.float64).tolist()))
+
+def insert_rows(cur, channel_id, timestamps, values):
+    for i in range(0, len(timestamps), INSERT_ROWS):
+        # only numbers, built directly instead of escaping every parameter
+        cur.execute(f"""INSERT INTO data (channel_id, timestamp, value)
+                    VALUES {values_sql(channel_id, timestamps[i:i + INSERT_ROWS], values[i:i + INSERT_ROWS])}
+                    ON DUPLICATE KEY UPDATE value = VALUES(value)""")
+
+# needs local_infile enabled on the server and the connection (db.get_conn(allow_local_infile=True))
+def load_data(cur, channel_id, blocks, tmp):
+    with open(tmp, 'w') as f:
+        for timestamps, values in blocks:
+            f.writelines(f"{channel_id}\t{t}\t{v:.9g}\n" for t, v in zip(timestamps.tolist(), values.astype(np.float64).tolist()))
+    try:
+        cur.execute("LOAD DATA LOCAL INFILE %s REPLACE INTO TABLE data (channel_id, timestamp, value)", (os.path.abspath(tmp),))
+    finally:
+        os.remove(tmp)
+
+# Loads one archive file, replacing rows with the same timestamps, then rebuilds the rollups of the month
+# channels are matched by name and created if missing, so ids may differ from the database it was exported from
+def import_file(conn, path, use_load_data=False):
+    cur = conn.cursor()
+    rows = 0
+    try:
+        with open(path, 'rb') as f:
+            header, blocks = read_archive(f)
+            channel_id = db.get_or_create_channel(cur, header['channel'], header['type'], header['unit'])
+
+            if use_load_data:
+                counted = []
+                def count(blocks):
+                    for block in blocks:
+                        counted.append(len(block[0]))
+                        yield block
+                load_data(cur, channel_id, count(blocks), path + '.tsv')
+                rows = sum(counted)
+            else:
+                for timestamps, values in blocks:
+                    insert_rows(cur, channel_id, timestamps, values)
+                    rows += len(timestamps)
+
+        # compacted months only have the means, rollups this database already has for them keep their real min/max
+        start, end = header['start'], header['end']
+        known = retention.get_compacted_until(cur, channel_id)
+        if header['compacted_until'] is not None:
+            retention.set_compacted_until(cur, channel_id, header['compacted_until'])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+
+    rollups.backfill(conn, channel_id, max(start, known) if known else start, end)
+    return header, rows
+
+def archive_files(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                yield from (os.path.join(root, name) for name in sorted(files) if name.endswith(EXTENSION))
+        else:
+            yield path
+
+def import_files(conn, paths, use_load_data=False):
+    cur = conn.cursor()
+    retention.create_tables(cur)
+    rollups.create_tables(cur)
+    cur.close()
+
+    total = 0
+    derived_months = set() # months of meter or solar rows, their load/savings are recomputed
+    t0 = time.perf_counter()
+    for path in archive_files(paths):
+        t1 = time.perf_counter()
+        header, rows = import_file(conn, path, use_load_data)
+        total += rows
+        if header['channel'] in ('meter_power', 'solar_power'):
+            derived_months.add((header['start'], header['end']))
+        print(f"Imported {rows} rows of {header['channel']} {month_name(header['start'])} in {time.perf_counter() - t1:.1f} s")
+    t1 = time.perf_counter()
+    print(f"Imported {total} rows in {t1 - t0:.1f} s ({total / max(t1 - t0, 1e-9):.0f} rows/s)")
+
+    cur = conn.cursor()
+    channels = derived.get_channels(cur)
+    chunks = [chunk for start, end in sorted(derived_months) for chunk in derived.repair_chunks(cur, channels, start, end)] if 'load' in channels else []
+    conn.commit()
+    cur.close()
+    for start, end in chunks:
+        derived.repair_chunk(conn, channels, start, end)
+    if chunks:
+        print(f"Recomputed load/savings of {len(derived_months)} months in {time.perf_counter() - t1:.1f} s")
+    return total
+
+def info(paths):
+    for path in archive_files(paths):
+        with open(path, 'rb') as f:
+            header, blocks = read_archive(f)
+            rows = 0
+            first = last = None
+            for timestamps, values in blocks:
+                rows += len(timestamps)
+                first = timestamps[0] if first is None else first
+                last = timestamps[-1]
+        size = os.path.getsize(path)
+        print(f"{path}: {header['channel']} {month_name(header['start'])} {rows} rows, {size} bytes ({size / max(rows, 1):.2f} bytes/row)"
+              + (f", {time_name(first)} to {time_name(last)}" if rows else "")
+              + (f", compacted until {datetime.fromtimestamp(header['compacted_until'] / 1000, timezone.utc):%Y-%m-%d}" if header['compacted_until'] else ""))
+
+# python archive.py export DIR [channel ...] [--from YYYY-MM] [--to YYYY-MM]
+#   writes DIR/channel/YYYY-MM.sma for every month with data, existing files are replaced
+# python archive.py import [--load-data] FILE|DIR ...
+#   loads archive files into the database of database.env, rows with the same timestamp are replaced, rollups are rebuilt
+#   and load/savings are recomputed for the months of meter and solar files (see derived.py)
+#   --load-data uses LOAD DATA LOCAL INFILE, faster but needs local_infile=1 on the mysql server
+#   restart measure.py afterwards, so the backend drops its cached history (see backend.clear_cache)
+# python archive.py info FILE|DIR ...
+if __name__ == "__main__":
+    import sys
+
+    def option(args, name):
+        if name not in args: return None
+        i = args.index(name)
+        value = args[i + 1]
+        del args[i:i + 2]
+        return value
+
+    args = sys.argv[1:]
+    if len(args) < 2 or args[0] not in ("export", "import", "info"):
+        print("usage: python archive.py export DIR [channel ...] [--from YYYY-MM] [--to YYYY-MM]\n"
+              "       python archive.py import [--load-data] FILE|DIR ...\n"
+              "       python archive.py info FILE|DIR ...")
+        sys.exit(1)
+
+    try:
+        if args[0] == "export":
+            first, last = option(args, '--from'), option(args, '--to')
+            with db.get_conn() as conn:
+                export(conn, args[1], args[2:] or None, first, last)
+        elif args[0] == "import":
+            use_load_data = '--load-data' in args
+            paths = [arg for arg in args[1:] if arg != '--load-data']
+            with db.get_conn(allow_local_infile=use_load_data) as conn:
+                import_files(conn, paths, use_load_data)
+        else:
+            info(args[1:])
+    except Exception:
+        print(f"Error: {traceback.format_exc()}")
+        sys.exit(1)
@@ -1,12 +1,76 @@
-from fastapi import FastAPI, HTTPException
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from datetime import datetime, timedelta
+from fastapi.responses import Response, StreamingResponse
+from datetime import date, datetime, timedelta
+import numpy as np
+import archive
+import asyncio
+import bisect
+import cache
+import columnar
+import functools
+import json
 import database as db
+import derived
+import energy
+import hot
+import live
+import logging
+import metrics
+import os
 import time
 import timestamps as ts
+import resample
+import retention
+import rollups
+import sampling
 import traceback
 
-app = FastAPI()
+# timings per request and step are debug output, SOLARMON_DEBUG=1 shows them, /metrics has them aggregated
+log = logging.getLogger('solarmon.backend')
+if os.environ.get('SOLARMON_DEBUG'):
+    logging.basicConfig(format='%(asctime)s-%(levelname)s | %(message)s')
+    log.setLevel(logging.DEBUG)
+
+data_requests = metrics.Counter('solarmon_backend_data_requests_total', 'Requests to /data')
+data_not_modified = metrics.Counter('solarmon_backend_data_not_modified_total', 'Requests to /data answered with 304')
+data_seconds = metrics.Histogram('solarmon_backend_data_seconds', 'Time to prepare a /data response, without encoding and sending the body', metrics.TIME_BUCKETS)
+fetch_seconds = metrics.Histogram('solarmon_backend_fetch_seconds', 'Time of one database query for /data (raw rows or buckets of a channel)', metrics.TIME_BUCKETS)
+fetch_rows = metrics.Histogram('solarmon_backend_fetch_rows', 'Rows returned by one database query for /data', metrics.ROW_BUCKETS)
+processing_seconds = metrics.Histogram('solarmon_backend_processing_seconds', 'Time of one processing step (gaps of a series)', metrics.TIME_BUCKETS)
+encode_seconds = metrics.Histogram('solarmon_backend_encode_seconds', 'Time spent encoding a /data response body (json or binary)', metrics.TIME_BUCKETS)
+response_bytes = metrics.Counter('solarmon_backend_response_bytes_total', 'Bytes of /data response bodies')
+stats_seconds = metrics.Histogram('solarmon_backend_stats_seconds', 'Time to answer /stats', metrics.TIME_BUCKETS)
+energy_update_seconds = metrics.Histogram('solarmon_backend_energy_update_seconds', 'Time to update the stored daily energy', metrics.TIME_BUCKETS)
+metrics.Counter('solarmon_backend_cache_hits_total', 'Chunk cache hits', fn=lambda: cache.chunks.hits)
+metrics.Counter('solarmon_backend_cache_misses_total', 'Chunk cache misses', fn=lambda: cache.chunks.misses)
+metrics.Gauge('solarmon_backend_cache_bytes', 'Approximate size of the chunk cache', fn=lambda: cache.chunks.size)
+metrics.Gauge('solarmon_backend_live_clients', 'Connected /live clients', fn=lambda: len(live_clients))
+
+# shared database connection pool, created on startup
+pool = None
+
+@asynccontextmanager
+async def lifespan(app):
+    global pool
+    pool = await db.create_pool()
+    try:
+        async with db.LazyCursor(pool) as cur:
+            await energy.create_tables(cur) # /stats works before the first energy update
+    except Exception:
+        print(f"Error creating tables: {traceback.format_exc()}")
+    live_task = asyncio.create_task(live.subscribe(relay_live, on_connect=clear_cache))
+    hot_task = asyncio.create_task(hot.hot_data.run(pool))
+    energy_task = asyncio.create_task(energy_loop())
+    yield
+    live_task.cancel()
+    hot_task.cancel()
+    energy_task.cancel()
+    pool.close()
+    await pool.wait_closed()
+
+app = FastAPI(lifespan=lifespan)
 
 # Add CORS middleware
 app.add_middleware(
@@ -17,224 +81,803 @@ app.add_middleware(
     allow_headers=["*"], # Allow all headers
 )
 
-# TODO: instead of processing for gaps, then trying to filter by combining solar and meter afterwards
-# try to produce raw view data with gaps and filtered version with data in interval (either value or null for missing) first
-# then combing the two arrays is easy
-def process_results(results, gap_thres, gap_fill_fix):
-    timestamps = []
-    values = []
-    
-    if len(results) == 0: return timestamps, values
-    
-    prev_row = results[0] # no gap on first row
-    for row in results:
-        # add None entries for gaps if we determine data is missing (so frontend can show gaps by not drawing lines)
-        if row[0] - prev_row[0] > gap_thres:
-            if gap_fill_fix: # fix for plotly filling gaps for fill="tozeroy"
-                # plotly does not actually handle gaps correctly if fill is used
-                # gap in line
-                timestamps.append(None)
-                values.append(None)
-                # artificially set line to zero to avoid wrong fill
-                timestamps.append(prev_row[0])
-                timestamps.append(row[0]) #  - 60*1000
-                values.append(0)
-                values.append(0)
-                # gap in line
-                timestamps.append(None)
-                values.append(None)
-            else:
-                # make gap in plotly line trace via nulls
-                timestamps.append(None)
-                values.append(None)
-        #if row[0] - prev_row[0] > 1500:
-        #    print(f"{ts.time_from_timestamp(prev_row[0])} - {ts.time_from_timestamp(row[0])} {row[0] - prev_row[0]}")
-        
-        timestamps.append(row[0])
-        values.append(row[1])
-
-        prev_row = row
-
-    return timestamps, values
-
-def filter_and_sum_meter_and_solar(meter_data, solar_data, start, end):
-    if len(meter_data['timestamps']) == 0 or len(solar_data['timestamps']) == 0:
-        return (
-            { 'timestamps': [], 'values': [] },
-            { 'timestamps': [], 'values': [] }
-        )
+# rows from the database -> columnar arrays (timestamps as int64, values as float64)
+# timestamps are exact in float64 (< 2^53) so converting through a float array is fine
+def rows_to_arrays(rows):
+    if len(rows) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+
+    arr = np.array(rows, dtype=np.float64)
+    return arr[:,0].astype(np.int64), arr[:,1]
+
+# add NaN entries for gaps if we determine data is missing (so frontend can show gaps by not drawing lines, they end up as null in json)
+# prev_timestamp: timestamp of the row before these (for incremental updates), so gaps to it are detected too
+# returns float64 arrays, the response is encoded from them in chunks (see columnar.py)
+def process_results(timestamps, values, gap_thres, gap_fill_fix, prev_timestamp=None):
+    n = len(timestamps)
+    if n == 0: return np.empty(0), np.empty(0)
+
+    prev = np.empty(n, dtype=np.int64)
+    prev[1:] = timestamps[:-1]
+    prev[0] = timestamps[0] if prev_timestamp is None else prev_timestamp # no gap on first row
+
+    gaps = np.flatnonzero(timestamps - prev > gap_thres)
+
+    # fix for plotly filling gaps for fill="tozeroy", plotly does not actually handle gaps correctly if fill is used
+    # so per gap: None, zero at previous row, zero at next row, None (artificially set line to zero to avoid wrong fill)
+    # otherwise just a None (make gap in plotly line trace via nulls)
+    markers = 4 if gap_fill_fix else 1
+
+    # position of each row in the output, shifted by the markers inserted before it
+    shift = np.zeros(n, dtype=np.int64)
+    shift[gaps] = markers
+    pos = np.arange(n) + np.cumsum(shift)
+
+    out_timestamps = np.full(n + markers*len(gaps), np.nan)
+    out_values = np.full(n + markers*len(gaps), np.nan)
+    out_timestamps[pos] = timestamps
+    out_values[pos] = values
+
+    if gap_fill_fix:
+        fill = pos[gaps] - markers + 1
+        out_timestamps[fill] = prev[gaps]
+        out_timestamps[fill + 1] = timestamps[gaps]
+        out_values[fill] = 0
+        out_values[fill + 1] = 0
+
+    return out_timestamps, out_values
+
+# assume missing data if 3 times more elapsed time than supposed sample rate
+GAP_THRES_POWER = sampling.GAP_THRES
+
+# bucket sizes for downsampled queries (ms), buckets are aligned to multiples of these
+# so the grid stays the same while panning instead of shifting with the requested start
+RESOLUTIONS = [s*1000 for s in [
+    2, 5, 10, 30,
+    60, 2*60, 5*60, 10*60, 15*60, 30*60,
+    60*60, 2*60*60, 3*60*60, 6*60*60, 12*60*60, 24*60*60
+]]
+
+# pick the smallest bucket size that results in at most 'points' buckets for the range
+# returns None if the raw data is already about as dense as requested
+def pick_interval(start, end, points):
+    if points is None or points <= 0: return None
+
+    end = min(end, ts.get_volkzaehler_timestamp()) # end defaults to far future
+    wanted = (end - start) / points
+    if wanted <= 1000: # data is 1 Hz at most
+        return None
+
+    for res in RESOLUTIONS:
+        if res >= wanted:
+            return res
+    return RESOLUTIONS[-1]
+
+# min/max/avg per bucket computed by the database, so only the aggregated rows are transferred
+# reads from the coarsest rollup table that fits the bucket size where the rollups are complete (see rollups.rollup_coverage),
+# raw data before that, with the same weighting of irregularly sampled rows (channel_sampling, see sampling.py)
+# rows: (bucket, avg, min, max, first_timestamp, last_timestamp)
+async def query_bucket_rows(cur, channel_id, start, end, interval, channel_sampling):
+    results = []
+
+    split = end + 1 # first bucket read from the rollups
+    rollup = rollups.pick_rollup(interval)
+    if rollup is not None:
+        covered_from = await rollups.get_covered_from(cur, channel_id)
+        if covered_from is not None:
+            split = max(-(-covered_from // interval) * interval, start // interval * interval)
+
+    if start < split:
+        rows, args = rollups.weighted_rows(channel_id, start, min(end, split - 1) + 1, channel_sampling)
+        await cur.execute(f"""select timestamp div %s as bucket, sum(value * w) / sum(w), min(value), max(value), min(timestamp), max(timestamp)
+                        from ({rows}) as weighted_rows
+                        group by bucket
+                        order by bucket
+                        """, (interval, *args))
+        results += await cur.fetchall()
+
+    if split <= end:
+        res, table = rollup
+        await cur.execute(f"""select bucket div %s as b, sum(sum_value) / sum(cnt), min(min_value), max(max_value), min(first_ts), max(last_ts)
+                        from {table}
+                        where channel_id = %s and bucket between %s and %s
+                        group by b
+                        order by b
+                        """, (interval, channel_id, split, end))
+        results += await cur.fetchall()
+
+    return results
+
+# buckets overlapping [start, end]
+def bucket_rows_part(rows, start, end, interval):
+    lo = bisect.bisect_left(rows, start // interval, key=lambda row: row[0])
+    hi = bisect.bisect_right(rows, end // interval, key=lambda row: row[0])
+    return rows[lo:hi]
+
+# goes through the chunk cache for history (see cache.py)
+async def query_channel_buckets(cur, channel_id, start, end, interval, channel_sampling):
+    async def fetch(start, end):
+        with fetch_seconds.time() as timer:
+            rows = await query_bucket_rows(cur, channel_id, start, end, interval, channel_sampling)
+        fetch_rows.observe(len(rows))
+        log.debug(f"  bucket fetch time: {timer.seconds*1000:.2f} ms ({len(rows)} buckets of {interval} ms)")
+        return rows
 
-    t0 = time.perf_counter()
+    try:
+        results = await cache.chunks.get_range((channel_id, interval), start, end,
+            fetch = fetch,
+            part = lambda rows, s, e: bucket_rows_part(rows, s, e, interval),
+            join = lambda parts: [row for rows in parts for row in rows],
+            size = lambda rows: len(rows) * 250) # rough size of a tuple of 6 python numbers
+        return results
+    except Exception as ex:
+        print(f"Error querying channel buckets: {traceback.format_exc()}")
+        return []
 
-    print(f"start: {start}, end: {end}")
-
-    offs_meter = 0 # -4*1000 # artificial offset to make meter data align with solar data (which is more accurate, since based on solar dips we can sync it and measurements can't predict the future)
-    offs_solar = 0
-
-    start = max(start, min(meter_data['timestamps'][0] + offs_meter, solar_data['timestamps'][0] + offs_solar))
-    end   = min(end  , max(meter_data['timestamps'][-1] + offs_meter, solar_data['timestamps'][-1] + offs_solar))
-
-    print(f"start: {start}, end: {end}")
-
-    interval = 4*1000
-    sample_rate = 1000 # Should get this from the database!
-
-    start_i = start // interval
-    end_i   = end // interval # include timeperiod number
-    count   = end_i+1 - start_i
-
-    print(f"start_i: {start_i}, end_i: {end_i}, count: {count}")
-
-    res_tim = [i*interval - interval//2 for i in range(start_i, end_i+1)] # center the interval makes most sense for the plot
-
-    # 'accurate' accumulation, anyway here's a picture:
-    #  [        5 seconds        ][        5 seconds        ]
-    # [    ][    ][    ][    ][ L|R][    ][    ][    ][    ]
-    # compute weight of left and right part of the sample falling into different intervals
-    def accumulate(data, offs):
-        # compute duration of each measurement based on previous timestamp
-        times = data['timestamps']
-        values = data['values']
-        buf = [0]*count
-
-        prev_timestamp = (times[0] + offs - sample_rate) / interval
-
-        for i in range(0, len(times)):
-            timestamp = times[i]
-            if timestamp is None: continue # gap count as 0
-            # keep all timestamps and durations in interval to minimize computation, yes this is confusing
-            # NOTE: why does this mean that value * dur is not a energy value but a average power value?
-            timestamp = (timestamp + offs) / interval
-            
-            # duration of sample using previous timestamp (relative to interval)
-            dur = timestamp - prev_timestamp
-            weighted_value = values[i] * dur # weight the value to result in average power in interval
-            # compute the interval the end of the sample falls into
-            tmp = int(timestamp)
-            interval_ts = float(tmp)
-            right_idx = tmp - start_i
-
-            if prev_timestamp >= interval_ts:
-                # entire sample is in the interval, fastpath
-                if right_idx >= 0 and right_idx < count:
-                    buf[right_idx] += weighted_value
+# like process_results, but for bucket rows, values are the bucket averages with min and max as extra series
+# gap_thres: function(timestamps) (see get_gap_thres)
+def process_buckets(rows, interval, gap_thres, gap_fill_fix, compacted_until=None):
+    timestamps = []
+    values = []
+    mins = []
+    maxs = []
+
+    def append(t, v, vmin, vmax):
+        timestamps.append(t)
+        values.append(v)
+        mins.append(vmin)
+        maxs.append(vmax)
+
+    if len(rows) == 0: return { 'timestamps': timestamps, 'values': values, 'min': mins, 'max': maxs }
+
+    # gaps smaller than a bucket can't be shown anyway
+    firsts = np.array([row[4] for row in rows], dtype=np.int64)
+    thres = np.maximum(retention.gap_thres_for(firsts, gap_thres(firsts), compacted_until), interval)
+    thres = np.broadcast_to(thres, len(rows)).tolist()
+
+    prev_last = rows[0][5] # no gap on first row
+    for (bucket, avg, vmin, vmax, first, last), row_thres in zip(rows, thres):
+        # same gap handling as process_results, but using the real first/last sample timestamps in the buckets
+        if first - prev_last > row_thres:
+            if gap_fill_fix:
+                append(None, None, None, None)
+                append(prev_last, 0, 0, 0)
+                append(first, 0, 0, 0)
+                append(None, None, None, None)
             else:
-                # split sample, compute duration of l/r part and weight accordingly
-                right_dur = timestamp - interval_ts
-                right_value = weighted_value * (right_dur / dur) # part of the energy falling into the right interval
-                left_value = weighted_value - right_value
-
-                left_idx = right_idx - 1
-                if left_idx  >= 0 and right_idx < count:  buf[left_idx ] += left_value
-                if right_idx >= 0 and right_idx < count:  buf[right_idx] += right_value
-
-            prev_timestamp = timestamp
-        
-        return buf
-    
-    meter_buf = accumulate(meter_data, offs_meter)
-    solar_buf = accumulate(solar_data, offs_solar)
-
-    # TODO: could try to turn gaps in source values into gaps in filtered data, but his is a little complicated because gap fix makes detecting gaps harder
-    # Instead just accept that missing values will technically introduce error in things like saved energy numbers
-    # remove negative values due to glitches
-    load_val = [max(val[0] + val[1], 0.0) for val in zip(meter_buf, solar_buf)]
-
-    energy_saving = [
-        max(min(val[0], 0.0) + val[1], 0.0) 
-        for val in zip(meter_buf, solar_buf)]
-
-    res = [
-        { 'timestamps': res_tim, 'values': load_val },
-        { 'timestamps': res_tim, 'values': energy_saving }
-    ]
-    
-    t1 = time.perf_counter()
-    print(f" filter_and_sum_meter_and_solar time: {(t1 - t0)*1000:.2f} ms")
-
-    return res
-
-def query_channel_range(cur, channel_id, start, end, gap_thres, gap_fill_fix=False):
-    try:
+                append(None, None, None, None)
+
+        append(bucket*interval + interval//2, avg, vmin, vmax) # center of bucket
+
+        prev_last = last
+
+    return { 'timestamps': timestamps, 'values': values, 'min': mins, 'max': maxs }
+
+# rows are streamed from the database and converted a chunk at a time, so only the arrays (16 bytes per row) are ever held in full
+async def query_channel_rows(cur, channel_id, start, end):
+    parts = []
+    async for rows in cur.stream("""select timestamp, value
+                    from data
+                    where channel_id = %s and timestamp between %s and %s
+                    order by timestamp
+                    """, (channel_id, start, end)):
+        parts.append(rows_to_arrays(rows))
+    return join_arrays(parts)
+
+def arrays_part(arrays, start, end):
+    timestamps, values = arrays
+    lo = np.searchsorted(timestamps, start, 'left')
+    hi = np.searchsorted(timestamps, end, 'right')
+    if lo == 0 and hi == len(timestamps): return arrays
+    return timestamps[lo:hi].copy(), values[lo:hi].copy() # cached chunks shouldn't keep the whole fetch alive
+
+def join_arrays(parts):
+    if not parts: return rows_to_arrays([])
+    if len(parts) == 1: return parts[0]
+    return np.concatenate([p[0] for p in parts]), np.concatenate([p[1] for p in parts])
+
+# returns (timestamps, values) arrays, goes through the chunk cache for history (see cache.py)
+async def query_channel_range(cur, channel_id, start, end):
+    async def fetch(start, end):
         t0 = time.perf_counter()
-        t0f = time.perf_counter()
-
-        cur.execute("""select timestamp, value
-                        from data
-                        where channel_id = %s and timestamp between %s and %s
-                        """, (channel_id, start, end))
-        results = cur.fetchall()
-        t1f = time.perf_counter()
-
-        print(f'channel_id: {channel_id} blah: {len(results)}')
-
-        t0p = time.perf_counter()
-
-        timestamps, values = process_results(results, gap_thres, gap_fill_fix)
 
-        res = { 'timestamps': timestamps, 'values': values }
-        t1p = time.perf_counter()
+        arrays = await query_channel_rows(cur, channel_id, start, end)
         t1 = time.perf_counter()
-        
+        fetch_seconds.observe(t1 - t0)
+        fetch_rows.observe(len(arrays[0]))
+
         # fatch is the bottleneck by far, takes a lot more time than iterating the data in python, so json conversion is likely fast as well
         # but of course once backend is deployed to raspberry, performance will change dramatically
-        print(f"  fetch time: {(t1f - t0f)*1000:.2f} ms")
-        print(f"  processing time: {(t1p - t0p)*1000:.2f} ms")
-        print(f" total query time: {(t1 - t0)*1000:.2f} ms")
+        log.debug(f"  channel {channel_id}: {len(arrays[0])} rows, fetch time: {(t1 - t0)*1000:.2f} ms")
 
-        return res
+        return arrays
+
+    try:
+        return await cache.chunks.get_range((channel_id, 0), start, end, fetch, arrays_part, join_arrays,
+            size = lambda arrays: arrays[0].nbytes + arrays[1].nbytes)
     except Exception as ex:
         print(f"Error querying channel range: {traceback.format_exc()}")
-        return { 'timestamps': [], 'values': [] }
+        return rows_to_arrays([])
+
+# channel_id -> compacted_until, only queried if the range can reach into compacted data at all
+compacted = None
+
+async def get_compacted(cur, start):
+    global compacted
+    if start >= ts.get_volkzaehler_timestamp() - min(retention.RETENTION.values())*24*60*60*1000 - retention.CHUNK:
+        return {}
+
+    if compacted is None:
+        try:
+            await cur.execute("SELECT channel_id, compacted_until FROM retention")
+            compacted = dict(await cur.fetchall())
+        except Exception:
+            print(f"Error querying retention: {traceback.format_exc()}")
+            return {} # retention job never ran
+    return compacted
+
+# (timestamps, values) arrays -> series for the response, with gaps marked, gap_thres: function(timestamps) (see get_gap_thres)
+def to_series(arrays, gap_thres, gap_fill_fix, prev_timestamp=None, compacted_until=None):
+    t0 = time.perf_counter()
+    gap_thres = retention.gap_thres_for(arrays[0], gap_thres(arrays[0]), compacted_until)
+    timestamps, values = process_results(arrays[0], arrays[1], gap_thres, gap_fill_fix, prev_timestamp)
+    t1 = time.perf_counter()
+    processing_seconds.observe(t1 - t0)
+    log.debug(f"  processing time: {(t1 - t0)*1000:.2f} ms")
+
+    return { 'timestamps': timestamps, 'values': values }
+
+# Recent data comes from the in-memory buffers (see hot.py), only the part before them from the database
+async def channel_range(cur, channels, name, start, end):
+    split = hot.hot_data.covered_from(name)
+    if split is None or end < split:
+        return await query_channel_range(cur, channels[name], start, end)
+
+    recent = hot.hot_data.range(name, max(start, split), end)
+    if start >= split:
+        return recent
+
+    old = await query_channel_range(cur, channels[name], start, split - 1)
+    return np.concatenate((old[0], recent[0])), np.concatenate((old[1], recent[1]))
+
+async def channel_buckets(cur, channels, name, start, end, interval):
+    split = hot.hot_data.covered_from(name)
+    if split is not None:
+        split = -(-split // interval) * interval # first whole bucket in memory
+    if split is None or end < split:
+        channel_sampling = (await get_channel_sampling(cur, channels))[name]
+        return await query_channel_buckets(cur, channels[name], start, end, interval, channel_sampling)
+
+    recent = hot.hot_data.buckets(name, max(start, split), end, interval)
+    if start >= split:
+        return recent
+
+    channel_sampling = (await get_channel_sampling(cur, channels))[name]
+    return await query_channel_buckets(cur, channels[name], start, split - 1, interval, channel_sampling) + recent
+
+# Each channel is fetched on its own pooled connection, so with asyncio.gather a request takes as long as the slowest channel
+# instead of the sum of all of them (the cursors are lazy, channels served from memory don't take a connection at all)
+async def fetch_channel_range(channels, name, start, end):
+    async with db.LazyCursor(pool) as cur:
+        return await channel_range(cur, channels, name, start, end)
+
+async def fetch_channel_buckets(channels, name, start, end, interval):
+    async with db.LazyCursor(pool) as cur:
+        return await channel_buckets(cur, channels, name, start, end, interval)
+
+# channel name -> (period, max_interval) or None, how the channel is sampled (see sampling.py)
+# and channel name -> max_interval_from, from when on max_interval holds
+# changes when measure.py restarts with another config, which also reconnects the live stream (see clear_cache)
+channel_sampling = None
+max_interval_from = None
+
+async def get_channel_sampling(cur, channels):
+    global channel_sampling, max_interval_from
+    if channel_sampling is None:
+        try:
+            await cur.execute("SELECT channel_id, period, max_interval, max_interval_from FROM channel_sampling")
+            rows = await cur.fetchall()
+        except Exception:
+            rows = [] # measure.py didn't store it yet
+        by_id = { channel_id: (period, max_interval) for channel_id, period, max_interval, since in rows }
+        from_by_id = { channel_id: since for channel_id, period, max_interval, since in rows }
+        max_interval_from = { name: from_by_id.get(channel_id) for name, channel_id in channels.items() }
+        channel_sampling = { name: by_id.get(channel_id) for name, channel_id in channels.items() }
+    return channel_sampling
+
+# gap threshold of each row of a channel (timestamps), see sampling.gap_thres_for, after get_channel_sampling
+def gap_thres_of(name, timestamps):
+    return sampling.gap_thres_for(timestamps, channel_sampling[name], max_interval_from[name])
+
+# channel name -> function(timestamps) -> gap threshold (one or one per row), bigger for polled channels whose rows can be further apart
+async def get_gap_thres(cur, channels):
+    await get_channel_sampling(cur, channels)
+    return { name: functools.partial(gap_thres_of, name) for name in channels }
+
+# gap threshold of new rows of the series the frontend appends live points to (see appendLive in api.ts), after get_channel_sampling
+def live_gap_thres():
+    return { series: sampling.gap_thres(channel_sampling[name]) for series, name in (('solar', 'solar_power'), ('meter_power', 'meter_power')) }
+
+async def fetch_compacted(start):
+    async with db.LazyCursor(pool) as cur:
+        return await get_compacted(cur, start)
+
+# The cursor for incremental updates is the timestamp of the last row sent for solar, meter_power, meter_reading and load/savings
+def make_cursor(solar_last, meter_last, reading_last, load_last):
+    return f"{solar_last},{meter_last},{reading_last},{load_last}"
+
+# cursors from before load/savings were stored channels have no last load/savings, they are sent again from the older of solar and meter on
+def parse_cursor(cursor):
+    try:
+        parts = [int(x) for x in cursor.split(',')]
+        if len(parts) == 3:
+            parts.append(min(parts[0], parts[1]) - derived.LOAD_INTERVAL)
+        solar_last, meter_last, reading_last, load_last = parts
+        return solar_last, meter_last, reading_last, load_last
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid cursor")
+
+# last timestamp of a series fetched for /data, raw (timestamps, values) arrays or bucket rows
+def last_timestamp(data, interval, default):
+    if interval is None:
+        return int(data[0][-1]) if len(data[0]) else default
+    return data[-1][5] if data else default
+
+# Only rows newer than the cursor, so the cost of a poll depends on the amount of new data instead of the viewed range
+# load and savings replace the existing tail of those series in the frontend from their first timestamp on
+# (a row of one of them can be sent twice, the cursor has the older of their last rows)
+# with the interval of downsampled data the power series are buckets from the one with the last row on,
+# which replace the frontend's tail the same way, so the series keeps one resolution
+# gap_thres_power: channel name -> function(timestamps) -> gap threshold (see get_gap_thres)
+# cursor: parsed with parse_cursor
+async def get_data_since(channels, cursor, gap_thres_power, gap_thres_by_minute, interval=None):
+    solar_last, meter_last, reading_last, load_last = cursor
+    end = ts.get_volkzaehler_timestamp() + 60*1000
+
+    async def power_channel(name, last, gap_fill_fix):
+        if interval is None:
+            data = await fetch_channel_range(channels, name, last + 1, end)
+            return data, to_series(data, gap_thres_power[name], gap_fill_fix, prev_timestamp=last)
+
+        rows = await fetch_channel_buckets(channels, name, last // interval * interval, end, interval)
+        return rows, process_buckets(rows, interval, gap_thres_power[name], gap_fill_fix)
+
+    (new_solar, solar), (new_meter, meter_power), (new_load, load), (new_savings, savings), (reading_timestamps, reading_values) = await asyncio.gather(
+        power_channel('solar_power', solar_last, True),
+        power_channel('meter_power', meter_last, False),
+        power_channel('load', load_last, False),
+        power_channel('savings', load_last, False),
+        fetch_channel_range(channels, 'meter_reading', reading_last + 1, end))
+
+    latest_reading = {
+        'timestamp': int(reading_timestamps[-1]),
+        'value': float(reading_values[-1])
+    } if len(reading_timestamps) else None
+
+    last = {
+        'solar': last_timestamp(new_solar, interval, solar_last),
+        'meter_power': last_timestamp(new_meter, interval, meter_last),
+        'load': last_timestamp(new_load, interval, load_last),
+        'savings': last_timestamp(new_savings, interval, load_last),
+    }
+    return {
+        'solar': solar,
+        'meter_power': meter_power,
+        'load': load,
+        'savings': savings,
+        'latest_meter_energy': latest_reading,
+        'interval': interval,
+        'gap_thres': live_gap_thres(),
+        'last': last,
+        'cursor': make_cursor(last['solar'], last['meter_power'], last_timestamp((reading_timestamps, reading_values), None, reading_last),
+                              min(last['load'], last['savings']))
+    }
+
+# binary response if asked for with format=bin or an Accept header, see columnar.py
+def wants_binary(request, format):
+    return format == 'bin' or (format is None and columnar.MEDIA_TYPE in request.headers.get('accept', ''))
+
+# the body is encoded while it is sent, a chunk at a time, instead of building the whole json/binary response in memory first
+def encode_response(res, binary, response):
+    chunks = columnar.encode_chunks(res) if binary else columnar.encode_json_chunks(res)
+    return StreamingResponse(counted(metrics.timed_iter(chunks, encode_seconds)),
+        media_type=columnar.MEDIA_TYPE if binary else 'application/json', headers=response.headers)
+
+def counted(chunks):
+    for chunk in chunks:
+        response_bytes.inc(len(chunk))
+        yield chunk
+
+# Responses for ranges that are fully in the past only change when rows are written late, which changes the cache generation
+# (see cache.py), so browsers can keep them and revalidate them with the ETag
+def etag_for(start, end, points, binary):
+    if not cache.chunks.is_settled(end): return None
+    return f'"{cache.chunks.generation}-{start}-{end}-{points}-{"bin" if binary else "json"}"'
+
+# history older than this is compacted by retention.py (once its hourly run got to it) and left alone by the load/savings repairs
+# (see derived.py), so responses for ranges that end before it can be kept without asking again
+IMMUTABLE_AFTER = max(retention.RETENTION.values())*24*60*60*1000 + retention.CHUNK + retention.RUN_INTERVAL*1000 + derived.REPAIR_DELAY
+
+def cache_control_for(end):
+    if end < ts.get_volkzaehler_timestamp() - IMMUTABLE_AFTER:
+        return 'public, max-age=31536000, immutable'
+    return 'no-cache'
 
 @app.get("/data")
 async def get_data(
-            start: int | None = None,
-            end:   int | None = None
+            request: Request,
+            response: Response,
+            start:  int | None = None,
+            end:    int | None = None,
+            points: int | None = None, # max number of points per series, usually the width of the graph in pixels
+            since:  str | None = None, # cursor of a previous response, only return what is new since then
+            interval: int | None = None, # with since: interval of the previous response, new data comes as buckets of the same size
+            format: str | None = None  # json or bin
         ):
+    if interval is not None and (since is None or interval not in RESOLUTIONS):
+        raise HTTPException(status_code=400, detail=f"interval only works with since and has to be one of {RESOLUTIONS}")
+    cursor = parse_cursor(since) if since is not None else None
+
     try:
         t0 = time.perf_counter()
+        data_requests.inc()
 
         if start == None: start = ts.local_time_to_timestamp(datetime.now() - timedelta(days=1))
         if end   == None: end   = ts.local_time_to_timestamp(datetime.now() + timedelta(days=9999))
 
-        # assume missing data if 3 times more elapsed time than supposed sample rate
-        gap_thres_power = 1000 *3
         gap_thres_by_minute = 1000*60 *3
         
-        with db.get_cursor(read_timeout=5000) as cur:
-            power_id, power_by_minute_id, meter_power_id, meter_reading_id = db.get_channels(cur)
-
-            solar_data = query_channel_range(cur, power_id, start, end, gap_thres_power, gap_fill_fix=True)
-            #solar_by_minute_data = query_channel_range(cur, power_by_minute_id, start, end, gap_thres_by_minute, gap_fill_fix=True)
-            meter_power = query_channel_range(cur, meter_power_id, start, end, gap_thres_power)
-            meter_reading = query_channel_range(cur, meter_reading_id, start, end, gap_thres_by_minute)
-
-        filtered = filter_and_sum_meter_and_solar(meter_power, solar_data, start, end)
+        if since is None:
+            interval = pick_interval(start, end, points)
+        binary = wants_binary(request, format)
+
+        etag = etag_for(start, end, points, binary) if since is None else None
+        if etag is not None:
+            response.headers['ETag'] = etag
+            response.headers['Cache-Control'] = cache_control_for(end)
+            response.headers['Vary'] = 'Accept'
+            if request.headers.get('if-none-match') == etag:
+                data_not_modified.inc()
+                return Response(status_code=304, headers=response.headers)
+
+        async with db.LazyCursor(pool) as cur:
+            channels = await db.get_channel_ids(cur)
+            gap_thres_power = await get_gap_thres(cur, channels)
+
+        if since is not None:
+            res = await get_data_since(channels, cursor, gap_thres_power, gap_thres_by_minute, interval)
+
+            t1 = time.perf_counter()
+            data_seconds.observe(t1 - t0)
+            log.debug(f"total time (since): {(t1 - t0)*1000:.2f} ms")
+            return encode_response(res, binary, response)
+
+        compacted_task = asyncio.create_task(fetch_compacted(start))
+
+        # processing of a channel starts as soon as its data arrived, while the others are still being fetched
+        async def power_channel(name, gap_fill_fix):
+            if interval is None:
+                data = await fetch_channel_range(channels, name, start, end)
+                compacted_until = (await compacted_task).get(channels[name])
+                return data, to_series(data, gap_thres_power[name], gap_fill_fix=gap_fill_fix, compacted_until=compacted_until)
+
+            rows = await fetch_channel_buckets(channels, name, start, end, interval)
+            compacted_until = (await compacted_task).get(channels[name])
+            with processing_seconds.time():
+                return rows, process_buckets(rows, interval, gap_thres_power[name], gap_fill_fix=gap_fill_fix, compacted_until=compacted_until)
+
+        #solar_by_minute = await query_channel_range(cur, channels['solar_power_by_minute'], start, end)
+        (solar, solar_data), (meter, meter_power), (load, load_data), (savings, savings_data), (reading_timestamps, reading_values), compacted_until = await asyncio.gather(
+            power_channel('solar_power', True),
+            power_channel('meter_power', False),
+            power_channel('load', False),
+            power_channel('savings', False),
+            fetch_channel_range(channels, 'meter_reading', start, end),
+            compacted_task)
+        #solar_by_minute_data = to_series(solar_by_minute, gap_thres_by_minute, gap_fill_fix=True)
+
+        last = {
+            'solar': last_timestamp(solar, interval, start),
+            'meter_power': last_timestamp(meter, interval, start),
+            'load': last_timestamp(load, interval, start),
+            'savings': last_timestamp(savings, interval, start),
+        }
+        reading_last = int(reading_timestamps[-1]) if len(reading_timestamps) else start
 
         latest_reading = {
-            'timestamp': meter_reading['timestamps'][-1],
-            'value': meter_reading['values'][-1]
-        } if meter_reading['timestamps'] else None
+            'timestamp': int(reading_timestamps[-1]),
+            'value': float(reading_values[-1])
+        } if len(reading_timestamps) else None
 
         res = {
             'solar': solar_data,
             #'solar_by_minute': solar_by_minute_data,
             'meter_power': meter_power,
             #'meter_reading': meter_reading,
-            'load': filtered[0],
-            'savings': filtered[1],
-            'latest_meter_energy': latest_reading
+            'load': load_data,
+            'savings': savings_data,
+            'latest_meter_energy': latest_reading,
+            'interval': interval, # bucket size in ms, None for raw data
+            'gap_thres': live_gap_thres(), # ms, for live points appended to solar and meter_power
+            'last': last, # timestamp of the last row of each power series, with buckets not the same as the last timestamp in the series
+            'cursor': make_cursor(last['solar'], last['meter_power'], reading_last, min(last['load'], last['savings']))
         }
 
         t1 = time.perf_counter()
-        print(f"total time: {(t1 - t0)*1000:.2f} ms")
+        data_seconds.observe(t1 - t0)
+        log.debug(f"total time: {(t1 - t0)*1000:.2f} ms")
 
-        return res
+        return encode_response(res, binary, response)
     except Exception as ex:
         print(f"Error querying data: {traceback.format_exc()}")
         raise HTTPException(status_code=404, detail=f"Error querying data")
-  
+
+# Any channels aligned onto one grid, the time weighted average of each per bucket (see resample.py), eg.
+# curl "http://pi:8000/resample?channels=solar_power,meter_power&start=1751320800000&end=1751407200000&interval=60000"
+# buckets of interval ms are aligned to multiples of it (utc), interval defaults to the bucket size for points like /data
+# time no sample covers is left out of the averages, buckets without any data are null
+# long buckets are computed from the rollups (at least RESAMPLE_ROWS rows per bucket), short ones from the raw rows
+# (a rollup row is spread evenly over its time, which is only close enough to the raw rows if a bucket has many)
+RESAMPLE_MIN_INTERVAL = 1000
+RESAMPLE_MAX_BUCKETS = 100000
+RESAMPLE_ROWS = 10
+
+def resample_rollup(interval):
+    best = None
+    for res, table in rollups.ROLLUPS:
+        if res * RESAMPLE_ROWS <= interval and interval % res == 0:
+            best = res
+    return best
+
+# rollup rows (see query_bucket_rows) as samples at their last timestamp, like the raw rows they average
+# a row is the time since the previous row, which can be up to res further back than between raw rows
+# gap_thres: function(timestamps) (see get_gap_thres)
+def bucket_rows_channel(rows, res, gap_thres, compacted_until):
+    timestamps = np.array([row[5] for row in rows], dtype=np.int64)
+    values = np.array([row[1] for row in rows], dtype=np.float64)
+    gap_thres = retention.gap_thres_for(timestamps, gap_thres(timestamps), compacted_until) + res
+    return resample.Channel(timestamps, values, sample_rate=res, gap_thres=gap_thres, gaps=resample.GAP_MISSING, fill=None)
+
+@app.get("/resample")
+async def get_resample(
+            request: Request,
+            response: Response,
+            channels: str,  # comma separated channel names
+            start:    int,
+            end:      int,
+            interval: int | None = None, # bucket size in ms
+            points:   int | None = None, # number of buckets, if no interval is given
+            format:   str | None = None  # json or bin
+        ):
+    if end <= start:
+        raise HTTPException(status_code=400, detail="start must be before end")
+    if interval is None:
+        interval = pick_interval(start, end, points) or RESAMPLE_MIN_INTERVAL
+    if interval < RESAMPLE_MIN_INTERVAL:
+        raise HTTPException(status_code=400, detail=f"interval must be at least {RESAMPLE_MIN_INTERVAL} ms")
+    if (end - start) // interval > RESAMPLE_MAX_BUCKETS:
+        raise HTTPException(status_code=400, detail=f"range must have between 1 and {RESAMPLE_MAX_BUCKETS} buckets")
+
+    try:
+        async with db.LazyCursor(pool) as cur:
+            channel_ids = await db.get_channel_ids(cur)
+            channel_sampling = await get_channel_sampling(cur, channel_ids)
+            gap_thres_by_name = await get_gap_thres(cur, channel_ids)
+    except Exception as ex:
+        print(f"Error querying channels: {traceback.format_exc()}")
+        raise HTTPException(status_code=404, detail=f"Error querying channels")
+
+    names = channels.split(',')
+    unknown = [name for name in names if name not in channel_ids]
+    if unknown:
+        raise HTTPException(status_code=404, detail=f"Unknown channel {', '.join(unknown)}")
+
+    try:
+        t0 = time.perf_counter()
+        start = start // interval * interval
+        rollup_res = resample_rollup(interval)
+        compacted_until_by_id = await fetch_compacted(start)
+
+        # samples just outside the range still reach into its first and last bucket
+        async def fetch(name):
+            compacted_until = compacted_until_by_id.get(channel_ids[name])
+            if rollup_res is not None:
+                rows = await fetch_channel_buckets(channel_ids, name, start - rollup_res, end + rollup_res, rollup_res)
+                return bucket_rows_channel(rows, rollup_res, gap_thres_by_name[name], compacted_until)
+
+            reach = sampling.gap_thres(channel_sampling[name])
+            arrays = await fetch_channel_range(channel_ids, name, start - reach, end + reach)
+            return resample.Channel(*arrays, sample_rate=sampling.sample_rate(channel_sampling[name]),
+                                    gap_thres=retention.gap_thres_for(arrays[0], gap_thres_by_name[name](arrays[0]), compacted_until),
+                                    gaps=resample.GAP_MISSING, fill=None)
+
+        inputs = dict(zip(names, await asyncio.gather(*(fetch(name) for name in names))))
+
+        with processing_seconds.time():
+            averages = resample.resample(inputs, start, end, interval)
+        timestamps = start + np.arange(len(next(iter(averages.values()))), dtype=np.int64)*interval + interval//2
+
+        t1 = time.perf_counter()
+        log.debug(f"resample time: {(t1 - t0)*1000:.2f} ms ({len(timestamps)} buckets of {interval} ms from {'rollups' if rollup_res else 'raw rows'})")
+    except Exception as ex:
+        print(f"Error resampling: {traceback.format_exc()}")
+        raise HTTPException(status_code=404, detail=f"Error resampling")
+
+    res = { name: { 'timestamps': timestamps, 'values': values } for name, values in averages.items() }
+    res['interval'] = interval
+    return encode_response(res, wants_binary(request, format), response)
+
+# Daily energy totals for /stats (see energy.py), complete days are only computed once
+ENERGY_UPDATE_INTERVAL = 5*60 # seconds, how often today is recomputed
+energy_dirty_from = None # days from here on are recomputed, set when rows are written late
+
+async def compute_day_energy(cur, channels, day):
+    start, end = energy.day_range(day)
+
+    # samples just outside the day still contribute to its first and last interval
+    solar = await channel_range(cur, channels, 'solar_power', start - derived.LOAD_INTERVAL, end + derived.LOAD_INTERVAL)
+    meter = await channel_range(cur, channels, 'meter_power', start - derived.LOAD_INTERVAL, end + derived.LOAD_INTERVAL)
+
+    compacted_until = await get_compacted(cur, start)
+    channel_sampling = await get_channel_sampling(cur, channels)
+    inputs = {
+        'meter': derived.meter_channel(meter, channel_sampling['meter_power']),
+        'solar': derived.solar_channel(solar, channel_sampling['solar_power'], compacted_until.get(channels['solar_power']), max_interval_from['solar_power']),
+    }
+
+    # the whole day as one bucket, import/export, load and savings are computed per load interval
+    averages = resample.resample(inputs, start, end, end - start, base=derived.LOAD_INTERVAL, expressions=energy.EXPRESSIONS)
+    return energy.day_energy(averages, end - start)
+
+async def update_energy(cur):
+    global energy_dirty_from
+    dirty = energy_dirty_from
+    energy_dirty_from = None
+
+    try:
+        await energy.create_tables(cur)
+        channels = await db.get_channel_ids(cur)
+        stored = await energy.get_stored_days(cur)
+
+        await cur.execute("SELECT min(timestamp) FROM data WHERE channel_id in (%s, %s)", (channels['solar_power'], channels['meter_power']))
+        first = (await cur.fetchone())[0]
+        if first is None: return 0
+
+        now = ts.get_volkzaehler_timestamp()
+        updated = 0
+        for day in energy.days(ts.time_from_timestamp(first).date(), date.today()):
+            day_start, day_end = energy.day_range(day)
+            if stored.get(day) and (dirty is None or day_end <= dirty): continue
+
+            await energy.store_day(cur, day, await compute_day_energy(cur, channels, day), complete=day_end + cache.SETTLE < now)
+            updated += 1
+        return updated
+    except Exception:
+        if dirty is not None:
+            energy_dirty_from = dirty if energy_dirty_from is None else min(dirty, energy_dirty_from)
+        raise
+
+async def energy_loop():
+    while True:
+        try:
+            t0 = time.perf_counter()
+            async with db.LazyCursor(pool) as cur:
+                updated = await update_energy(cur)
+            t1 = time.perf_counter()
+            energy_update_seconds.observe(t1 - t0)
+            log.debug(f"Energy: updated {updated} days in {(t1 - t0)*1000:.2f} ms")
+        except Exception:
+            print(f"Error updating energy: {traceback.format_exc()}")
+
+        await asyncio.sleep(ENERGY_UPDATE_INTERVAL)
+
+@app.get("/stats")
+async def get_stats(
+            period: str = 'day',       # day, week, month or year
+            start:  date | None = None, # first local day, default depends on period
+            end:    date | None = None  # last local day, default today
+        ):
+    if period not in energy.PERIODS:
+        raise HTTPException(status_code=400, detail=f"period must be one of {', '.join(energy.PERIODS)}")
+
+    try:
+        t0 = time.perf_counter()
+
+        if end is None: end = date.today()
+        if start is None: start = energy.default_start(end, period)
+
+        async with db.LazyCursor(pool) as cur:
+            res = await energy.get_stats(cur, period, energy.period_start(start, period), end)
+
+        t1 = time.perf_counter()
+        stats_seconds.observe(t1 - t0)
+        log.debug(f"stats time: {(t1 - t0)*1000:.2f} ms")
+
+        return res
+    except Exception as ex:
+        print(f"Error querying stats: {traceback.format_exc()}")
+        raise HTTPException(status_code=404, detail=f"Error querying stats")
+
+# One month of a channel as an archive file (see archive.py), for backups from another machine:
+# curl -o solar_power/2025-07.sma "http://pi:8000/archive?channel=solar_power&month=2025-07"
+@app.get("/archive")
+async def get_archive(
+            channel: str,
+            month:   str  # YYYY-MM (utc)
+        ):
+    try:
+        start, end = archive.month_range(month)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="month must be YYYY-MM")
+
+    async with db.LazyCursor(pool) as cur:
+        await cur.execute("SELECT channel_id, type, unit FROM channels WHERE name = %s", (channel,))
+        row = await cur.fetchone()
+        if row is None:
+            raise HTTPException(status_code=404, detail=f"Unknown channel {channel}")
+        channel_id, type, unit = row
+        compacted = await get_compacted(cur, 0)
+    header = archive.make_header(channel, type, unit, start, end, compacted.get(channel_id))
+
+    # the rows are read and encoded a block at a time while the response is sent
+    async def stream():
+        async with db.LazyCursor(pool) as cur:
+            async for piece in archive.stream_month(cur, channel_id, header):
+                yield piece
+
+    return StreamingResponse(stream(), media_type=columnar.MEDIA_TYPE,
+        headers={ 'Content-Disposition': f'attachment; filename="{channel}_{month}{archive.EXTENSION}"' })
+
+# prometheus text format, see metrics.py
+@app.get("/metrics")
+async def get_metrics():
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+# Live stream of new measurements and load/savings intervals as server sent events, relayed from measure.py (see live.py)
+# one queue per connected client
+live_clients = set()
+
+# invalidate messages may have been missed while not connected
+async def clear_cache():
+    global compacted, channel_sampling
+    cache.chunks.invalidate_from(0)
+    compacted = None
+    channel_sampling = None
+    db.channel_ids = None # measure.py may have created channels
+
+def relay_live(msg):
+    global compacted, energy_dirty_from
+    if msg['series'] == 'invalidate':
+        # rows older than t were written late or compacted (see retention.py), cached history and energy may be outdated
+        cache.chunks.invalidate_from(msg['t'])
+        compacted = None
+        energy_dirty_from = msg['t'] if energy_dirty_from is None else min(energy_dirty_from, msg['t'])
+        return
+
+    event = f"data: {json.dumps(msg)}\n\n"
+    for q in live_clients:
+        try:
+            q.put_nowait(event)
+        except asyncio.QueueFull:
+            pass
+
+@app.get("/live")
+async def get_live():
+    q = asyncio.Queue(1000)
+
+    async def stream():
+        live_clients.add(q)
+        try:
+            while True:
+                try:
+                    yield await asyncio.wait_for(q.get(), 15)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+        finally:
+            live_clients.discard(q)
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={ 'Cache-Control': 'no-cache' })
+
 #if __name__ == "__main__":
 #    import asyncio
 #    asyncio.run(get_data())
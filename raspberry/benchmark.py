@@ -0,0 +1,437 @@
+import asyncio
+import contextlib
+import io
+import json
+import logging
+import os
+import platform
+import re
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+import numpy as np
+from fastapi import Response
+from starlette.requests import Request
+import backend
+import cache
+import database as db
+import derived
+import partitions
+import retention
+import rollups
+import sampling
+import synthetic
+
+# Repeatable performance numbers instead of the perf_counter prints: generates synthetic data (see synthetic.py),
+# loads it into a database and times /data, /resample, the processing functions and the writer
+# the database is a sqlite file by default, which runs the same queries (see SqliteConn), so it works on any machine
+# but only the numbers of the same machine and database are comparable, save a baseline before a change and compare after
+#
+# python benchmark.py [--days 31] [--repeat 5] [--mysql DBNAME] [--save FILE] [--compare FILE]
+#   --mysql DBNAME  use a separate mysql database with the credentials of database.env, its tables are dropped and recreated
+#   --save FILE     store the results as json
+#   --compare FILE  compare with saved results, exits with 1 if anything got more than REGRESSION slower
+# compared are the fastest runs, the median is noisier
+REGRESSION = 1.2
+
+WRITE_ROWS = 20000 # measurements pushed through the writer
+
+CHANNELS = { 'solar_power': 1, 'solar_power_by_minute': 2, 'meter_power': 3, 'meter_reading': 4, 'load': 5, 'savings': 6 }
+
+SCHEMA = [
+    """CREATE TABLE channels (
+        channel_id INT(3) PRIMARY KEY NOT NULL,
+        name VARCHAR(255) NOT NULL UNIQUE,
+        type VARCHAR(20) NOT NULL,
+        unit VARCHAR(20) NOT NULL
+    )""",
+    f"CREATE TABLE data ({partitions.DATA_COLUMNS})",
+]
+TABLES = ['channels', 'data', 'retention', 'channel_sampling', 'rollup_coverage', *(table for res, table in rollups.ROLLUPS)]
+
+# The mysql specific bits of the queries the backend, writer and rollups use, translated for sqlite
+TRANSLATE = [
+    (re.compile(r'%s'), '?'),
+    (re.compile(r'\bdiv\b', re.I), '/'), # integer division for integer columns in sqlite
+    (re.compile(r'\bINSERT IGNORE\b', re.I), 'INSERT OR IGNORE'),
+    (re.compile(r'\bON DUPLICATE KEY UPDATE\b', re.I), 'ON CONFLICT DO UPDATE SET'),
+    (re.compile(r'\bVALUES\((\w+)\)', re.I), r'excluded.\1'),
+    (re.compile(r'\bLEAST\(', re.I), 'min('),
+    (re.compile(r'\bGREATEST\(', re.I), 'max('),
+    (re.compile(r'\bFROM DUAL\b', re.I), ''),
+]
+
+def translate(query):
+    for pattern, replacement in TRANSLATE:
+        query = pattern.sub(replacement, query)
+    return query
+
+def sqlite_args(args):
+    if args is None: return ()
+    return tuple(int(a) if isinstance(a, np.integer) else float(a) if isinstance(a, np.floating) else a for a in args)
+
+class SqliteCursor:
+    def __init__(self, conn):
+        self.cur = conn.cursor()
+
+    @property
+    def rowcount(self):
+        return self.cur.rowcount
+
+    def execute(self, query, args=None):
+        self.cur.execute(translate(query), sqlite_args(args))
+
+    def executemany(self, query, rows):
+        self.cur.executemany(translate(query), [sqlite_args(row) for row in rows])
+
+    def fetchall(self):
+        return self.cur.fetchall()
+
+    def fetchone(self):
+        return self.cur.fetchone()
+
+    def fetchmany(self, size):
+        return self.cur.fetchmany(size)
+
+    def close(self):
+        self.cur.close()
+
+# same for the aiomysql connections of the backend pool and the writer, usable with await and async with like aiomysql cursors
+class AsyncSqliteCursor(SqliteCursor):
+    async def execute(self, query, args=None):
+        SqliteCursor.execute(self, query, args)
+
+    async def executemany(self, query, rows):
+        SqliteCursor.executemany(self, query, rows)
+
+    async def fetchall(self):
+        return SqliteCursor.fetchall(self)
+
+    async def fetchone(self):
+        return SqliteCursor.fetchone(self)
+
+    async def fetchmany(self, size):
+        return SqliteCursor.fetchmany(self, size)
+
+    async def close(self):
+        SqliteCursor.close(self)
+
+    def __await__(self):
+        yield from []
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        SqliteCursor.close(self)
+
+# mysql.connector like connection (rollups.backfill), AsyncSqliteConn is the aiomysql like one (backend pool, writer)
+class SqliteConn:
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+
+    def cursor(self, *args, **kwargs):
+        return SqliteCursor(self.conn)
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def close(self):
+        self.conn.close()
+
+class AsyncSqliteConn(SqliteConn):
+    def cursor(self, cursor_class=None):
+        return AsyncSqliteCursor(self.conn)
+
+    async def commit(self):
+        self.conn.commit()
+
+# the backend pool, a new connection per acquire like a pool with idle connections
+class SqlitePool:
+    def __init__(self, path):
+        self.path = path
+
+    async def acquire(self):
+        return AsyncSqliteConn(self.path)
+
+    def release(self, conn):
+        conn.close()
+
+    def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
+
+def create_schema(conn, sqlite):
+    cur = conn.cursor()
+    for table in TABLES:
+        cur.execute(f"DROP TABLE IF EXISTS {table}")
+    for sql in SCHEMA:
+        cur.execute(sql + (" WITHOUT ROWID" if sqlite and "CREATE TABLE data" in sql else "")) # clustered on the primary key like innodb
+    rollups.create_tables(cur)
+    retention.create_tables(cur)
+    sampling.create_tables(cur)
+
+    for name, channel_id in CHANNELS.items():
+        cur.execute("INSERT INTO channels (channel_id, name, type, unit) VALUES (%s, %s, %s, %s)",
+                    (channel_id, name, 'energy' if name == 'meter_reading' else 'power', 'kWh' if name == 'meter_reading' else 'W'))
+    # like measure.py
+    sampling.set_sampling(cur, CHANNELS['meter_power'], *db.VZ_METER_SAMPLING)
+    for name, type, unit in derived.CHANNELS:
+        sampling.set_sampling(cur, CHANNELS[name], *derived.SAMPLING)
+    conn.commit()
+    cur.close()
+
+def load_data(conn, data, chunk=50000):
+    cur = conn.cursor()
+    for name, (timestamps, values) in data.items():
+        channel_id = CHANNELS[name]
+        for i in range(0, len(timestamps), chunk):
+            rows = list(zip([channel_id] * len(timestamps[i:i + chunk]), timestamps[i:i + chunk].tolist(), values[i:i + chunk].tolist()))
+            cur.executemany("INSERT INTO data (channel_id, timestamp, value) VALUES (%s, %s, %s)", rows)
+            conn.commit()
+
+        # the rollups are complete from where the writer started, which the backfill moves back to the first row
+        cur.execute("INSERT INTO rollup_coverage (channel_id, covered_from) VALUES (%s, %s)", (channel_id, int(timestamps[-1])))
+        rollups.backfill(conn, channel_id, int(timestamps[0]), int(timestamps[-1]) + 1)
+    cur.close()
+
+def time_it(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    return times
+
+async def time_it_async(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        await fn()
+        times.append(time.perf_counter() - t0)
+    return times
+
+def request():
+    return Request({ 'type': 'http', 'method': 'GET', 'path': '/data', 'query_string': b'', 'headers': [] })
+
+# /data like the dashboard requests it, the whole body is read so encoding is included
+async def get_data(start, end, points, format):
+    with contextlib.redirect_stdout(io.StringIO()): # the per request prints
+        res = await backend.get_data(request(), Response(), start=start, end=end, points=points, format=format)
+        size = 0
+        async for chunk in res.body_iterator:
+            size += len(chunk)
+    return size
+
+def clear_caches():
+    cache.chunks.entries.clear()
+    cache.chunks.size = 0
+    backend.compacted = None
+
+async def bench_data(results, end, repeat):
+    cases = [
+        ('data day raw json', 1, None, 'json', False),
+        ('data day raw bin', 1, None, 'bin', False),
+        ('data day', 1, 1500, 'bin', False),
+        ('data week', 7, 1500, 'bin', False),
+        ('data month', 30, 1500, 'bin', False),
+        ('data month cached', 30, 1500, 'bin', True),
+    ]
+    for name, days, points, format, cached in cases:
+        start = end - days*synthetic.DAY
+
+        async def run():
+            if not cached: clear_caches()
+            return await get_data(start, end, points, format)
+
+        clear_caches()
+        size = await run() # warm up
+        results[name] = { 'times': await time_it_async(run, repeat), 'bytes': size }
+
+# /resample of meter and solar, from raw rows for short buckets, from the rollups for long ones
+async def bench_resample(results, end, repeat):
+    cases = [
+        ('resample day 1 s', 1, 1000),
+        ('resample week 1 min', 7, 60*1000),
+        ('resample month 1 h', 30, 60*60*1000),
+        ('resample month 1 day', 30, synthetic.DAY),
+    ]
+    for name, days, interval in cases:
+        start = end - days*synthetic.DAY
+
+        async def run():
+            clear_caches()
+            with contextlib.redirect_stdout(io.StringIO()):
+                res = await backend.get_resample(request(), Response(), channels='meter_power,solar_power', start=start, end=end, interval=interval, format='bin')
+                size = 0
+                async for chunk in res.body_iterator:
+                    size += len(chunk)
+            return size
+
+        size = await run() # warm up
+        results[name] = { 'times': await time_it_async(run, repeat), 'bytes': size }
+
+def bench_processing(results, data, end, repeat):
+    solar = data['solar_power']
+    meter = data['meter_power']
+
+    def last_days(arrays, days):
+        timestamps, values = arrays
+        keep = timestamps >= end - days*synthetic.DAY
+        return timestamps[keep], values[keep].astype(np.float64)
+
+    week_solar = last_days(solar, 7)
+    week_meter = last_days(meter, 7)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        results['process_results week'] = { 'times': time_it(
+            lambda: backend.process_results(*week_solar, backend.GAP_THRES_POWER, True), repeat) }
+        results['load_and_savings week'] = { 'times': time_it(
+            lambda: derived.load_and_savings(derived.meter_channel(week_meter, db.VZ_METER_SAMPLING), derived.solar_channel(week_solar, None),
+                                             end - 7*synthetic.DAY, end), repeat) }
+
+# pushes WRITE_ROWS measurements through database.write_loop, time per 1000 rows until all are committed
+async def bench_writer(results, start, tmp, sqlite_path, repeat):
+    log = logging.getLogger('benchmark')
+    log.setLevel(logging.WARNING)
+    db.SPOOL_PATH = os.path.join(tmp, 'writer.spool') # never touch the spool of measure.py
+
+    if sqlite_path is not None:
+        async def connect(autocommit=False):
+            return AsyncSqliteConn(sqlite_path)
+        db.get_conn_async = connect
+
+    times = []
+    for r in range(repeat):
+        writer = asyncio.create_task(db.write_loop(log))
+        t = start + r*WRITE_ROWS*1000 # new rows, like live measurements
+        t0 = time.perf_counter()
+        for i in range(WRITE_ROWS):
+            db.queue_write(log, db.Measurement(t + i*500, CHANNELS['solar_power' if i % 2 else 'meter_power'], float(i % 1000)))
+        await db.queue.join()
+        times.append((time.perf_counter() - t0) / WRITE_ROWS * 1000)
+
+        writer.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await writer
+
+    results['write_loop per 1000 rows'] = { 'times': times }
+
+def summary(times):
+    return { 'median_ms': statistics.median(times)*1000, 'min_ms': min(times)*1000 }
+
+def print_report(results, baseline=None):
+    regressions = []
+    print()
+    if baseline is None:
+        print(f"{'benchmark':28} {'median ms':>10} {'min ms':>10}")
+    else:
+        print(f"{'benchmark':28} {'median ms':>10} {'min ms':>10} {'baseline':>10} {'change':>8}")
+
+    for name, res in results['benchmarks'].items():
+        if baseline is None or name not in baseline['benchmarks']:
+            print(f"{name:28} {res['median_ms']:10.2f} {res['min_ms']:10.2f}")
+            continue
+
+        base = baseline['benchmarks'][name]['min_ms']
+        ratio = res['min_ms'] / base if base > 0 else 1
+        slower = ratio > REGRESSION
+        if slower: regressions.append(name)
+        print(f"{name:28} {res['median_ms']:10.2f} {res['min_ms']:10.2f} {base:10.2f} {(ratio - 1)*100:+7.1f}%{'  SLOWER' if slower else ''}")
+
+    if baseline is not None and baseline['database'] != results['database']:
+        print(f"\nwarning: baseline was measured on {baseline['database']}, this run on {results['database']}")
+    return regressions
+
+async def run(args, tmp):
+    days = int(args.get('--days', 31))
+    repeat = int(args.get('--repeat', 5))
+    mysql = args.get('--mysql')
+
+    end = (int(time.time()*1000) - 2*synthetic.DAY) // synthetic.DAY * synthetic.DAY # settled, so the chunk cache is used like for history
+    start = end - days*synthetic.DAY
+
+    t0 = time.perf_counter()
+    data = synthetic.generate(start, days)
+    timestamps, load, savings = derived.load_and_savings(derived.meter_channel(data['meter_power'], db.VZ_METER_SAMPLING),
+                                                         derived.solar_channel(data['solar_power'], None), start, end)
+    data['load'] = (timestamps, load)
+    data['savings'] = (timestamps, savings)
+    t1 = time.perf_counter()
+    print(f"Generated {days} days, " + ", ".join(f"{name} {len(t)}" for name, (t, v) in data.items()) + f" rows in {t1 - t0:.1f} s")
+
+    sqlite_path = None
+    if mysql is None:
+        sqlite_path = os.path.join(tmp, 'benchmark.sqlite')
+        conn = SqliteConn(sqlite_path)
+        database = f"sqlite {sqlite3.sqlite_version}"
+    else:
+        config = db.load_config()
+        if mysql == config['DB_NAME']:
+            print("--mysql needs a separate database, its tables are dropped")
+            sys.exit(1)
+        config['DB_NAME'] = mysql
+        conn = db.get_conn()
+        database = f"mysql {conn.get_server_info()}"
+
+    create_schema(conn, sqlite_path is not None)
+    load_data(conn, data)
+    conn.close()
+    t2 = time.perf_counter()
+    print(f"Loaded into {database} in {t2 - t1:.1f} s")
+
+    backend.pool = SqlitePool(sqlite_path) if sqlite_path else await db.create_pool()
+    db.channel_ids = None
+
+    results = {}
+    await bench_data(results, end, repeat)
+    await bench_resample(results, end, repeat)
+    bench_processing(results, data, end, repeat)
+    await bench_writer(results, end, tmp, sqlite_path, repeat)
+
+    backend.pool.close()
+    await backend.pool.wait_closed()
+
+    return {
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'machine': f"{platform.node()} {platform.machine()} python {platform.python_version()}",
+        'database': database,
+        'days': days,
+        'benchmarks': { name: { **summary(res['times']), **{ k: v for k, v in res.items() if k != 'times' } } for name, res in results.items() },
+    }
+
+if __name__ == "__main__":
+    args = {}
+    argv = sys.argv[1:]
+    while argv:
+        if argv[0] not in ('--days', '--repeat', '--mysql', '--save', '--compare') or len(argv) < 2:
+            print("usage: python benchmark.py [--days 31] [--repeat 5] [--mysql DBNAME] [--save FILE] [--compare FILE]")
+            sys.exit(1)
+        args[argv[0]] = argv[1]
+        argv = argv[2:]
+
+    baseline = None
+    if '--compare' in args:
+        with open(args['--compare']) as f:
+            baseline = json.load(f)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        results = asyncio.run(run(args, tmp))
+    regressions = print_report(results, baseline)
+
+    if '--save' in args:
+        with open(args['--save'], 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if regressions:
+        print(f"\n{len(regressions)} benchmarks more than {(REGRESSION - 1)*100:.0f}% slower than the baseline")
+        sys.exit(1)
@@ -0,0 +1,88 @@
+import collections
+import time
+import timestamps as ts
+
+# LRU cache of database query results in aligned chunks of history, so panning back and forth over past days
+# doesn't query the database again. Only chunks that ended more than SETTLE ago are cached, newer data can still change.
+# measure.py announces rows that were written late (spool replay, database outage) over the live stream, see invalidate_from
+CHUNK = 24*60*60*1000 # multiple of every bucket size in backend.RESOLUTIONS, so buckets never straddle chunks
+SETTLE = 10*60*1000
+MAX_BYTES = 64*1024*1024
+
+class ChunkCache:
+    def __init__(self, max_bytes=MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict() # key -> (value, size), least recently used first
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        # changes whenever cached data might have changed, part of the ETag of historical /data responses
+        self.generation = f"{int(time.time())}.0"
+        self.invalidations = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, value, size):
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= old[1]
+
+        self.entries[key] = (value, size)
+        self.size += size
+        while self.size > self.max_bytes and self.entries:
+            _, (_, evicted) = self.entries.popitem(last=False)
+            self.size -= evicted
+
+    # drop every chunk that contains data at or after timestamp
+    def invalidate_from(self, timestamp):
+        for key in [key for key in self.entries if key[-1] + CHUNK > timestamp]:
+            self.size -= self.entries.pop(key)[1]
+
+        self.invalidations += 1
+        self.generation = f"{self.generation.split('.')[0]}.{self.invalidations}"
+
+    # range ends before anything that can still change
+    def is_settled(self, end):
+        return end < ts.get_volkzaehler_timestamp() - SETTLE
+
+    # Result for [start, end] assembled from cached chunks
+    # fetch(start, end) queries the database, consecutive missing chunks are fetched with one call
+    # part(result, start, end) cuts the part for a range out of a result, join(results) concatenates them in order
+    async def get_range(self, key, start, end, fetch, part, join, size):
+        settled = ts.get_volkzaehler_timestamp() - SETTLE
+        parts = []
+        missing = []
+
+        async def fetch_missing():
+            if not missing: return
+            res = await fetch(missing[0], missing[-1] + CHUNK - 1)
+            for chunk in missing:
+                value = part(res, chunk, chunk + CHUNK - 1)
+                self.put((*key, chunk), value, size(value))
+                parts.append(value)
+            missing.clear()
+
+        chunk = start // CHUNK * CHUNK
+        while chunk <= end and chunk + CHUNK <= settled:
+            value = self.get((*key, chunk))
+            if value is None:
+                missing.append(chunk)
+            else:
+                await fetch_missing()
+                parts.append(value)
+            chunk += CHUNK
+        await fetch_missing()
+
+        if chunk <= end: # recent part, not cached
+            parts.append(await fetch(max(chunk, start), end))
+
+        return part(join(parts), start, end)
+
+chunks = ChunkCache()
@@ -0,0 +1,106 @@
+import json
+import struct
+import numpy as np
+
+# Binary version of the /data response, so neither the backend nor the browser has to go through huge json lists
+# layout (little endian):
+#   u32 header length, json header (padded with spaces so the payload starts 8 byte aligned)
+#   per series in header order: f64 timestamps, then one f32 array per field, each series padded to 8 bytes
+# gaps (None in the json response) are NaN, which plotly treats the same as null
+# the header has the non series parts of the response and the layout:
+#   { ..., "series": [{ "name": "solar", "length": 123, "fields": ["values", "min", "max"] }, ...] }
+# aligned so the frontend can wrap the buffer in Float64Array/Float32Array views without copying
+# both this and the json version are encoded in chunks while the response is sent (see encode_chunks, encode_json_chunks)
+MEDIA_TYPE = 'application/octet-stream'
+
+def pad8(n):
+    return -n % 8
+
+# series arrays are converted this many points at a time, output is sent in pieces of about BUFFER_BYTES
+CHUNK_POINTS = 16384
+BUFFER_BYTES = 64*1024
+
+def is_series(value):
+    return isinstance(value, dict) and 'timestamps' in value
+
+# series fields can be lists (None for gaps) or float arrays (NaN for gaps)
+def chunks(values):
+    for i in range(0, len(values), CHUNK_POINTS):
+        yield values[i:i + CHUNK_POINTS]
+
+# joins small pieces so the response isn't sent in tiny writes
+def buffered(pieces):
+    buf = []
+    size = 0
+    for piece in pieces:
+        buf.append(piece)
+        size += len(piece)
+        if size >= BUFFER_BYTES:
+            yield b''.join(buf)
+            buf.clear()
+            size = 0
+    if buf:
+        yield b''.join(buf)
+
+def encode_pieces(res):
+    header = {}
+    series_list = []
+
+    for name, series in res.items():
+        if not is_series(series):
+            header[name] = series
+            continue
+
+        fields = [field for field in series if field != 'timestamps']
+        header.setdefault('series', []).append({ 'name': name, 'length': len(series['timestamps']), 'fields': fields })
+        series_list.append((series, fields))
+
+    header = json.dumps(header).encode()
+    header += b' ' * pad8(4 + len(header))
+    yield struct.pack('<I', len(header))
+    yield header
+
+    for series, fields in series_list:
+        size = 0
+        for field, dtype in [('timestamps', '<f8'), *((field, '<f4') for field in fields)]:
+            for chunk in chunks(series[field]):
+                # None -> NaN
+                arr = np.asarray(chunk, dtype=dtype)
+                size += arr.nbytes
+                yield arr.tobytes()
+        yield b'\0' * pad8(size)
+
+def encode_chunks(res):
+    return buffered(encode_pieces(res))
+
+def encode(res):
+    return b''.join(encode_pieces(res))
+
+# Same response as json, with null for gaps and integer timestamps
+def json_values(chunk, integer):
+    arr = np.asarray(chunk, dtype=np.float64)
+    gaps = np.isnan(arr)
+    values = (np.where(gaps, 0, arr).astype(np.int64) if integer else arr).tolist()
+    for i in np.flatnonzero(gaps):
+        values[i] = None
+    return json.dumps(values)[1:-1]
+
+def encode_json_pieces(res):
+    yield b'{'
+    for i, (name, series) in enumerate(res.items()):
+        prefix = (', ' if i else '') + json.dumps(name) + ': '
+        if not is_series(series):
+            yield (prefix + json.dumps(series)).encode()
+            continue
+
+        yield (prefix + '{').encode()
+        for j, field in enumerate(series):
+            yield ((', ' if j else '') + json.dumps(field) + ': [').encode()
+            for k, chunk in enumerate(chunks(series[field])):
+                yield ((', ' if k else '') + json_values(chunk, field == 'timestamps')).encode()
+            yield b']'
+        yield b'}'
+    yield b'}'
+
+def encode_json_chunks(res):
+    return buffered(encode_json_pieces(res))
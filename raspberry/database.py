@@ -1,17 +1,53 @@
 from contextlib import contextmanager
+from enum import Enum
+import functools
+from typing import NamedTuple
 import asyncio
 import traceback
+import time
 import timestamps as ts
+import rollups
+import partitions
+import metrics
+import sampling
+import spool as spool_file
 import aiomysql
 import mysql.connector
+import pymysql
 
-queue = asyncio.Queue(128)
+# items are single measurements or lists of up to BATCH_MAX_ROWS of them (see queue_write_many)
+# limited by measurements instead of items (queued_rows), so big pushes can't fill the memory
+queue = asyncio.Queue()
+queued_rows = 0
+QUEUE_MAX_ROWS = 50000
 
-async def get_conn_async(autocommit = False):
+# How multiple measurements of the same channel are combined before they are written
+class Combine(Enum):
+    NONE = 0           # store every measurement
+    MAX_PER_MINUTE = 1 # only keep the max value per minute (with its accurate timestamp), for meter readings
+
+# What gets put into the writer queue
+class Measurement(NamedTuple):
+    timestamp: int # volkszaehler timestamp (ms)
+    channel_id: int
+    value: float
+    combine: Combine = Combine.NONE
+    weight: int = 1 # samples the row stands for in the rollups (see sampling.py)
+
+# database.env is only read once
+@functools.cache
+def load_config():
     from dotenv import dotenv_values
     import os
 
-    config = dotenv_values(os.path.abspath("database.env"))
+    return dotenv_values(os.path.abspath("database.env"))
+
+# data table partitioned by month (see partitions.py, not measured yet), only affects newly created tables
+def partitioned():
+    return load_config().get("DB_PARTITIONED", "") in ("1", "true", "yes")
+
+async def get_conn_async(autocommit = False):
+    config = load_config()
 
     return await aiomysql.connect(
         host = config["DB_HOST"],
@@ -22,11 +58,9 @@ async def get_conn_async(autocommit = False):
         connect_timeout = 20,
         autocommit = autocommit
     )
-def get_conn():
-    from dotenv import dotenv_values
-    import os
-
-    config = dotenv_values(os.path.abspath("database.env"))
+# allow_local_infile for LOAD DATA LOCAL INFILE (see archive.py import)
+def get_conn(allow_local_infile = False):
+    config = load_config()
 
     return mysql.connector.connect(
         host = config["DB_HOST"],
@@ -35,45 +69,392 @@ def get_conn():
         password = config["DB_PASSWORD"],
         db = config["DB_NAME"],
         connect_timeout = 20,
+        allow_local_infile = allow_local_infile,
+    )
+
+# Connection pool for the backend, connections are opened lazily (minsize=0) so the backend starts even if the database is down
+# autocommit, so reads always see the latest data instead of an old transaction snapshot
+# a /data request runs up to 6 queries in parallel (its 5 channels and the compacted ranges, see backend.get_data),
+# each on its own connection, so this allows two at once
+async def create_pool(maxsize=12):
+    config = load_config()
+
+    return await aiomysql.create_pool(
+        host = config["DB_HOST"],
+        port = int(config["DB_PORT"]),
+        user = config["DB_USER"],
+        password = config["DB_PASSWORD"],
+        db = config["DB_NAME"],
+        connect_timeout = 20,
+        autocommit = True,
+        minsize = 0,
+        maxsize = maxsize,
+        pool_recycle = 3600, # mysql closes idle connections after a while
     )
 
+STREAM_ROWS = 10000
+
+# Cursor that only takes a connection from the pool once the first query is executed,
+# so requests that can be answered from memory (see hot.py) never touch the database
+class LazyCursor:
+    def __init__(self, pool):
+        self.pool = pool
+        self.conn = None
+        self.cur = None
+
+    async def execute(self, query, args=None):
+        if self.cur is None:
+            self.conn = await self.pool.acquire()
+            self.cur = await self.conn.cursor()
+        return await self.cur.execute(query, args)
+
+    # Rows of a query in lists of up to size rows, through an unbuffered (server side) cursor,
+    # so big results never exist as one list of tuples, the query has to be read to the end before the next one
+    async def stream(self, query, args=None, size=STREAM_ROWS):
+        if self.cur is None:
+            self.conn = await self.pool.acquire()
+            self.cur = await self.conn.cursor()
+
+        cur = await self.conn.cursor(aiomysql.SSCursor)
+        try:
+            await cur.execute(query, args)
+            while True:
+                rows = await cur.fetchmany(size)
+                if not rows: break
+                yield rows
+        finally:
+            await cur.close() # reads whatever is left
+
+    async def fetchall(self):
+        return await self.cur.fetchall()
+
+    async def fetchone(self):
+        return await self.cur.fetchone()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        if self.cur is not None:
+            await self.cur.close()
+            self.pool.release(self.conn)
+
 vz_meter_power_uuid = "37738e30-59ed-11f0-9591-9b7c17f0375b"
 vz_meter_reading_uuid = "23319b90-59ed-11f0-9d8c-a5c24498f2b7"
 
-async def write_loop(log):
+# (period, max_interval) of meter_power, vzlogger pushes a sample about every second (see sampling.py)
+VZ_METER_SAMPLING = (1000, 1000)
+
+# Writer batching: collect everything that is available (up to BATCH_MAX_ROWS) for at most BATCH_MAX_WAIT seconds
+# and write it in one transaction, instead of one autocommitted insert (and fsync) per measurement
+BATCH_MAX_ROWS = 500
+BATCH_MAX_WAIT = 1.0
+
+# measurements that didn't fit into the queue get spooled to disk instead of being dropped, see spool.py
+SPOOL_PATH = 'writer.spool'
+SPOOL_REPLAY_ROWS = 5000
+spool = None
+
+def get_spool():
+    global spool
+    if spool is None:
+        spool = spool_file.Spool(SPOOL_PATH)
+    return spool
+
+writer_spooled = metrics.Counter('solarmon_writer_spooled_total', 'Measurements spooled to disk because the writer queue was full')
+writer_dropped = metrics.Counter('solarmon_writer_dropped_total', 'Measurements that were lost')
+writer_rows = metrics.Counter('solarmon_writer_rows_total', 'Measurements written to the database')
+writer_duplicates = metrics.Counter('solarmon_writer_duplicates_total', 'Measurements that were already in the database (resent pushes, spool replays)')
+writer_rejected = metrics.Counter('solarmon_writer_rejected_total', 'Measurements dropped because the database rejected them (bad value, constraint)')
+writer_batch_rows = metrics.Histogram('solarmon_writer_batch_rows', 'Measurements per write batch', [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000])
+writer_flush_seconds = metrics.Histogram('solarmon_writer_flush_seconds', 'Time to write and commit one batch', metrics.TIME_BUCKETS)
+metrics.Gauge('solarmon_writer_queue', 'Measurements waiting in the writer queue', fn=lambda: queued_rows)
+metrics.Gauge('solarmon_writer_spool_pending', 'Measurements waiting in the spool file', fn=lambda: spool.pending() if spool else 0)
+
+# queue items are single measurements or lists of them (see queue_write_many)
+def add_item(batch, item):
+    global queued_rows
+    if isinstance(item, list):
+        batch.extend(item)
+        queued_rows -= len(item)
+    else:
+        batch.append(item)
+        queued_rows -= 1
+
+# wait up to timeout for the first item, returns (measurements, number of queue items), empty if nothing arrived
+# items are at most BATCH_MAX_ROWS, so a batch is less than twice that
+async def get_batch(timeout):
+    batch = []
+    try:
+        add_item(batch, await asyncio.wait_for(queue.get(), timeout))
+    except asyncio.TimeoutError:
+        return batch, 0
+    items = 1
+
+    deadline = time.monotonic() + BATCH_MAX_WAIT
+    while len(batch) < BATCH_MAX_ROWS:
+        try:
+            add_item(batch, queue.get_nowait())
+            items += 1
+            continue
+        except asyncio.QueueEmpty:
+            pass
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0: break
+        try:
+            add_item(batch, await asyncio.wait_for(queue.get(), remaining))
+            items += 1
+        except asyncio.TimeoutError:
+            break
+
+    return batch, items
+
+# Holds the best value of each minute in memory and only writes it once the minute is over,
+# instead of replacing the row for the minute on every pushed value
+class MinuteMaxCombiner:
+    # wait a little after the minute is over for late pushes
+    GRACE = 10*1000
+
+    def __init__(self):
+        self.pending = {} # (channel_id, minute_timestamp) -> (timestamp, value)
+        self.latest = {} # channel_id -> latest minute seen
+
+    def add(self, m):
+        minute = m.timestamp // 60000 * 60000
+        key = (m.channel_id, minute)
+
+        best = self.pending.get(key)
+        if best is None or m.value >= best[1]:
+            self.pending[key] = (m.timestamp, m.value)
+
+        self.latest[m.channel_id] = max(self.latest.get(m.channel_id, minute), minute)
+
+    # minutes that are complete, either because a later minute was already seen or because enough time passed
+    def closed(self, now):
+        return [(key, best) for key, best in self.pending.items()
+            if key[1] < self.latest[key[0]] or now >= key[1] + 60000 + self.GRACE]
+
+    def written(self, closed):
+        for key, best in closed:
+            if self.pending.get(key) == best:
+                del self.pending[key]
+
+    @staticmethod
+    async def write(cursor, closed):
+        for (channel_id, minute), (timestamp, value) in closed:
+            # keep max: drop rows for the minute that are not bigger, then insert unless a bigger one remains
+            # (also correct for values of minutes that were already written, eg. late pushes)
+            await cursor.execute(
+                "DELETE FROM data WHERE channel_id = %s AND timestamp >= %s AND timestamp < %s AND value <= %s",
+                (channel_id, minute, minute + 60000, value)
+            )
+            await cursor.execute(
+                """INSERT INTO data (timestamp, channel_id, value)
+                    SELECT %s, %s, %s FROM DUAL
+                    WHERE NOT EXISTS (SELECT 1 FROM data WHERE channel_id = %s AND timestamp >= %s AND timestamp < %s)""",
+                (timestamp, channel_id, value, channel_id, minute, minute + 60000)
+            )
+
+# (channel_id, timestamp) of the rows that are in the data table already, looked up by primary key
+async def existing_keys(cursor, rows):
+    by_channel = {}
+    for m in rows:
+        by_channel.setdefault(m.channel_id, set()).add(m.timestamp)
+
+    existing = set()
+    for channel_id, timestamps in by_channel.items():
+        await cursor.execute(f"select timestamp from data where channel_id = %s and timestamp in ({','.join(['%s']*len(timestamps))})",
+                             (channel_id, *timestamps))
+        existing.update((channel_id, row[0]) for row in await cursor.fetchall())
+    return existing
+
+# one multi row insert, duplicates can happen if a batch is retried after the commit went through,
+# vzlogger sends a push again or the spool is replayed
+# returns the rows that were not in the table yet, only those may go into the rollups (a duplicate would count twice there)
+async def insert_rows(cursor, rows):
+    existing = await existing_keys(cursor, rows)
+    await cursor.executemany(
+        "insert into data (timestamp, channel_id, value) values (%s,%s,%s) on duplicate key update value = values(value)", [m[:3] for m in rows]
+    )
+
+    new = {} # the last row of a key in the batch is the one that ends up in the table
+    for m in rows:
+        key = (m.channel_id, m.timestamp)
+        if key not in existing:
+            new[key] = m
+    writer_duplicates.inc(len(rows) - len(new))
+    return list(new.values())
+
+# returns the measurements that were newly inserted as is
+async def write_batch(conn, cursor, batch, combiner):
+    rows = []
+    for m in batch:
+        if m.combine == Combine.NONE:
+            rows.append(m)
+        elif m.combine == Combine.MAX_PER_MINUTE:
+            combiner.add(m)
+
+    new = await insert_rows(cursor, rows) if rows else []
+
+    closed = combiner.closed(ts.get_volkzaehler_timestamp())
+    await combiner.write(cursor, closed)
+
+    await conn.commit()
+    combiner.written(closed)
+    return new
+
+# server errors that are not about the statement: retried after reconnecting like lost connections
+# (too many connections, shutdown, lock wait timeout, deadlock, access denied)
+RETRY_ERRNOS = { 1040, 1053, 1205, 1213, 1044, 1045, 1142 }
+
+# table doesn't exist (yet)
+def is_missing_table(e):
+    return isinstance(e, pymysql.err.ProgrammingError) and len(e.args) > 0 and e.args[0] == 1146
+
+# the server rejected the statement because of the rows in it (value out of range, constraint, ...)
+# retrying the same rows fails forever, unlike errors of the connection (client side errnos 2000-2999, timeouts, ...)
+def is_statement_error(e):
+    if not isinstance(e, pymysql.err.MySQLError) or isinstance(e, pymysql.err.InterfaceError): return False
+    errno = e.args[0] if e.args and isinstance(e.args[0], int) else None
+    return errno is not None and not 2000 <= errno < 3000 and errno not in RETRY_ERRNOS
+
+# write_batch, if a statement of it fails (see is_statement_error) its rows and closed minutes are written one at a time
+# and the ones the database still rejects are dropped, so a single bad row can't block the writer
+# connection errors are raised, the caller keeps the batch and retries it after reconnecting
+# returns (newly inserted measurements for the rollups, number of measurements of the batch the database took)
+async def write_checked(log, conn, cursor, batch, combiner):
+    try:
+        return await write_batch(conn, cursor, batch, combiner), len(batch)
+    except Exception as e:
+        if not is_statement_error(e): raise
+        await conn.rollback()
+        log.warning(f"Writing {len(batch)} rows failed, retrying them one at a time: {e}")
+
+    rows = []
+    written = len(batch)
+    for m in batch:
+        if m.combine != Combine.NONE: continue # in the combiner already
+        try:
+            new = await insert_rows(cursor, [m])
+            await conn.commit()
+            rows.extend(new)
+        except Exception as e:
+            if not is_statement_error(e): raise
+            await conn.rollback()
+            written -= 1
+            writer_rejected.inc()
+            log.error(f"Dropping measurement the database rejects: {m}: {e}")
+
+    for item in combiner.closed(ts.get_volkzaehler_timestamp()):
+        try:
+            await combiner.write(cursor, [item])
+            await conn.commit()
+        except Exception as e:
+            if not is_statement_error(e): raise
+            await conn.rollback()
+            writer_rejected.inc()
+            log.error(f"Dropping minute value the database rejects: {item}: {e}")
+        combiner.written([item])
+    return rows, written
+
+def spooled_measurement(timestamp, channel_id, combine, value):
+    combine, weight = spool_file.unpack_combine(combine)
+    return Measurement(timestamp, channel_id, value, Combine(combine), weight)
+
+# on_late_rows(oldest_timestamp) is called once rows older than LATE_ROWS were committed (including their rollups),
+# so caches of history can be invalidated (see backend cache.py)
+LATE_ROWS = 5*60*1000
+
+async def write_loop(log, on_late_rows=None):
     log.info("Starting db_write_loop")
 
+    # all survive reconnects, so buckets and minutes not yet written and a batch that failed on the connection are not lost
+    rollup = rollups.RollupAccumulator()
+    combiner = MinuteMaxCombiner()
+    batch = []
+    batch_items = 0 # queue items the batch was taken from
+    spool = get_spool()
+    late_from = None # oldest late row written since the last rollup flush
+
+    def check_late(rows):
+        nonlocal late_from
+        if not rows: return
+        oldest = min(tup[0] for tup in rows)
+        if oldest < ts.get_volkzaehler_timestamp() - LATE_ROWS:
+            late_from = oldest if late_from is None else min(late_from, oldest)
+
+    stats_interval = 10*60
+    stats_time = time.monotonic()
+    stats_rows = 0
+    stats_batches = 0
+
     conn = None
     while True:
         try:
-            conn = await get_conn_async(autocommit=True)
+            conn = await get_conn_async(autocommit=False)
             
             async with conn.cursor() as cursor:
                 while True:
-                    tup = await queue.get()
-                    combine_per_minute = len(tup) >= 4 # ugly hack
-                    
-                    if not combine_per_minute:
-                        await cursor.execute(
-                            "insert into data (timestamp, channel_id, value) values (%s,%s,%s)", tup
-                        )
-                    else:
-                        # special handling for meter readings: only store every minute but take max
-                        minute_timestamp = (tup[0] // 60000) * 60000
-                        
-                        # Delete any existing values for this minute, then insert new value (effectively combine by max but keep accurate timestamp)
-                        await cursor.execute(
-                            "DELETE FROM data WHERE channel_id = %s AND timestamp >= %s AND timestamp < %s",
-                            (tup[1], minute_timestamp, minute_timestamp + 60000)
-                        )
-                        await cursor.execute(
-                            "INSERT INTO data (timestamp, channel_id, value) VALUES (%s, %s, %s)",
-                            (tup[0], tup[1], tup[2])
-                        )
-
-                    print(f"Write {ts.time_from_timestamp(tup[0])}: Insert ({tup[1]}, {tup[2]})")
-                    
-                    queue.task_done()
+                    if not batch:
+                        # don't wait around if there is a backlog to replay
+                        batch, batch_items = await get_batch(timeout=0.01 if spool.pending() else rollup.flush_interval)
+
+                    if batch or combiner.pending:
+                        t0 = time.perf_counter()
+                        rows, written = await write_checked(log, conn, cursor, batch, combiner)
+                        t1 = time.perf_counter()
+
+                        for m in rows:
+                            rollup.add(m.timestamp, m.channel_id, m.value, m.weight)
+                        check_late(rows)
+
+                        if batch:
+                            writer_rows.inc(written)
+                            writer_batch_rows.observe(len(batch))
+                            writer_flush_seconds.observe(t1 - t0)
+                            log.debug(f"Write {len(batch)} rows up to {ts.time_from_timestamp(batch[-1].timestamp)} in {(t1 - t0)*1000:.2f} ms")
+
+                            for _ in range(batch_items):
+                                queue.task_done()
+                            stats_rows += len(batch)
+                            stats_batches += 1
+                            batch = []
+                            batch_items = 0
+
+                    if spool.pending():
+                        records = spool.read(SPOOL_REPLAY_ROWS)
+                        spooled = [spooled_measurement(*record) for record in records]
+
+                        t0 = time.perf_counter()
+                        rows, written = await write_checked(log, conn, cursor, spooled, combiner)
+                        spool.consumed(len(records))
+                        t1 = time.perf_counter()
+
+                        for m in rows:
+                            rollup.add(m.timestamp, m.channel_id, m.value, m.weight)
+                        check_late(rows)
+                        writer_rows.inc(written)
+
+                        remaining = spool.pending()
+                        log.info(f"Replayed {len(spooled)} spooled rows in {(t1 - t0)*1000:.2f} ms, {remaining} remaining")
+
+                    if rollup.should_flush():
+                        await rollup.flush(cursor)
+                        await conn.commit()
+                        rollup.flushed()
+
+                        if late_from is not None and on_late_rows:
+                            on_late_rows(late_from)
+                        late_from = None
+
+                    if time.monotonic() - stats_time >= stats_interval:
+                        elapsed = time.monotonic() - stats_time
+                        log.info(f"Writer: {stats_rows} rows in {stats_batches} batches ({stats_rows / elapsed:.2f} rows/s), "
+                                 f"max flush time since start {writer_flush_seconds.max*1000:.2f} ms, queue {queued_rows}")
+                        stats_time = time.monotonic()
+                        stats_rows = 0
+                        stats_batches = 0
                         
         except Exception as e:
             log.error(f"Error in db_write_loop: {traceback.format_exc()}")
@@ -83,14 +464,59 @@ async def write_loop(log):
             if conn:
                 conn.close()
 
-def queue_write(log, tup):
+def put(item, rows):
+    global queued_rows
+    if queued_rows + rows > QUEUE_MAX_ROWS:
+        raise asyncio.QueueFull()
+    queue.put_nowait(item)
+    queued_rows += rows
+
+def queue_write(log, measurement):
     try:
-        queue.put_nowait(tup)
+        put(measurement, 1)
     except asyncio.QueueFull:
-        log.error("Database Writer queue is full, dropping measurement")
+        try:
+            spool = get_spool()
+            if spool.pending() == 0: # only log at the start of a backlog
+                log.warning("Database Writer queue is full, spooling measurements to disk")
+            spool.append([measurement])
+            writer_spooled.inc()
+        except Exception:
+            writer_dropped.inc()
+            log.error(f"Database Writer queue is full and spooling failed, dropping measurement: {traceback.format_exc()}")
     except Exception as e:
+        writer_dropped.inc()
         log.error(f"Error adding to Database Writer queue: {e}")
 
+# more than this many measurements waiting in the spool and queue_write_many turns pushes away (~24 MB, days of 1 Hz data)
+SPOOL_MAX_PENDING = 1000000
+
+# Measurements of one push from vzlogger, queued in items of BATCH_MAX_ROWS instead of one each,
+# all of them or (if the queue is full) none, so a push is never half queued and half spooled
+# spooled like queue_write if the queue is full, returns False if it could not be taken, so the sender can retry later
+# (the push receiver then answers 503, vzlogger keeps its buffer and sends it again) instead of it being dropped
+def queue_write_many(log, measurements):
+    if not measurements: return True
+    if queued_rows + len(measurements) <= QUEUE_MAX_ROWS:
+        for i in range(0, len(measurements), BATCH_MAX_ROWS):
+            chunk = measurements[i:i + BATCH_MAX_ROWS]
+            put(chunk, len(chunk))
+        return True
+
+    try:
+        spool = get_spool()
+        pending = spool.pending()
+        if pending + len(measurements) > SPOOL_MAX_PENDING:
+            return False
+        if pending == 0: # only log at the start of a backlog
+            log.warning("Database Writer queue is full, spooling measurements to disk")
+        spool.append(measurements)
+        writer_spooled.inc(len(measurements))
+        return True
+    except Exception:
+        log.error(f"Database Writer queue is full and spooling failed: {traceback.format_exc()}")
+        return False
+
 @contextmanager
 def get_cursor(read_timeout=None):
     with get_conn() as conn:
@@ -120,62 +546,67 @@ def create_tables():
             )
         """)
 
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS data (
-                channel_id INT(3) NOT NULL,
-                timestamp BIGINT(20) NOT NULL,
-                value FLOAT NOT NULL,
-                PRIMARY KEY (channel_id, timestamp)
-            )
-        """)
-        cur.execute("""
-            ALTER TABLE data ADD CONSTRAINT fk_channel_id FOREIGN KEY (channel_id) REFERENCES channels(channel_id)
-        """)
-    
-def get_or_create_channels():
-    with get_cursor() as cur:
-        cur.execute("""
-            INSERT IGNORE INTO channels (name, type, unit)
-            VALUES ('solar_power', 'power', 'W')
-        """)
-        cur.execute("SELECT channel_id FROM channels WHERE name = 'solar_power'")
-        power_id = cur.fetchone()[0]
+        if partitioned():
+            partitions.create_table(cur, ts.get_volkzaehler_timestamp())
+        else:
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS data (
+                    channel_id INT(3) NOT NULL,
+                    timestamp BIGINT(20) NOT NULL,
+                    value FLOAT NOT NULL,
+                    PRIMARY KEY (channel_id, timestamp)
+                )
+            """)
+            cur.execute("""
+                ALTER TABLE data ADD CONSTRAINT fk_channel_id FOREIGN KEY (channel_id) REFERENCES channels(channel_id)
+            """)
 
-        cur.execute("""
-            INSERT IGNORE INTO channels (name, type, unit)
-            VALUES ('solar_power_by_minute', 'power', 'W')
-        """)
-        cur.execute("SELECT channel_id FROM channels WHERE name = 'solar_power_by_minute'")
-        power_by_minute_id = cur.fetchone()[0]
+        rollups.create_tables(cur)
 
-        cur.execute("""
-            INSERT IGNORE INTO channels (name, type, unit)
-            VALUES ('meter_power', 'power', 'W')
-        """)
-        cur.execute("SELECT channel_id FROM channels WHERE name = 'meter_power'")
-        meter_power = cur.fetchone()[0]
+def create_rollup_tables():
+    with get_cursor() as cur:
+        rollups.create_tables(cur)
+    
+# creates the channel if it doesn't exist yet, returns its id
+def get_or_create_channel(cur, name, type, unit):
+    cur.execute("INSERT IGNORE INTO channels (name, type, unit) VALUES (%s, %s, %s)", (name, type, unit))
+    cur.execute("SELECT channel_id FROM channels WHERE name = %s", (name,))
+    return cur.fetchone()[0]
 
-        cur.execute("""
-            INSERT IGNORE INTO channels (name, type, unit)
-            VALUES ('meter_reading', 'energy', 'kWh')
-        """)
-        cur.execute("SELECT channel_id FROM channels WHERE name = 'meter_reading'")
-        meter_reading = cur.fetchone()[0]
+def get_or_create_channels():
+    with get_cursor() as cur:
+        power_id = get_or_create_channel(cur, 'solar_power', 'power', 'W')
+        power_by_minute_id = get_or_create_channel(cur, 'solar_power_by_minute', 'power', 'W')
+        meter_power = get_or_create_channel(cur, 'meter_power', 'power', 'W')
+        meter_reading = get_or_create_channel(cur, 'meter_reading', 'energy', 'kWh')
 
         #print(f"power: {power_id}, power_by_minute: {power_by_minute_id}")
         return power_id, power_by_minute_id, meter_power, meter_reading
 
-def get_channels(cur):
-    cur.execute("SELECT channel_id FROM channels WHERE name = 'solar_power'")
-    power_id = cur.fetchone()[0]
+# channels: [(name, type, unit)], eg. the channels of the polled devices (see devices.py), returns name -> channel_id
+def get_or_create_named_channels(channels):
+    with get_cursor() as cur:
+        return { name: get_or_create_channel(cur, name, type, unit) for name, type, unit in channels }
 
-    cur.execute("SELECT channel_id FROM channels WHERE name = 'solar_power_by_minute'")
-    power_by_minute_id = cur.fetchone()[0]
+# channel_id -> (period, max_interval) of the polled channels (see sampling.py)
+def set_channel_sampling(channels):
+    with get_cursor() as cur:
+        sampling.create_tables(cur)
+        for channel_id, (period, max_interval) in channels.items():
+            sampling.set_sampling(cur, channel_id, period, max_interval)
 
-    cur.execute("SELECT channel_id FROM channels WHERE name = 'meter_power'")
-    meter_power_id = cur.fetchone()[0]
+# timestamp of the newest row of a channel, None if it has none
+def get_last_timestamp(channel_id):
+    with get_cursor() as cur:
+        cur.execute("SELECT max(timestamp) FROM data WHERE channel_id = %s", (channel_id,))
+        return cur.fetchone()[0]
 
-    cur.execute("SELECT channel_id FROM channels WHERE name = 'meter_reading'")
-    meter_reading_id = cur.fetchone()[0]
+# channel ids never change once created, so only query them once
+channel_ids = None
 
-    return power_id, power_by_minute_id, meter_power_id, meter_reading_id
+async def get_channel_ids(cur):
+    global channel_ids
+    if channel_ids is None:
+        await cur.execute("SELECT name, channel_id FROM channels")
+        channel_ids = { name: channel_id for name, channel_id in await cur.fetchall() }
+    return channel_ids
@@ -35,6 +35,8 @@ echo "Pulling latest changes from git..."
 git pull
 
 cp database.template.env database.env
+# devices measure.py polls, keep the local one if it was edited
+[[ -f devices.json ]] || cp devices.template.json devices.json
 
 # Create virtual environment if it doesn't exist
 if [[ ! -d "venv" ]]; then
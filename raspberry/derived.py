@@ -0,0 +1,243 @@
+import asyncio
+import time
+import traceback
+import numpy as np
+import database as db
+import retention
+import resample
+import rollups
+import sampling
+import timestamps as ts
+
+# Load and savings as channels of their own: the average power per LOAD_INTERVAL of house load and of solar power used directly,
+# one row per interval, computed from meter_power and solar_power
+# measure.py computes them while the samples arrive (see intervals.py) and writes them like measurements,
+# so /data, the rollups and the archive read them like any other channel instead of recomputing them from the raw data every time
+# intervals that samples arrived too late for (vzlogger catching up after an outage, measure.py restarts)
+# are recomputed from the database by repair_chunk(), as is history from before these channels existed (see the end of the file)
+LOAD_INTERVAL = 4*1000
+
+# (name, type, unit) for database.get_or_create_named_channels
+CHANNELS = [('load', 'power', 'W'), ('savings', 'power', 'W')]
+
+# (period, max_interval) of both channels, one row every interval (see sampling.py)
+SAMPLING = (LOAD_INTERVAL, LOAD_INTERVAL)
+
+# average power of house load and of solar used directly, from the average meter and solar power of the same interval
+# remove negative values due to glitches
+EXPRESSIONS = {
+    'load': lambda series: np.maximum(series['meter'] + series['solar'], 0.0),
+    'savings': lambda series: np.maximum(np.minimum(series['meter'], 0.0) + series['solar'], 0.0),
+}
+
+# meter and solar (timestamps, values) arrays as channels for resample.py, channel_sampling from sampling.get_sampling
+# solar samples after a gap count as 0 (what the gap_fill_fix zero points of backend.process_results amount to)
+# while the first meter sample after a gap is spread over the whole gap
+# time without samples counts as 0, intervals are written even if one of the channels is missing
+def meter_channel(arrays, channel_sampling):
+    return resample.Channel(*arrays, sample_rate=sampling.sample_rate(channel_sampling), gaps=resample.GAP_SPREAD, fill=0.0)
+
+# compacted_until of solar, older rows are 10 s means further apart (see retention.gap_thres_for)
+# max_interval_from of solar, the larger gap threshold of its sampling only holds from there on (see sampling.gap_thres_for)
+def solar_channel(arrays, channel_sampling, compacted_until=None, max_interval_from=None):
+    gap_thres = retention.gap_thres_for(arrays[0], sampling.gap_thres_for(arrays[0], channel_sampling, max_interval_from), compacted_until)
+    return resample.Channel(*arrays, sample_rate=sampling.sample_rate(channel_sampling), gap_thres=gap_thres, gaps=resample.GAP_ZERO, fill=0.0)
+
+# meter and solar: resample.Channel (see meter_channel, solar_channel)
+# returns (timestamps, load, savings) arrays of the intervals in [start, end] that have samples of either channel
+def load_and_savings(meter, solar, start, end):
+    interval = LOAD_INTERVAL
+
+    channels = [times for times in (meter.timestamps, solar.timestamps) if len(times)]
+    if not channels:
+        return np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0)
+
+    start = max(start, min(int(times[0]) for times in channels))
+    end   = min(end  , max(int(times[-1]) for times in channels))
+
+    start_i = start // interval
+    end_i   = end // interval # include timeperiod number
+
+    # TODO: could try to turn gaps in source values into gaps in filtered data, but his is a little complicated because gap fix makes detecting gaps harder
+    # Instead just accept that missing values will technically introduce error in things like saved energy numbers
+    res = resample.resample({ 'meter': meter, 'solar': solar }, start_i*interval, (end_i + 1)*interval, interval, expressions=EXPRESSIONS)
+
+    timestamps = np.arange(start_i, start_i + len(res['load']), dtype=np.int64)*interval - interval//2 # center the interval makes most sense for the plot
+    return timestamps, res['load'], res['savings']
+
+# rows of a channel in [start, end] and the one before and after, whose samples reach into the range
+def read_channel(cur, channel_id, start, end):
+    cur.execute("SELECT timestamp, value FROM data WHERE channel_id = %s and timestamp < %s ORDER BY timestamp DESC LIMIT 1", (channel_id, start))
+    rows = cur.fetchall()
+    cur.execute("SELECT timestamp, value FROM data WHERE channel_id = %s and timestamp between %s and %s ORDER BY timestamp", (channel_id, start, end))
+    rows += cur.fetchall()
+    cur.execute("SELECT timestamp, value FROM data WHERE channel_id = %s and timestamp > %s ORDER BY timestamp LIMIT 1", (channel_id, end))
+    rows += cur.fetchall()
+
+    if not rows:
+        return np.empty(0, dtype=np.int64), np.empty(0)
+    arr = np.array(rows, dtype=np.float64)
+    return arr[:,0].astype(np.int64), arr[:,1]
+
+# Replaces the rows of both channels in [start, end) (whole rollup buckets) with ones recomputed from the solar and meter rows
+def repair_chunk(conn, channels, start, end):
+    interval = LOAD_INTERVAL
+    ids = [channels[name] for name, type, unit in CHANNELS]
+
+    cur = conn.cursor()
+    try:
+        # samples ending in interval i (from i*interval) are written at i*interval - interval//2, like the live intervals
+        first_i = start // interval + 1
+        last_i = (end - 1 + interval//2) // interval
+        meter_id, solar_id = channels['meter_power'], channels['solar_power']
+        meter = meter_channel(read_channel(cur, meter_id, first_i*interval, (last_i + 1)*interval), sampling.get_sampling(cur, meter_id))
+        solar = solar_channel(read_channel(cur, solar_id, first_i*interval, (last_i + 1)*interval), sampling.get_sampling(cur, solar_id),
+                              retention.get_compacted_until(cur, solar_id), sampling.get_max_interval_from(cur, solar_id))
+        timestamps, load, savings = load_and_savings(meter, solar, first_i*interval, (last_i + 1)*interval - 1)
+
+        cur.execute("DELETE FROM data WHERE channel_id in (%s, %s) and timestamp >= %s and timestamp < %s", (*ids, start, end))
+        timestamps = timestamps.tolist()
+        for channel_id, values in zip(ids, (load, savings)):
+            if timestamps:
+                cur.executemany("INSERT INTO data (channel_id, timestamp, value) VALUES (%s, %s, %s)",
+                                list(zip([channel_id] * len(timestamps), timestamps, values.tolist())))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+
+    for channel_id in ids:
+        rollups.backfill(conn, channel_id, start, end)
+    return len(timestamps)
+
+# [start, end) widened to whole hours (the coarsest rollup), compacted history is left as it is (see retention.py)
+def repair_chunks(cur, channels, start, end):
+    compacted_until = retention.get_compacted_until(cur, channels['load'])
+    start = max(start, compacted_until or start) // retention.CHUNK * retention.CHUNK
+    end = -(-end // retention.CHUNK) * retention.CHUNK
+    return [(chunk, chunk + retention.CHUNK) for chunk in range(start, end, retention.CHUNK)]
+
+def get_channels(cur):
+    retention.create_tables(cur)
+    sampling.create_tables(cur)
+    cur.execute("SELECT name, channel_id FROM channels")
+    return dict(cur.fetchall())
+
+# recomputes one chunk in its own connection, for asyncio.to_thread
+def repair_chunk_conn(start, end):
+    with db.get_conn() as conn:
+        cur = conn.cursor()
+        channels = get_channels(cur)
+        conn.commit()
+        cur.close()
+        return repair_chunk(conn, channels, start, end)
+
+# Range measure.py still has to recompute, all marked ranges are merged into one
+# repaired once its hours are over by REPAIR_DELAY: by then the writer has committed the rows of the range
+# and flushed its own rollup updates for those hours, which the rollups rebuilt by repair_chunk would otherwise race with
+REPAIR_DELAY = 5*60*1000
+REPAIR_INTERVAL = 60 # seconds
+
+class PendingRepair:
+    def __init__(self):
+        self.start = None
+        self.end = None
+
+    def add(self, start, end):
+        self.start = start if self.start is None else min(self.start, start)
+        self.end = end if self.end is None else max(self.end, end)
+
+    # [start, end) of the whole hours that can be repaired now, None if there are none
+    def take(self, now):
+        if self.start is None: return None
+
+        until = (now - REPAIR_DELAY) // retention.CHUNK * retention.CHUNK
+        start = self.start // retention.CHUNK * retention.CHUNK
+        end = min(-(-self.end // retention.CHUNK) * retention.CHUNK, until)
+        if start >= end: return None
+
+        if end >= self.end:
+            self.start = self.end = None
+        else:
+            self.start = end
+        return start, end
+
+repairs = PendingRepair()
+
+# runs in measure.py, on_repaired(start, end) is called for every repaired chunk (to invalidate caches)
+async def repair_loop(log, on_repaired=None):
+    log.info("Starting load/savings repair loop")
+
+    while True:
+        await asyncio.sleep(REPAIR_INTERVAL)
+
+        # spooled rows are not in the database yet
+        if db.get_spool().pending(): continue
+
+        todo = repairs.take(ts.get_volkzaehler_timestamp())
+        if todo is None: continue
+
+        start, end = todo
+        try:
+            t0 = time.perf_counter()
+            with db.get_cursor() as cur:
+                chunks = repair_chunks(cur, get_channels(cur), start, end)
+
+            intervals = 0
+            for chunk_start, chunk_end in chunks:
+                try:
+                    # in a thread, the blocking mysql calls can't run on the event loop
+                    intervals += await asyncio.to_thread(repair_chunk_conn, chunk_start, chunk_end)
+                except Exception:
+                    repairs.add(chunk_start, end) # the rest is tried again later
+                    raise
+                if on_repaired:
+                    on_repaired(chunk_start, chunk_end)
+                await asyncio.sleep(retention.CHUNK_PAUSE)
+
+            t1 = time.perf_counter()
+            log.info(f"Repaired load/savings from {ts.time_from_timestamp(start)} to {ts.time_from_timestamp(end)}: {intervals} intervals in {t1 - t0:.1f} s")
+        except Exception:
+            log.error(f"Error repairing load/savings: {traceback.format_exc()}")
+
+# python derived.py repair [days]
+# Recomputes load and savings from the solar and meter rows, without days all data is processed
+# run it once to fill in the history from before these channels existed (with measure.py running, it created the channels)
+# Stops an hour before now, measure.py writes the intervals from there and repairs what it missed
+# Starts after the compacted part of load and savings (see retention.py)
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) < 2 or sys.argv[1] != "repair":
+        print("usage: python derived.py repair [days]")
+        sys.exit(1)
+
+    end = (ts.get_volkzaehler_timestamp() - REPAIR_DELAY) // retention.CHUNK * retention.CHUNK
+
+    with db.get_cursor() as cur:
+        channels = get_channels(cur)
+        if 'load' not in channels:
+            print("Channels load and savings don't exist yet, start measure.py once first")
+            sys.exit(1)
+
+        if len(sys.argv) >= 3:
+            start = end - int(sys.argv[2]) * 24*60*60*1000
+        else:
+            cur.execute("SELECT min(timestamp) FROM data WHERE channel_id in (%s, %s)", (channels['solar_power'], channels['meter_power']))
+            start = cur.fetchone()[0]
+            if start is None: sys.exit(0)
+        chunks = repair_chunks(cur, channels, start, end)
+
+    with db.get_conn() as conn:
+        t0 = time.perf_counter()
+        intervals = 0
+        for i, (chunk_start, chunk_end) in enumerate(chunks):
+            try:
+                intervals += repair_chunk(conn, channels, chunk_start, chunk_end)
+            except Exception:
+                print(f"Error repairing {ts.time_from_timestamp(chunk_start)}: {traceback.format_exc()}")
+                sys.exit(1)
+            if i % 24 == 23 or i == len(chunks) - 1:
+                print(f"Repaired up to {ts.time_from_timestamp(chunk_end)}, {intervals} intervals in {time.perf_counter() - t0:.1f} s")
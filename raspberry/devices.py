@@ -0,0 +1,252 @@
+import asyncio
+import json
+import math
+import os
+import random
+import time
+import traceback
+from typing import NamedTuple
+import aiohttp
+import metrics
+import sampling
+import timestamps as ts
+
+# Devices measure.py polls, from devices.json (see devices.template.json), without it just the shelly plug of the solar panel
+# Every device is polled by its own task on a shared aiohttp session, on its own schedule (whole multiples of its period),
+# so a slow or unreachable device never delays the samples of the others
+# a device is only polled again once its previous request is done, ticks that pass while it is still waiting are skipped
+DEVICES_PATH = 'devices.json'
+
+DEFAULT_DEVICES = [
+    {
+        'name': 'solar_plug',
+        'type': 'shelly',
+        'host': '192.168.2.109',
+        'channel': 'solar_power',
+        'by_minute_channel': 'solar_power_by_minute',
+        'invert': True, # negative Watts = solar power
+        'live': 'solar',
+        'skip_zero': 60,
+        'compression': None,
+        'tolerance': 10,
+    },
+]
+
+# per device settings that can be left out
+# period, timeout, jitter: seconds, jitter is a random delay before each poll, to spread out the requests of many devices
+# invert: negate the power, skip_zero: don't write samples after the power was zero for this many seconds (night)
+# live: series name on the live stream (see live.py), by_minute_channel: also write the per minute average of a shelly
+# compression: 'deadband' only stores the samples needed to draw the curve within tolerance W (see sampling.DeadBand),
+#   max_hold: seconds a stored row may stand for at most, None stores every sample
+# max_period: seconds, adaptive polling: the period doubles up to this while the power changes less than tolerance W
+#   between polls and goes back to period on bigger changes, None always polls every period
+DEFAULTS = {
+    'period': 1,
+    'timeout': 5,
+    'jitter': 0,
+    'invert': False,
+    'skip_zero': None,
+    'live': None,
+    'by_minute_channel': None,
+    'compression': None,
+    'tolerance': 10,
+    'max_hold': 60,
+    'max_period': None,
+}
+
+# power: W, by_minute: (minute timestamp, average W) of the last complete minute, only when it changed
+class Sample(NamedTuple):
+    power: float
+    by_minute: tuple | None = None
+
+# https://shelly-api-docs.shelly.cloud/gen2/ComponentsAndServices/Switch/
+# 'aenergy' and 'ret_aenergy' have the energy of the last 3 minutes in mWh, ret_aenergy is the returned (solar) energy
+class ShellyPlug:
+    def __init__(self, config):
+        self.url = config.get('url') or f"http://{config['host']}/rpc/Switch.GetStatus?id={config.get('switch', 0)}"
+        self.energy = 'ret_aenergy' if config['invert'] else 'aenergy'
+
+    def parse(self, status):
+        energy = status[self.energy]
+        by_minute = (energy['minute_ts'] * 1000, float(energy['by_minute'][0]) * (60.0 / 1000)) # s -> ms, mWh / min -> W
+        return Sample(float(status['apower']), by_minute)
+
+# Any device with a json api, path is the list of keys to the power value, scale converts it to W
+class HttpJsonDevice:
+    def __init__(self, config):
+        self.url = config['url']
+        self.path = config['path']
+        self.scale = config.get('scale', 1)
+
+    def parse(self, data):
+        for key in self.path:
+            data = data[key]
+        return Sample(float(data) * self.scale)
+
+DEVICE_TYPES = {
+    'shelly': ShellyPlug,
+    'http_json': HttpJsonDevice,
+}
+
+def load_devices(path=DEVICES_PATH):
+    configs = DEFAULT_DEVICES
+    if os.path.exists(path):
+        with open(path) as f:
+            configs = json.load(f)
+    configs = [{ **DEFAULTS, **config } for config in configs]
+
+    for config in configs:
+        if config['compression'] not in (None, 'deadband'):
+            raise ValueError(f"{config['name']}: unknown compression {config['compression']}")
+        if config['max_period'] is not None and config['max_period'] < config['period']:
+            raise ValueError(f"{config['name']}: max_period is shorter than period")
+    return configs
+
+# (period, max_interval) in ms of the main channel of a device, see sampling.py
+def device_sampling(config):
+    max_interval = max(config['period'], config['max_period'] or 0, config['max_hold'] if config['compression'] else 0)
+    return config['period']*1000, max_interval*1000
+
+# channels the devices write to, (name, type, unit) for database.get_or_create_channel
+def device_channels(configs):
+    channels = []
+    for config in configs:
+        for name in (config['channel'], config['by_minute_channel']):
+            if name is not None and (name, 'power', 'W') not in channels:
+                channels.append((name, 'power', 'W'))
+    return channels
+
+class DevicePoller:
+    # on_sample(poller, timestamp, sample) for every successful poll
+    def __init__(self, config, on_sample, log):
+        self.config = config
+        self.name = config['name']
+        self.device = DEVICE_TYPES[config['type']](config)
+        self.on_sample = on_sample
+        self.log = log
+
+        self.zero_since = None # timestamp of first zero power sample in a row
+        self.was_idle = False # for the handler to log only the start of idle periods
+        self.prev_by_minute = None
+        self.failing = False
+
+        # rows to store of the main channel, every sample unless compressed, with weights for adaptive polling
+        period, max_interval = device_sampling(config)
+        self.deadband = sampling.DeadBand(config['tolerance'] if config['compression'] else None, config['max_hold']*1000,
+                                          period, max_duration=2*(config['max_period'] or config['period'])*1000)
+
+        self.period = config['period'] # current poll period, changes with adaptive polling
+        self.prev_power = None
+
+        labels = { 'device': self.name }
+        self.poll_seconds = metrics.Histogram('solarmon_device_poll_seconds', 'Time to read a device', metrics.TIME_BUCKETS, labels)
+        self.poll_errors = metrics.Counter('solarmon_device_poll_errors_total', 'Failed reads of a device', labels=labels)
+        self.skipped = metrics.Counter('solarmon_device_skipped_total', 'Polls skipped because the previous one was still running', labels=labels)
+        self.sample_errors = metrics.Counter('solarmon_device_sample_errors_total', 'Samples of a device that could not be handled', labels=labels)
+
+    # power has been zero for skip_zero seconds, samples are not written (but still passed on, load/savings keep going at night)
+    def idle(self, timestamp):
+        skip_zero = self.config['skip_zero']
+        return skip_zero is not None and self.zero_since is not None and timestamp - self.zero_since >= skip_zero*1000
+
+    async def poll(self, session, timestamp):
+        try:
+            with self.poll_seconds.time():
+                async with session.get(self.device.url, timeout=aiohttp.ClientTimeout(total=self.config['timeout'])) as response:
+                    response.raise_for_status()
+                    sample = self.device.parse(await response.json(content_type=None))
+        except Exception:
+            self.poll_errors.inc()
+            if not self.failing: # once, not every second while a device is offline
+                self.log.error(f"Failed to read {self.name}: {traceback.format_exc()}")
+            self.failing = True
+            return
+
+        if self.failing:
+            self.log.info(f"{self.name} is back")
+            self.failing = False
+
+        # poll runs as its own task that nobody waits for, errors have to be handled here or they are lost
+        try:
+            self.handle(timestamp, sample)
+        except Exception:
+            self.sample_errors.inc()
+            self.log.error(f"Error handling sample of {self.name}: {traceback.format_exc()}")
+
+    def handle(self, timestamp, sample):
+        if self.config['invert']:
+            sample = sample._replace(power=-sample.power)
+
+        if sample.power <= 0.001:
+            if self.zero_since is None: self.zero_since = timestamp
+        else:
+            self.zero_since = None
+
+        if self.config['max_period'] is not None:
+            if self.prev_power is not None and abs(sample.power - self.prev_power) > self.config['tolerance']:
+                self.period = self.config['period']
+            else:
+                self.period = min(self.period*2, self.config['max_period'])
+        self.prev_power = sample.power
+
+        if sample.by_minute is not None:
+            if sample.by_minute[0] == self.prev_by_minute:
+                sample = sample._replace(by_minute=None)
+            else:
+                self.prev_by_minute = sample.by_minute[0]
+
+        self.on_sample(self, timestamp, sample)
+
+    async def run(self, session):
+        period = self.config['period']
+        self.log.info(f"Polling {self.name} every {period} s" + (f" (up to {self.config['max_period']} s while stable)" if self.config['max_period'] else ""))
+
+        pending = None
+        tick = math.ceil(time.time() / period) * period # consistent timings close to exactly on whole periods (of the fastest period)
+        while True:
+            delay = tick - time.time() + random.uniform(0, self.config['jitter'])
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            if pending is not None and not pending.done():
+                self.skipped.inc()
+            else:
+                # timestamp when the request is sent, it doesn't matter how long the device takes to answer
+                pending = asyncio.create_task(self.poll(session, ts.get_volkzaehler_timestamp()))
+
+            tick += self.period
+            if tick < time.time(): # fell behind (event loop was blocked), continue with the next whole period
+                tick = math.ceil(time.time() / period) * period
+
+async def poll_devices(configs, on_sample, log):
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*(DevicePoller(config, on_sample, log).run(session) for config in configs))
+
+# python devices.py [seconds]
+# polls the devices of devices.json (eg. fake_shelly.py instances) without a database and prints what arrives
+if __name__ == "__main__":
+    import logging
+    import sys
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s-%(levelname)s | %(message)s')
+    log = logging.getLogger('devices')
+    seconds = float(sys.argv[1]) if len(sys.argv) >= 2 else 10
+
+    # rows measure.py would store of the main channel (ignoring skip_zero)
+    stored = {}
+
+    def on_sample(poller, timestamp, sample):
+        rows = poller.deadband.add(timestamp, sample.power)
+        stored[poller.name] = stored.get(poller.name, 0) + len(rows)
+        print(f"{poller.name:16} {ts.time_from_timestamp(timestamp)} {sample.power:8.1f} W" +
+              (f"  minute {ts.time_from_timestamp(sample.by_minute[0])}: {sample.by_minute[1]:.1f} W" if sample.by_minute else "") +
+              (f"  stored {len(rows)} rows" if rows else "") +
+              (f"  next poll in {poller.period} s" if poller.config['max_period'] else "") +
+              ("  (idle)" if poller.idle(timestamp) else ""))
+
+    try:
+        asyncio.run(asyncio.wait_for(poll_devices(load_devices(), on_sample, log), seconds))
+    except asyncio.TimeoutError:
+        pass
+    print(metrics.render())
+    print("stored rows: " + ", ".join(f"{name} {rows}" for name, rows in stored.items()))
@@ -0,0 +1,115 @@
+from datetime import date, datetime, timedelta
+import numpy as np
+import database as db
+import derived
+import timestamps as ts
+
+# Energy per local day, integrated by the backend from the same intervals as the load/savings channels (see backend.energy_loop, derived.py)
+# and stored, so /stats only has to add up stored days instead of integrating power series on every request
+# a day is stored as complete once it is over, until then it is recomputed regularly
+ENERGY = ['solar', 'import', 'export', 'load', 'savings'] # Wh columns, import/export is meter power > 0 / < 0
+
+PERIODS = ['day', 'week', 'month', 'year']
+
+async def create_tables(cur):
+    await cur.execute("""
+        CREATE TABLE IF NOT EXISTS energy_daily (
+            day DATE PRIMARY KEY NOT NULL,
+            solar_wh DOUBLE NOT NULL,
+            import_wh DOUBLE NOT NULL,
+            export_wh DOUBLE NOT NULL,
+            load_wh DOUBLE NOT NULL,
+            savings_wh DOUBLE NOT NULL,
+            complete BOOLEAN NOT NULL
+        )
+    """)
+
+# (start, end) timestamps of a local day, end exclusive
+# local midnight is always a multiple of the 4 s load intervals, so intervals never straddle days
+def day_range(day):
+    start = ts.local_time_to_timestamp(datetime(day.year, day.month, day.day))
+    end = ts.local_time_to_timestamp(datetime(day.year, day.month, day.day) + timedelta(days=1))
+    return start, end
+
+def days(first, last):
+    day = first
+    while day <= last:
+        yield day
+        day += timedelta(days=1)
+
+# average power of import/export (and load and savings, same as their channels) per load interval,
+# from the meter and solar averages of resample.resample, solar is the channel itself
+EXPRESSIONS = {
+    'import': lambda series: np.maximum(series['meter'], 0.0),
+    'export': lambda series: np.maximum(-series['meter'], 0.0),
+    **derived.EXPRESSIONS,
+}
+
+# Wh per column from the average power of each over duration ms (the day as one bucket of resample.resample)
+def day_energy(averages, duration):
+    hours = duration / (60*60*1000)
+    return { name: float(averages[name][0]) * hours for name in ENERGY }
+
+# day -> complete
+async def get_stored_days(cur):
+    await cur.execute("SELECT day, complete FROM energy_daily")
+    return { day: bool(complete) for day, complete in await cur.fetchall() }
+
+async def store_day(cur, day, energy, complete):
+    await cur.execute(f"""
+        INSERT INTO energy_daily (day, {', '.join(f'{name}_wh' for name in ENERGY)}, complete)
+        VALUES (%s, {', '.join(['%s']*len(ENERGY))}, %s)
+        ON DUPLICATE KEY UPDATE {', '.join(f'{name}_wh = VALUES({name}_wh)' for name in ENERGY)}, complete = VALUES(complete)
+    """, (day, *(energy[name] for name in ENERGY), complete))
+
+def period_start(day, period):
+    if period == 'week': return day - timedelta(days=day.weekday()) # monday
+    if period == 'month': return day.replace(day=1)
+    if period == 'year': return day.replace(month=1, day=1)
+    return day
+
+# default range of /stats per period
+def default_start(today, period):
+    if period == 'day': return today - timedelta(days=30)
+    if period == 'week': return period_start(today - timedelta(weeks=12), 'week')
+    if period == 'month': return period_start(today.replace(day=1) - timedelta(days=365), 'month')
+    return date(1970, 1, 1)
+
+def ratio(a, b):
+    return a / b if b > 0 else None
+
+# Sums stored days per period, in kWh, struct of arrays like /data
+async def get_stats(cur, period, first, last):
+    try:
+        await cur.execute(f"""
+            SELECT day, {', '.join(f'{name}_wh' for name in ENERGY)}, complete
+                FROM energy_daily
+                WHERE day between %s and %s
+                ORDER BY day
+        """, (first, last))
+        rows = await cur.fetchall()
+    except Exception as e:
+        if not db.is_missing_table(e): raise
+        rows = [] # nothing stored yet, all zeros
+
+    periods = {}
+    for day, *values, complete in rows:
+        p = periods.setdefault(period_start(day, period), { 'energy': [0.0]*len(ENERGY), 'days': 0, 'complete': True })
+        p['energy'] = [a + b for a, b in zip(p['energy'], values)]
+        p['days'] += 1
+        p['complete'] = p['complete'] and bool(complete)
+
+    res = { 'period': period, 'start': [p.isoformat() for p in periods] }
+    for i, name in enumerate(ENERGY):
+        res[name] = [p['energy'][i] / 1000 for p in periods.values()]
+    # share of the solar energy used directly, and of the load covered by solar
+    res['self_consumption'] = [ratio(s, sol) for s, sol in zip(res['savings'], res['solar'])]
+    res['autarky'] = [ratio(s, l) for s, l in zip(res['savings'], res['load'])]
+    res['days'] = [p['days'] for p in periods.values()] # days with data
+    res['complete'] = [p['complete'] for p in periods.values()]
+
+    total = { name: sum(res[name]) for name in ENERGY }
+    total['self_consumption'] = ratio(total['savings'], total['solar'])
+    total['autarky'] = ratio(total['savings'], total['load'])
+    res['total'] = total
+    return res
@@ -0,0 +1,80 @@
+import asyncio
+import random
+import sys
+import time
+import numpy as np
+from aiohttp import web
+import synthetic
+
+# Local stand-in for a shelly plug (gen2 Switch.GetStatus), to try measure.py / devices.py without the hardware
+# apower follows the synthetic solar curve (see synthetic.py) as a negative value like the plug of the solar panel,
+# aenergy/ret_aenergy count up with by_minute and minute_ts like the real thing
+#
+# python fake_shelly.py [port] [delay ms] [failure rate]
+#   delay: every answer takes this long (+-50%), to see that a slow device doesn't hold up the others
+#   failure rate: fraction of requests answered with 500
+class FakeShelly:
+    def __init__(self, delay=0, failure_rate=0, seed=None):
+        self.delay = delay
+        self.failure_rate = failure_rate
+        self.rng = np.random.default_rng(seed)
+        self.cloud = 1.0
+
+        self.last = time.time()
+        self.returned = 0.0 # Wh
+        self.minute = int(self.last // 60)
+        self.by_minute = [0.0, 0.0, 0.0] # mWh of the last complete minutes, newest first
+        self.this_minute = 0.0
+
+    def power(self, now):
+        self.cloud = min(max(self.cloud + self.rng.normal(0, 0.02), 0.15), 1.0)
+        return float(synthetic.clear_sky(np.array([int(now*1000)]))[0]) * self.cloud + float(self.rng.normal(0, 2))
+
+    def update(self):
+        now = time.time()
+        power = max(self.power(now), 0.0)
+        energy = power * (now - self.last) / 3600 # Wh
+        self.last = now
+
+        if int(now // 60) != self.minute:
+            self.by_minute = [self.this_minute, *self.by_minute[:2]]
+            self.this_minute = 0.0
+            self.minute = int(now // 60)
+        self.this_minute += energy * 1000
+        self.returned += energy
+        return power
+
+    def status(self):
+        power = self.update()
+        return {
+            'id': 0,
+            'source': 'WS_in',
+            'output': True,
+            'apower': round(-power, 1),
+            'voltage': round(230 + random.uniform(-3, 3), 1),
+            'freq': 50,
+            'current': round(power / 230, 3),
+            'aenergy': { 'total': round(self.returned, 3), 'by_minute': [0.0, 0.0, 0.0], 'minute_ts': self.minute*60 },
+            'ret_aenergy': { 'total': round(self.returned, 3), 'by_minute': [round(e, 3) for e in self.by_minute], 'minute_ts': self.minute*60 },
+            'temperature': { 'tC': 37.3, 'tF': 99.1 },
+        }
+
+    async def handle(self, request):
+        if self.delay:
+            await asyncio.sleep(self.delay / 1000 * random.uniform(0.5, 1.5))
+        if random.random() < self.failure_rate:
+            return web.Response(status=500, text="Error")
+        return web.json_response(self.status())
+
+def make_app(shelly):
+    app = web.Application()
+    app.router.add_get('/rpc/Switch.GetStatus', shelly.handle)
+    return app
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) >= 2 else 8090
+    delay = float(sys.argv[2]) if len(sys.argv) >= 3 else 0
+    failure_rate = float(sys.argv[3]) if len(sys.argv) >= 4 else 0
+
+    print(f"Fake shelly on http://localhost:{port}/rpc/Switch.GetStatus?id=0")
+    web.run_app(make_app(FakeShelly(delay, failure_rate)), host='localhost', port=port, print=None)
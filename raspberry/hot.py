@@ -0,0 +1,180 @@
+import asyncio
+import numpy as np
+import time
+import database as db
+import derived
+import live
+import timestamps as ts
+
+# Recent raw data of the channels the dashboard shows, kept in memory so /data for the last hours doesn't need the database
+# Filled with a tail query from the database, then kept up to date by the live stream from measure.py (see live.py)
+HOT_HOURS = 26 # a bit more than the default 24h view
+HOT_CAPACITY = HOT_HOURS*60*60 * 2 # samples per channel, the channels are ~1 Hz, if it ever fills up the window just gets shorter
+
+# rows measured before we connected to the live stream can still be in the writer queue (meter readings up to a minute),
+# wait this long before the tail query so they are in the database
+SYNC_DELAY = 15
+
+# live series -> channel name
+HOT_CHANNELS = {
+    'solar': 'solar_power',
+    'meter_power': 'meter_power',
+    'meter_reading': 'meter_reading',
+    'load': 'load',
+    'savings': 'savings',
+}
+
+# Fixed capacity ring buffer of (timestamp, value), oldest samples get overwritten
+class RingBuffer:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.timestamps = np.zeros(capacity, dtype=np.int64)
+        self.values = np.zeros(capacity, dtype=np.float32) # float like the data table, so results match the database exactly
+        self.start = 0 # index of oldest sample
+        self.count = 0
+        self.covered_from = None # every sample from here on is in the buffer, None if not in sync with the database
+
+    def clear(self):
+        self.start = 0
+        self.count = 0
+        self.covered_from = None
+
+    def last(self):
+        if self.count == 0: return None
+        return int(self.timestamps[(self.start + self.count - 1) % self.capacity])
+
+    def extend(self, timestamps, values):
+        last = self.last()
+        if last is not None:
+            # duplicates from the tail query or out of order
+            keep = timestamps > last
+            timestamps, values = timestamps[keep], values[keep]
+
+        for i in range(0, len(timestamps), self.capacity):
+            self._write(timestamps[i:i + self.capacity], values[i:i + self.capacity])
+
+    def append(self, timestamp, value):
+        if self.count and timestamp <= self.last(): return
+        self._write(np.array([timestamp]), np.array([value]))
+
+    def _write(self, timestamps, values):
+        n = len(timestamps)
+        if n == 0: return
+
+        # n <= capacity, so only old samples get overwritten
+        overwritten = self.count + n - self.capacity
+        if overwritten > 0 and self.covered_from is not None:
+            # window gets shorter, starts right after the newest overwritten sample
+            newest_dropped = int(self.timestamps[(self.start + overwritten - 1) % self.capacity])
+            self.covered_from = max(self.covered_from, newest_dropped + 1)
+
+        pos = (self.start + self.count) % self.capacity
+        first = min(n, self.capacity - pos)
+        self.timestamps[pos:pos + first] = timestamps[:first]
+        self.values[pos:pos + first] = values[:first]
+        self.timestamps[:n - first] = timestamps[first:]
+        self.values[:n - first] = values[first:]
+
+        self.count += n
+        if self.count > self.capacity:
+            self.start = (self.start + self.count - self.capacity) % self.capacity
+            self.count = self.capacity
+
+    # (timestamps, values) arrays like backend.query_channel_range, copies so later appends can't change them
+    def range(self, start, end):
+        idx = (self.start + np.arange(self.count)) % self.capacity if self.start + self.count > self.capacity else slice(self.start, self.start + self.count)
+        timestamps = self.timestamps[idx]
+        lo = np.searchsorted(timestamps, start, 'left')
+        hi = np.searchsorted(timestamps, end, 'right')
+        return timestamps[lo:hi].copy(), self.values[idx][lo:hi].astype(np.float64)
+
+# rows like backend.query_channel_buckets: (bucket, avg, min, max, first_timestamp, last_timestamp)
+def to_buckets(timestamps, values, interval):
+    if len(timestamps) == 0: return []
+
+    buckets = timestamps // interval
+    starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    ends = np.r_[starts[1:], len(timestamps)]
+
+    avg = np.add.reduceat(values, starts) / (ends - starts)
+    mins = np.minimum.reduceat(values, starts)
+    maxs = np.maximum.reduceat(values, starts)
+
+    return list(zip(buckets[starts].tolist(), avg.tolist(), mins.tolist(), maxs.tolist(),
+                    timestamps[starts].tolist(), timestamps[ends - 1].tolist()))
+
+class HotData:
+    def __init__(self, capacity=HOT_CAPACITY):
+        self.buffers = { name: RingBuffer(capacity) for name in HOT_CHANNELS.values() }
+        self.synced = False
+
+    # start of the range that can be served from memory, None if nothing can
+    def covered_from(self, name):
+        buf = self.buffers.get(name)
+        if not self.synced or buf is None: return None
+        return buf.covered_from
+
+    def range(self, name, start, end):
+        return self.buffers[name].range(start, end)
+
+    def buckets(self, name, start, end, interval):
+        return to_buckets(*self.buffers[name].range(start, end), interval)
+
+    def on_message(self, msg):
+        if msg['series'] == 'invalidate' and msg['v'] is not None:
+            # load/savings of [t, v) were recomputed (see derived.repair_loop), the rows in memory are outdated
+            # so only what comes after is served from here, the rest is read from the database again
+            for name, type, unit in derived.CHANNELS:
+                buf = self.buffers[name]
+                if buf.covered_from is not None:
+                    buf.covered_from = max(buf.covered_from, msg['v'])
+            return
+
+        name = HOT_CHANNELS.get(msg['series'])
+        if name is not None:
+            self.buffers[name].append(msg['t'], msg['v'])
+
+    # messages may have been missed (see live.LivePublisher.publish), the next sync fills in the rows after the last one in memory,
+    # but missed invalidates of load/savings can't be caught up that way, so those are loaded again completely
+    def on_disconnect(self):
+        self.synced = False
+        for name, type, unit in derived.CHANNELS:
+            self.buffers[name].covered_from = None
+
+    # fill in everything since the last sample (or the whole window) from the database
+    async def sync(self, pool):
+        await asyncio.sleep(SYNC_DELAY)
+
+        t0 = time.perf_counter()
+        window_start = ts.get_volkzaehler_timestamp() - HOT_HOURS*60*60*1000
+
+        async with db.LazyCursor(pool) as cur:
+            channels = await db.get_channel_ids(cur)
+
+            for name, buf in self.buffers.items():
+                if name not in channels: continue # load/savings before measure.py created them
+                last = buf.last()
+                if buf.covered_from is None or last is None or last < window_start:
+                    buf.clear()
+                    buf.covered_from = window_start
+                    start = window_start
+                else:
+                    start = last + 1
+
+                async for rows in cur.stream("""select timestamp, value
+                                from data
+                                where channel_id = %s and timestamp >= %s
+                                order by timestamp
+                                """, (channels[name], start)):
+                    timestamps, values = zip(*rows)
+                    buf.extend(np.array(timestamps, dtype=np.int64), np.array(values, dtype=np.float32))
+
+        self.synced = True
+
+        t1 = time.perf_counter()
+        print(f"Hot data synced in {(t1 - t0)*1000:.2f} ms: " + ", ".join(f"{name} {buf.count}" for name, buf in self.buffers.items()))
+
+    async def run(self, pool):
+        await live.subscribe(self.on_message, lambda: self.sync(pool), self.on_disconnect)
+
+hot_data = HotData()
@@ -0,0 +1,112 @@
+# Streaming version of the load/savings computation in derived.load_and_savings (see resample.py)
+# Gets fed samples as they are measured and hands out intervals once no later sample can contribute to them anymore
+# Uses the same weighting, so the intervals match what derived.repair_chunk computes from the database later
+# samples that arrive too late to be counted are remembered (see take_late), so their intervals can be repaired
+
+# Accumulates value * duration per interval for one channel
+class ChannelIntegrator:
+    def __init__(self, interval, sample_rate, gap_thres=None):
+        self.interval = interval
+        self.sample_rate = sample_rate
+        # samples after a gap count as 0, like the zero points process_results adds with gap_fill_fix
+        self.gap_thres = gap_thres
+
+        self.prev = None # timestamp of previous sample (ms)
+        self.first = None # first interval index
+        self.sums = {} # interval index -> weighted sum (average power once the interval is complete)
+        self.emitted = None # intervals up to here were already handed out, late contributions are dropped
+        self.late = None # [start, end] of the time covered by dropped samples
+
+    def add(self, timestamp, value):
+        if self.prev is None:
+            self.prev = timestamp - self.sample_rate
+            self.first = timestamp // self.interval
+        if timestamp <= self.prev: # duplicate or out of order
+            if timestamp < self.prev:
+                self._late(timestamp - self.sample_rate, timestamp)
+            return
+
+        if self.gap_thres is not None and timestamp - self.prev > self.gap_thres:
+            value = 0
+
+        prev = self.prev / self.interval
+        t = timestamp / self.interval
+
+        # spread the sample over the intervals from the previous sample on
+        idx = int(t)
+        first = int(prev)
+        if first == idx:
+            dropped = not self._add(idx, value * (t - prev))
+        else:
+            dropped = not self._add(first, value * (first + 1 - prev))
+            for i in range(first + 1, idx):
+                dropped |= not self._add(i, value)
+            dropped |= not self._add(idx, value * (t - idx))
+        if dropped and value != 0: # zeros (after gaps) change nothing
+            self._late(self.prev, timestamp)
+
+        self.prev = timestamp
+
+    def _add(self, idx, weighted_value):
+        if self.emitted is not None and idx <= self.emitted: return False
+        self.sums[idx] = self.sums.get(idx, 0.0) + weighted_value
+        return True
+
+    def _late(self, start, end):
+        self.late = [start, end] if self.late is None else [min(self.late[0], start), max(self.late[1], end)]
+
+    # last interval no future sample can add to (the next sample can still add to the interval before its own)
+    def complete_until(self):
+        return int(self.prev // self.interval) - 2
+
+    def take(self, idx):
+        return self.sums.pop(idx, 0.0)
+
+class LoadSavingsIntegrator:
+    # sample rates and gap threshold like derived.meter_channel and derived.solar_channel get them from channel_sampling
+    def __init__(self, interval=4*1000, sample_rate_meter=1000, sample_rate_solar=1000, gap_thres_solar=3*1000, max_lag=60*1000):
+        self.interval = interval
+        self.meter = ChannelIntegrator(interval, sample_rate_meter)
+        self.solar = ChannelIntegrator(interval, sample_rate_solar, gap_thres=gap_thres_solar)
+        # reorder window: if one channel is behind the other by more than this (vzlogger pushes late or not at all)
+        # intervals are handed out anyway and its missing part counts as 0, its samples for them are late then
+        self.max_lag = max_lag
+        self.next = None # next interval to hand out
+
+    def add_meter(self, timestamp, value):
+        self.meter.add(timestamp, value)
+
+    def add_solar(self, timestamp, value):
+        self.solar.add(timestamp, value)
+
+    # returns list of (timestamp, load, savings) for the intervals that are complete now
+    def poll(self):
+        if self.meter.prev is None or self.solar.prev is None: return []
+
+        if self.next is None:
+            self.next = min(self.meter.first, self.solar.first)
+
+        done = min(self.meter.complete_until(), self.solar.complete_until())
+        latest = max(self.meter.prev, self.solar.prev)
+        done = max(done, int((latest - self.max_lag) // self.interval) - 2)
+
+        res = []
+        for idx in range(self.next, done + 1):
+            m = self.meter.take(idx)
+            s = self.solar.take(idx)
+            # same as derived.load_and_savings, including its interval timestamps
+            res.append((idx*self.interval - self.interval//2, max(m + s, 0.0), max(min(m, 0.0) + s, 0.0)))
+
+        if done >= self.next:
+            self.next = done + 1
+            self.meter.emitted = done
+            self.solar.emitted = done
+        return res
+
+    # (start, end) of the time covered by samples that were dropped since the last call, None if there were none
+    def take_late(self):
+        late = [c.late for c in (self.meter, self.solar) if c.late is not None]
+        self.meter.late = None
+        self.solar.late = None
+        if not late: return None
+        return min(l[0] for l in late), max(l[1] for l in late)
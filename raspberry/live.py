@@ -0,0 +1,82 @@
+import asyncio
+import json
+import traceback
+
+# Live measurements from measure.py to the backend over a local socket, as newline delimited json:
+# {"series": "solar", "t": 1751800000000, "v": 123.4}
+# series are named like the /data response (solar, meter_power, load, savings, meter_reading)
+# except for {"series": "invalidate", "t": oldest timestamp}, sent when rows were written late (see database.write_loop)
+# or rewritten, then "v" is the end of the range (load/savings, see derived.repair_loop)
+LIVE_HOST = '127.0.0.1'
+LIVE_PORT = 8083
+
+# lines waiting per subscriber, a subscriber that falls further behind is disconnected
+# (vzlogger catch-up pushes publish thousands of samples at once)
+QUEUE_SIZE = 1000
+
+# measure.py side
+class LivePublisher:
+    def __init__(self):
+        self.subscribers = set() # one queue per connected subscriber
+
+    def publish(self, series, timestamp, value):
+        if not self.subscribers: return
+
+        line = (json.dumps({ 'series': series, 't': timestamp, 'v': value }) + '\n').encode()
+        for q in list(self.subscribers):
+            try:
+                q.put_nowait(line)
+            except asyncio.QueueFull:
+                # subscriber too slow, it gets what was queued so far and is then disconnected,
+                # so it knows it missed messages and fills the gap from the database (see subscribe)
+                print(f"Live subscriber fell {q.qsize()} messages behind, disconnecting it")
+                self.subscribers.discard(q)
+
+    async def handle(self, reader, writer):
+        q = asyncio.Queue(QUEUE_SIZE)
+        self.subscribers.add(q)
+        try:
+            while q in self.subscribers or not q.empty():
+                writer.write(await q.get())
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.subscribers.discard(q)
+            writer.close()
+
+    async def serve(self, log):
+        log.info("Starting live publisher")
+
+        while True:
+            try:
+                server = await asyncio.start_server(self.handle, LIVE_HOST, LIVE_PORT)
+                async with server:
+                    await server.serve_forever()
+            except Exception:
+                log.error(f"Error in live publisher: {traceback.format_exc()}")
+                log.info("Retrying in 10 seconds...")
+                await asyncio.sleep(10)
+
+publisher = LivePublisher()
+
+# backend side, calls on_message(msg) for every message, reconnects forever
+# on_connect is awaited before the first message is read, messages sent meanwhile wait in the socket
+# on_disconnect is called whenever the connection is lost (messages may have been missed)
+async def subscribe(on_message, on_connect=None, on_disconnect=None):
+    while True:
+        try:
+            reader, writer = await asyncio.open_connection(LIVE_HOST, LIVE_PORT)
+            try:
+                if on_connect: await on_connect()
+                while line := await reader.readline():
+                    on_message(json.loads(line))
+            finally:
+                writer.close()
+                if on_disconnect: on_disconnect()
+        except (ConnectionError, OSError):
+            pass # measure.py not running
+        except Exception:
+            print(f"Error in live subscriber: {traceback.format_exc()}")
+
+        await asyncio.sleep(5)
@@ -1,14 +1,18 @@
 import logging
+import os
 import sys
 from logging.handlers import RotatingFileHandler
 
+# SOLARMON_DEBUG=1 also logs every measurement and batch (debug level), otherwise see /metrics
 def setup_logging(application_name):
+    level = logging.DEBUG if os.environ.get('SOLARMON_DEBUG') else logging.INFO
+
     logger = logging.getLogger(application_name)
-    logger.setLevel(logging.INFO)
+    logger.setLevel(level)
     
     # Console handler
     console_handler = logging.StreamHandler(sys.stdout)
-    console_handler.setLevel(logging.INFO)
+    console_handler.setLevel(level)
     
     # File handler with rotation
     file_handler = RotatingFileHandler(
@@ -16,7 +20,7 @@ def setup_logging(application_name):
         maxBytes=10*1024*1024,  # 10MB
         backupCount=5
     )
-    file_handler.setLevel(logging.INFO)
+    file_handler.setLevel(level)
     
     # Format
     formatter = logging.Formatter('%(asctime)s-%(levelname)s | %(message)s')
@@ -1,17 +1,41 @@
 import database as db
 import timestamps as ts
 import time
-import math
 import traceback
 import log_setup
+import derived
+import devices
+import intervals
+import live
+import metrics
+import retention
+import sampling
 import asyncio
-import aiohttp
+import json
+import math
+
+try:
+    import orjson # a few times faster for the big pushes after vzlogger reconnects
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
 
 log = log_setup.setup_logging('solarmon.measure')
 
 #db.create_tables()
+db.create_rollup_tables()
 power_id, power_by_minute_id, meter_power_id, meter_reading_id = db.get_or_create_channels()
 
+# polled devices (see devices.py), their channels are created if needed
+device_configs = devices.load_devices()
+device_channel_ids = db.get_or_create_named_channels(devices.device_channels(device_configs))
+db.set_channel_sampling({ device_channel_ids[config['channel']]: devices.device_sampling(config) for config in device_configs })
+db.set_channel_sampling({ meter_power_id: db.VZ_METER_SAMPLING })
+
+# load and savings (see derived.py)
+derived_ids = db.get_or_create_named_channels(derived.CHANNELS)
+db.set_channel_sampling({ channel_id: derived.SAMPLING for channel_id in derived_ids.values() })
+
 #"id": 0,
 #"source": "WS_in",
 #"output": true,
@@ -46,97 +70,173 @@ power_id, power_by_minute_id, meter_power_id, meter_reading_id = db.get_or_creat
 # ret_aenergy is just the negative flow (due to solar panel)
 # by_minute contains measured energy per minute (previous 3 minutes)
 
-# https://shelly-api-docs.shelly.cloud/gen2/ComponentsAndServices/Switch/
-async def read_shelly_plug_status(session):
-    try:
-        url = 'http://192.168.2.109/rpc/Switch.GetStatus?id=0'
-        #async with aiohttp.ClientSession() as session:
-        async with session.get(url, timeout=5) as response:
-            response.raise_for_status()
-            return await response.json()
-    except Exception:
-        log.error(f"Failed to read Shelly status: {traceback.format_exc()}")
-        raise
-
-async def high_res_measurement_loop():
-    period = 1
-    prev_by_minute_ts = 0
-    zero_power_count = 0
-    zero_power_threshold = math.ceil(60 / period)
-    zero_power_state = False
-
-    log.info("Starting measurement loop")
-    
-    async with aiohttp.ClientSession() as session:
-        while True:
-            start_ts = time.time()
-            
-            try:
-                timestamp = ts.get_volkzaehler_timestamp()
-                status = await read_shelly_plug_status(session)
-
-                apower = -status['apower'] # Negative Watts = solar power
-
-                # If power is zero for a while, assume night and don't write to db to save space and speed up queries
-                if apower <= 0.001: zero_power_count += 1
-                else: zero_power_count = 0
-                
-                if zero_power_count >= zero_power_threshold:
-                    if not zero_power_state: # Only print once
-                        zero_power_state = True
-                        log.info(f"Zero power for {zero_power_count*period} seconds, skipping...")
-                else:
-                    zero_power_state = False
-
-                    by_minute_ts        = status['ret_aenergy']['minute_ts'] * 1000 # s -> ms
-                    by_minute_avg_power = float(status['ret_aenergy']['by_minute'][0]) * (60.0 / 1000) # mWh / min -> W (avg in minute)
-                    
-                    db.queue_write(log, (timestamp, power_id, apower))
-                    print(f"Measure Shelly {ts.time_from_timestamp(timestamp)}: {apower} W")
-
-                    if prev_by_minute_ts != by_minute_ts:
-                        db.queue_write(log, (by_minute_ts, power_by_minute_id, by_minute_avg_power))
-                        log.info(f"Measure Shelly minute {ts.time_from_timestamp(by_minute_ts)}: {by_minute_avg_power} W")
-                    
-                    prev_by_minute_ts = by_minute_ts
-
-                sleep_time = math.ceil(start_ts/period)*period - start_ts # good way to get consistent timings close to exactly on whole seconds
-            except Exception:
-                log.error(f"Error in measurement loop: {traceback.format_exc()}")
-                log.info("Retrying in 10 seconds...")
-                sleep_time = 10
-
-            await asyncio.sleep(sleep_time)
+push_requests = metrics.Counter('solarmon_push_requests_total', 'Pushes received from vzlogger')
+push_samples = metrics.Counter('solarmon_push_samples_total', 'Samples received from vzlogger')
+push_errors = metrics.Counter('solarmon_push_errors_total', 'Pushes from vzlogger that could not be handled')
+push_invalid = metrics.Counter('solarmon_push_invalid_total', 'Pushed samples left out because the timestamp or value made no sense')
+push_rejected = metrics.Counter('solarmon_push_rejected_total', 'Pushes answered with 503 because the writer could not take them')
+push_seconds = metrics.Histogram('solarmon_push_seconds', 'Time to handle one push from vzlogger', metrics.TIME_BUCKETS)
+
+# load and savings for the live stream and their channels, computed as samples arrive
+solar_config = next((config for config in device_configs if config['channel'] == 'solar_power'), None)
+solar_sampling = devices.device_sampling(solar_config) if solar_config else None
+load_savings = intervals.LoadSavingsIntegrator(derived.LOAD_INTERVAL,
+    sample_rate_meter=sampling.sample_rate(db.VZ_METER_SAMPLING), sample_rate_solar=sampling.sample_rate(solar_sampling),
+    gap_thres_solar=sampling.gap_thres(solar_sampling))
+
+# intervals since the last one written before measure.py stopped are recomputed once their rows are in the database
+# (vzlogger pushes what it buffered meanwhile once we are back), the whole history with derived.py repair
+last_load = db.get_last_timestamp(derived_ids['load'])
+if last_load is not None:
+    derived.repairs.add(last_load, ts.get_volkzaehler_timestamp())
+
+def publish_load_savings():
+    rows = []
+    for timestamp, load, savings in load_savings.poll():
+        live.publisher.publish('load', timestamp, load)
+        live.publisher.publish('savings', timestamp, savings)
+        rows.append(db.Measurement(timestamp, derived_ids['load'], load))
+        rows.append(db.Measurement(timestamp, derived_ids['savings'], savings))
+
+    # samples that came in after their intervals were written, or intervals that couldn't be written
+    late = load_savings.take_late()
+    if late is not None:
+        derived.repairs.add(late[0] - 2*derived.LOAD_INTERVAL, late[1] + derived.LOAD_INTERVAL)
+    if rows and not db.queue_write_many(log, rows):
+        derived.repairs.add(rows[0].timestamp - derived.LOAD_INTERVAL, rows[-1].timestamp + derived.LOAD_INTERVAL)
+
+# rows of a device's main channel, to the database and the live stream, which fills the hot buffers of the backend (see hot.py)
+# so live and recent data are the same rows as the database has, with compression the stored ones instead of every sample
+def write_device_rows(config, channel_id, rows):
+    for row_timestamp, value, weight in rows:
+        db.queue_write(log, db.Measurement(row_timestamp, channel_id, value, weight=weight))
+        if config['live']:
+            live.publisher.publish(config['live'], row_timestamp, value)
+
+def on_device_sample(poller, timestamp, sample):
+    config = poller.config
+
+    # also gets the zero power values that are not written, so load/savings keep going at night
+    if config['channel'] == 'solar_power':
+        load_savings.add_solar(timestamp, sample.power)
+        publish_load_savings()
+
+    channel_id = device_channel_ids[config['channel']]
+
+    # If power is zero for a while, assume night and don't write to db to save space and speed up queries
+    if poller.idle(timestamp):
+        if not poller.was_idle: # Only print once
+            log.info(f"Zero power on {poller.name} for {config['skip_zero']} seconds, skipping...")
+            write_device_rows(config, channel_id, poller.deadband.flush())
+        poller.was_idle = True
+        return
+    poller.was_idle = False
+
+    # every sample, or with compression only the ones needed for the curve (see sampling.DeadBand)
+    write_device_rows(config, channel_id, poller.deadband.add(timestamp, sample.power))
+    log.debug(f"Measure {poller.name} {ts.time_from_timestamp(timestamp)}: {sample.power} W")
+
+    if config['by_minute_channel'] and sample.by_minute is not None:
+        by_minute_ts, by_minute_avg_power = sample.by_minute
+        db.queue_write(log, db.Measurement(by_minute_ts, device_channel_ids[config['by_minute_channel']], by_minute_avg_power))
+        log.info(f"Measure {poller.name} minute {ts.time_from_timestamp(by_minute_ts)}: {by_minute_avg_power} W")
 
 ## HTTP server for push data
 from aiohttp import web
 
+PUSH_MAX_BYTES = 64*1024*1024
+
+# seconds vzlogger is asked to wait before sending a rejected push again
+PUSH_RETRY_AFTER = 5
+
+# timestamps before this or more than an hour in the future are not real measurements
+MIN_TIMESTAMP = 946684800000 # 2000-01-01
+MAX_FUTURE = 60*60*1000
+
+# the value column is a FLOAT, bigger values are rejected by mysql (strict mode) and would only be dropped by the writer
+MAX_VALUE = 3.4e38
+
+def valid_sample(tup, now):
+    if not isinstance(tup, (list, tuple)) or len(tup) < 2: return False
+    timestamp, value = tup[0], tup[1]
+    return (isinstance(timestamp, (int, float)) and MIN_TIMESTAMP <= timestamp <= now + MAX_FUTURE
+            and isinstance(value, (int, float)) and math.isfinite(value) and abs(value) <= MAX_VALUE)
+
+# {"data": [{"uuid": "...", "tuples": [[timestamp, value], ...]}, ...]} -> [(uuid, [(timestamp, value), ...])]
+# raises ValueError if it's not a push at all, single bad samples are only left out
+def parse_push(body, now):
+    data = json_loads(body)
+    if not isinstance(data, dict) or not isinstance(data.get('data'), list):
+        raise ValueError("expected {\"data\": [...]}")
+
+    channels = []
+    for obj in data['data']:
+        if not isinstance(obj, dict) or not isinstance(obj.get('uuid'), str) or not isinstance(obj.get('tuples'), list):
+            raise ValueError("expected {\"uuid\": ..., \"tuples\": [...]} per channel")
+        tuples = [(int(tup[0]), float(tup[1])) for tup in obj['tuples'] if valid_sample(tup, now)]
+        push_invalid.inc(len(obj['tuples']) - len(tuples))
+        channels.append((obj['uuid'], tuples))
+    return channels
+
+# The whole push goes into the writer queue at once, in items of db.BATCH_MAX_ROWS (see db.queue_write_many),
+# if the writer can't take it vzlogger gets a 503 and sends it again later, so nothing is dropped
+# live values and load/savings are only updated for accepted pushes, a resent push would count twice otherwise
 async def handle_push(request):
     try:
-        data = await request.json()
-        print(f"Received push data: {data}")
-
-        for obj in data['data']:
-            if (obj['uuid'] == db.vz_meter_power_uuid):
-                for (timestamp, value) in obj['tuples']:
-                    db.queue_write(log, (timestamp, meter_power_id, value))
-            elif (obj['uuid'] == db.vz_meter_reading_uuid):
-                for (timestamp, value_wh) in obj['tuples']:
-                    value_kwh = value_wh / 1000
-                    db.queue_write(log, (timestamp, meter_reading_id, value_kwh, True))
+        t0 = time.perf_counter()
+        push_requests.inc()
+        body = await request.read()
+        log.debug(f"Received push: {body.decode(errors='replace')}")
+
+        try:
+            channels = parse_push(body, ts.get_volkzaehler_timestamp())
+        except ValueError as e: # includes json errors
+            push_errors.inc()
+            log.warning(f"Invalid push: {e}")
+            return web.Response(status=400, text="Invalid")
 
+        measurements = []
+        for uuid, tuples in channels:
+            if uuid == db.vz_meter_power_uuid:
+                measurements.extend(db.Measurement(timestamp, meter_power_id, value) for timestamp, value in tuples)
+            elif uuid == db.vz_meter_reading_uuid:
+                measurements.extend(db.Measurement(timestamp, meter_reading_id, value_wh / 1000, db.Combine.MAX_PER_MINUTE) for timestamp, value_wh in tuples)
+
+        if not db.queue_write_many(log, measurements):
+            push_rejected.inc()
+            return web.Response(status=503, text="Busy", headers={ 'Retry-After': str(PUSH_RETRY_AFTER) })
+
+        for uuid, tuples in channels:
+            push_samples.inc(len(tuples))
+            if uuid == db.vz_meter_power_uuid:
+                for timestamp, value in tuples:
+                    live.publisher.publish('meter_power', timestamp, value)
+                    load_savings.add_meter(timestamp, value)
+                publish_load_savings()
+            elif uuid == db.vz_meter_reading_uuid:
+                for timestamp, value_wh in tuples:
+                    live.publisher.publish('meter_reading', timestamp, value_wh / 1000)
+
+        push_seconds.observe(time.perf_counter() - t0)
         return web.Response(text="OK")
     except Exception as e:
-        print(f"Error handling push: {e}")
+        push_errors.inc()
+        log.error(f"Error handling push: {traceback.format_exc()}")
         return web.Response(status=500, text="Error")
 
+# prometheus text format, see metrics.py
+async def handle_metrics(request):
+    return web.Response(body=metrics.render().encode(), headers={ 'Content-Type': metrics.CONTENT_TYPE })
+
 async def http_push_receiver():
     log.info("Starting http_push_receiver")
     
     while True:
         try:
-            app = web.Application()
+            # catch-up pushes after an outage can be hours of samples, more than the default limit of 1 MB
+            app = web.Application(client_max_size=PUSH_MAX_BYTES)
             app.router.add_post('/vzlogger_data', handle_push)
+            app.router.add_get('/metrics', handle_metrics)
             runner = web.AppRunner(app)
             await runner.setup()
             site = web.TCPSite(runner, 'localhost', 8082)
@@ -157,9 +257,12 @@ async def main_async():
     log.info("measure.py starting up")
     
     await asyncio.gather(
-        db.write_loop(log),
-        high_res_measurement_loop(),
-        http_push_receiver()
+        db.write_loop(log, on_late_rows=lambda oldest: live.publisher.publish('invalidate', oldest, None)),
+        devices.poll_devices(device_configs, on_device_sample, log),
+        http_push_receiver(),
+        live.publisher.serve(log),
+        retention.retention_loop(log, on_compacted=lambda start: live.publisher.publish('invalidate', start, None)),
+        derived.repair_loop(log, on_repaired=lambda start, end: live.publisher.publish('invalidate', start, end))
     )
 
 if __name__ == "__main__":
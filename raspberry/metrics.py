@@ -0,0 +1,112 @@
+import bisect
+import time
+
+# Minimal in-process metrics (counters, gauges and histograms)
+# Cheap enough to update in hot loops, unlike printing every measurement
+# every metric registers itself, render() gives all of them in the prometheus text format for /metrics
+# (served by the backend and by measure.py on its push receiver port)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+registry = []
+
+# labels: eg. { 'device': 'solar_plug' }, metrics with the same name and different labels are rendered together
+def label_str(labels):
+    if not labels: return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels.items()) + '}'
+
+# fn: read the value when rendering instead of keeping it updated (eg. queue length)
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, help, fn=None, labels=None):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.fn = fn
+        self.labels = labels or {}
+        registry.append(self)
+
+    def inc(self, n=1):
+        self.value += n
+
+    def samples(self):
+        yield self.name + label_str(self.labels), self.fn() if self.fn else self.value
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def set(self, value):
+        self.value = value
+
+# counts per upper bucket bound (like prometheus), plus total count, sum and max
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets, labels=None):
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.buckets = sorted(buckets)
+        self.counts = [0]*(len(self.buckets) + 1) # last is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        registry.append(self)
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    # with histogram.time(): ...
+    def time(self):
+        return Timer(self)
+
+    def samples(self):
+        total = 0
+        for bound, count in zip(self.buckets + ['+Inf'], self.counts):
+            total += count
+            yield f'{self.name}_bucket' + label_str({ **self.labels, 'le': bound }), total
+        yield f'{self.name}_sum' + label_str(self.labels), self.sum
+        yield f'{self.name}_count' + label_str(self.labels), self.count
+
+class Timer:
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self.t0
+        self.histogram.observe(self.seconds)
+
+# passes through the items of an iterator (eg. a streamed response body) and observes the time spent producing them
+def timed_iter(items, histogram):
+    spent = 0.0
+    t0 = time.perf_counter()
+    for item in items:
+        spent += time.perf_counter() - t0
+        yield item
+        t0 = time.perf_counter()
+    histogram.observe(spent + time.perf_counter() - t0)
+
+def render():
+    families = {}
+    for metric in registry:
+        families.setdefault(metric.name, []).append(metric)
+
+    lines = []
+    for name, family in families.items():
+        lines.append(f"# HELP {name} {family[0].help}")
+        lines.append(f"# TYPE {name} {family[0].type}")
+        for metric in family:
+            for sample, value in metric.samples():
+                lines.append(f"{sample} {value}")
+    return "\n".join(lines) + "\n"
+
+# bucket bounds for timings in seconds
+TIME_BUCKETS = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10]
+ROW_BUCKETS = [10, 100, 1000, 10000, 100000, 1000000]
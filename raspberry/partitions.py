@@ -0,0 +1,163 @@
+import time
+import traceback
+from datetime import datetime, timezone
+
+# Optional layout of the data table: range partitioned by month on timestamp (DB_PARTITIONED=1 in database.env for new setups,
+# python partitions.py migrate for existing ones)
+# retention replaces whole months instead of deleting rows (see retention.py)
+# UNMEASURED: the benchmark below has never been run, so it's not known whether range scans are any faster
+# than with the (channel_id, timestamp) key of the plain table, run it on the real database before switching
+# partitioned tables can't have foreign keys, so data.channel_id isn't checked against channels in this mode
+MONTHS_AHEAD = 3 # partitions are created this far ahead, so inserts never end up in pmax
+
+UNMEASURED = "the partitioned layout is unmeasured, compare it with python partitions.py benchmark first"
+
+DATA_COLUMNS = """
+    channel_id INT(3) NOT NULL,
+    timestamp BIGINT(20) NOT NULL,
+    value FLOAT NOT NULL,
+    PRIMARY KEY (channel_id, timestamp)
+"""
+
+def month_start(year, month):
+    return round(datetime(year, month, 1, tzinfo=timezone.utc).timestamp() * 1000)
+
+def next_month(year, month):
+    return (year + 1, 1) if month == 12 else (year, month + 1)
+
+def month_of(timestamp):
+    t = datetime.fromtimestamp(timestamp / 1000, timezone.utc)
+    return t.year, t.month
+
+# (name, start, end) for every month from the one containing start to the one containing end
+def months(start, end):
+    res = []
+    year, month = month_of(start)
+    while month_start(year, month) <= end:
+        nyear, nmonth = next_month(year, month)
+        res.append((f"p{year:04d}{month:02d}", month_start(year, month), month_start(nyear, nmonth)))
+        year, month = nyear, nmonth
+    return res
+
+def partition_list(start, end):
+    parts = [f"PARTITION {name} VALUES LESS THAN ({month_end})" for name, month_start, month_end in months(start, end)]
+    parts.append("PARTITION pmax VALUES LESS THAN MAXVALUE")
+    return ",\n".join(parts)
+
+def partition_clause(start, end):
+    return f"PARTITION BY RANGE (timestamp) (\n{partition_list(start, end)}\n)"
+
+def ahead(now):
+    year, month = month_of(now)
+    for _ in range(MONTHS_AHEAD):
+        year, month = next_month(year, month)
+    return month_start(year, month)
+
+def create_table(cur, now):
+    cur.execute(f"CREATE TABLE IF NOT EXISTS data ({DATA_COLUMNS}) {partition_clause(now, ahead(now) - 1)}")
+
+def is_partitioned(cur, table='data'):
+    cur.execute("""SELECT count(*) FROM information_schema.partitions
+                WHERE table_schema = DATABASE() and table_name = %s and partition_name IS NOT NULL""", (table,))
+    return cur.fetchone()[0] > 0
+
+# [(name, start, end)] of the monthly partitions, without pmax
+def get_partitions(cur):
+    cur.execute("""SELECT partition_name, partition_description FROM information_schema.partitions
+                WHERE table_schema = DATABASE() and table_name = 'data' and partition_name != 'pmax'
+                ORDER BY partition_ordinal_position""")
+    res = []
+    for name, less_than in cur.fetchall():
+        year, month = int(name[1:5]), int(name[5:7])
+        res.append((name, month_start(year, month), int(less_than)))
+    return res
+
+# split new months off pmax, which is empty as long as this runs regularly, so it's instant
+def ensure_partitions(cur, now):
+    existing = get_partitions(cur)
+    last = existing[-1][2] if existing else now
+    if last >= ahead(now): return
+
+    cur.execute(f"ALTER TABLE data REORGANIZE PARTITION pmax INTO (\n{partition_list(last, ahead(now) - 1)}\n)")
+
+def migrate(conn, now):
+    cur = conn.cursor()
+    if is_partitioned(cur):
+        print("data is already partitioned")
+        return
+    print(f"Note: {UNMEASURED}")
+
+    cur.execute("SELECT min(timestamp) FROM data")
+    first = cur.fetchone()[0] or now
+
+    cur.execute("""SELECT constraint_name FROM information_schema.table_constraints
+                WHERE table_schema = DATABASE() and table_name = 'data' and constraint_type = 'FOREIGN KEY'""")
+    for (name,) in cur.fetchall():
+        print(f"Dropping foreign key {name}")
+        cur.execute(f"ALTER TABLE data DROP FOREIGN KEY {name}")
+
+    # copies the whole table once, reads block until it's done
+    t0 = time.perf_counter()
+    cur.execute(f"ALTER TABLE data {partition_clause(first, ahead(now) - 1)}")
+    t1 = time.perf_counter()
+    print(f"Partitioned data into {len(months(first, ahead(now) - 1))} months in {t1 - t0:.1f} s")
+    cur.close()
+
+# Copies the last days of data into a plain and a partitioned table and compares range scans like query_channel_range does
+def benchmark(conn, now, days, repeat=5):
+    cur = conn.cursor()
+    start = now - days*24*60*60*1000
+
+    cur.execute("SELECT channel_id FROM channels WHERE name = 'solar_power'")
+    channel_id = cur.fetchone()[0]
+
+    tables = [('bench_plain', ''), ('bench_partitioned', partition_clause(start, now))]
+    try:
+        for table, clause in tables:
+            t0 = time.perf_counter()
+            cur.execute(f"DROP TABLE IF EXISTS {table}")
+            cur.execute(f"CREATE TABLE {table} ({DATA_COLUMNS}) {clause}")
+            cur.execute(f"INSERT INTO {table} SELECT channel_id, timestamp, value FROM data WHERE timestamp >= %s", (start,))
+            conn.commit()
+            t1 = time.perf_counter()
+            print(f"Copied {cur.rowcount} rows into {table} in {t1 - t0:.1f} s")
+
+        for label, window in [('1 day', 1), ('1 week', 7), ('1 month', 30)]:
+            if window > days: continue
+            for table, clause in tables:
+                times = []
+                for _ in range(repeat):
+                    t0 = time.perf_counter()
+                    cur.execute(f"""select timestamp, value from {table}
+                                where channel_id = %s and timestamp between %s and %s
+                                order by timestamp""", (channel_id, now - window*24*60*60*1000, now))
+                    rows = cur.fetchall()
+                    times.append(time.perf_counter() - t0)
+                times.sort()
+                print(f"{label:8} {table:18} {len(rows):8} rows  median {times[len(times)//2]*1000:8.1f} ms  min {times[0]*1000:8.1f} ms")
+    finally:
+        for table, clause in tables:
+            cur.execute(f"DROP TABLE IF EXISTS {table}")
+        cur.close()
+
+# python partitions.py migrate          partitions the existing data table (stop measure.py first, the table is locked while it is copied)
+# python partitions.py benchmark [days] compares scans of 1 day, 1 week and 1 month on both layouts, using the last days of data (default 90)
+#                                       (no results yet, see UNMEASURED)
+if __name__ == "__main__":
+    import sys
+    import database as db
+    import timestamps as ts
+
+    if len(sys.argv) < 2 or sys.argv[1] not in ("migrate", "benchmark"):
+        print("usage: python partitions.py migrate | benchmark [days]")
+        print(f"({UNMEASURED})")
+        sys.exit(1)
+
+    with db.get_conn() as conn:
+        try:
+            if sys.argv[1] == "migrate":
+                migrate(conn, ts.get_volkzaehler_timestamp())
+            else:
+                benchmark(conn, ts.get_volkzaehler_timestamp(), int(sys.argv[2]) if len(sys.argv) >= 3 else 90)
+        except Exception:
+            print(f"Error: {traceback.format_exc()}")
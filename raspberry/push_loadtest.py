@@ -0,0 +1,122 @@
+import asyncio
+import json
+import sys
+import time
+import aiohttp
+import numpy as np
+import database as db
+import synthetic
+
+# Load test of the vzlogger push receiver of measure.py: sends catch-up bursts like vzlogger after a reconnect
+# (many minutes of buffered samples per push) from several senders at once, and resends pushes answered with 503
+# after Retry-After, like vzlogger does with its buffer
+# the samples are written to the database of the instance, so run it against a test instance
+# (measure.py started with a database.env for a separate database), not the real one
+#
+# python push_loadtest.py [--url URL] [--bursts 20] [--minutes 30] [--concurrency 4] [--days-ago 400] [--replay FILE]
+#   --minutes      samples per push (1 Hz, meter power and meter reading, one push per channel like vzlogger)
+#   --days-ago     where the synthetic samples are placed, far enough back to not mix with real data
+#   --replay FILE  send recorded pushes instead: one json body per line, or the log of measure.py with SOLARMON_DEBUG=1
+#                  (its "Received push: " lines)
+URL = 'http://localhost:8082/vzlogger_data'
+MAX_RETRIES = 20
+
+def synthetic_pushes(bursts, minutes, days_ago, seed=1):
+    rng = np.random.default_rng(seed)
+    start = (int(time.time()*1000) - days_ago*synthetic.DAY) // 60000 * 60000
+    reading = synthetic.START_READING * 1000 # Wh
+
+    pushes = []
+    for i in range(bursts):
+        burst_start = start + i*minutes*60000
+        t = synthetic.sample_times(rng, burst_start, burst_start + minutes*60000, jitter=40)
+        power = synthetic.household_load(rng, t) - synthetic.clear_sky(t) * synthetic.clouds(rng, t)
+        energy = reading + np.cumsum(np.maximum(power, 0) * 1000) / (60*60*1000) # Wh, 1 s per sample
+        reading = float(energy[-1])
+
+        pushes.append({ 'data': [{ 'uuid': db.vz_meter_power_uuid, 'tuples': [[int(a), round(float(b), 1)] for a, b in zip(t, power)] }] })
+        pushes.append({ 'data': [{ 'uuid': db.vz_meter_reading_uuid, 'tuples': [[int(a), round(float(b), 1)] for a, b in zip(t, energy)] }] })
+    return [json.dumps(push).encode() for push in pushes]
+
+def recorded_pushes(path):
+    pushes = []
+    with open(path) as f:
+        for line in f:
+            if 'Received push: ' in line:
+                line = line.split('Received push: ', 1)[1]
+            try:
+                push = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(push, dict) and 'data' in push:
+                pushes.append(line.strip().encode())
+    return pushes
+
+async def send(session, url, body, stats):
+    for attempt in range(MAX_RETRIES):
+        t0 = time.perf_counter()
+        async with session.post(url, data=body, headers={ 'Content-Type': 'application/json' }) as response:
+            await response.read()
+            stats['latency'].append(time.perf_counter() - t0)
+            stats['status'][response.status] = stats['status'].get(response.status, 0) + 1
+
+            if response.status != 503:
+                return response.status == 200
+            stats['retries'] += 1
+            await asyncio.sleep(float(response.headers.get('Retry-After', 1)))
+    return False
+
+async def run(url, pushes, concurrency):
+    stats = { 'latency': [], 'status': {}, 'retries': 0, 'failed': 0 }
+    todo = list(reversed(pushes))
+
+    async def sender(session):
+        while todo:
+            if not await send(session, url, todo.pop(), stats):
+                stats['failed'] += 1
+
+    t0 = time.perf_counter()
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*(sender(session) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - t0
+
+        # what the instance itself reports about the pushes and the writer
+        try:
+            async with session.get(url.rsplit('/', 1)[0] + '/metrics') as response:
+                instance_metrics = [line for line in (await response.text()).splitlines()
+                                    if line.startswith(('solarmon_push', 'solarmon_writer')) and '_bucket' not in line]
+        except aiohttp.ClientError:
+            instance_metrics = []
+    return stats, elapsed, instance_metrics
+
+def count_samples(body):
+    return sum(len(obj['tuples']) for obj in json.loads(body)['data'])
+
+if __name__ == "__main__":
+    args = { '--url': URL, '--bursts': '20', '--minutes': '30', '--concurrency': '4', '--days-ago': '400' }
+    argv = sys.argv[1:]
+    while argv:
+        if argv[0] not in (*args, '--replay') or len(argv) < 2:
+            print("usage: python push_loadtest.py [--url URL] [--bursts 20] [--minutes 30] [--concurrency 4] [--days-ago 400] [--replay FILE]")
+            sys.exit(1)
+        args[argv[0]] = argv[1]
+        argv = argv[2:]
+
+    if '--replay' in args:
+        pushes = recorded_pushes(args['--replay'])
+    else:
+        pushes = synthetic_pushes(int(args['--bursts']), int(args['--minutes']), int(args['--days-ago']))
+    samples = sum(count_samples(body) for body in pushes)
+    print(f"Sending {len(pushes)} pushes with {samples} samples ({sum(len(body) for body in pushes) / 1e6:.1f} MB) to {args['--url']}")
+
+    stats, elapsed, instance_metrics = asyncio.run(run(args['--url'], pushes, int(args['--concurrency'])))
+
+    latency = np.array(stats['latency'])*1000
+    print(f"{samples / elapsed:.0f} samples/s, {len(pushes) / elapsed:.1f} pushes/s in {elapsed:.1f} s")
+    if len(latency):
+        print(f"latency median {np.median(latency):.1f} ms, p95 {np.percentile(latency, 95):.1f} ms, max {latency.max():.1f} ms")
+    print(f"responses {dict(sorted(stats['status'].items()))}, resent after 503: {stats['retries']}, failed: {stats['failed']}")
+    if instance_metrics:
+        print("\n".join(instance_metrics))
+    if stats['failed']:
+        sys.exit(1)
@@ -0,0 +1,135 @@
+from typing import NamedTuple
+import numpy as np
+
+# Time weighted resampling of any set of channels onto one common grid of buckets
+# used for load and savings (derived.py), the daily energy (backend.compute_day_energy) and /resample
+# a sample (timestamp, value) is the average power since the previous sample of its channel (what the meter and the shelly report),
+# so its value is spread over that time and split at the bucket borders, which is right for irregular samples and any bucket size
+# the integral of the value over time is summed up at the end of each sample, the integral at a bucket border is interpolated back
+# from the end of the sample the border falls into, and the difference at the borders of a bucket is its integral
+# one pass over the sorted samples per channel, the grid is worked through in chunks of buckets so memory stays bounded
+# from 1 s buckets to 1 day buckets over years
+
+# what the time since the previous sample counts as if that is more than gap_thres
+GAP_SPREAD  = 'spread'  # the sample's value, eg. the meter, whose first sample after an outage is the average since the last one
+GAP_ZERO    = 'zero'    # 0, eg. solar, the plug isn't written while the panel produces nothing (see devices.py skip_zero)
+GAP_MISSING = 'missing' # unknown, only the sample's own sample_rate is covered
+
+# base buckets integrated at once, small enough for the temporary arrays to stay in the cpu cache
+CHUNK_BUCKETS = 16384
+
+# timestamps: sorted int ms, values: float
+# sample_rate: ms the first sample stands for (and samples after a GAP_MISSING gap), see sampling.sample_rate
+# gap_thres: ms, can be per sample (see retention.gap_thres_for), None if the channel has no gaps
+# fill: value of the time no sample covers (before the first, after the last, GAP_MISSING gaps),
+#   None leaves that time out of the average (buckets without any covered time are NaN)
+class Channel(NamedTuple):
+    timestamps: np.ndarray
+    values: np.ndarray
+    sample_rate: int = 1000
+    gap_thres: object = None
+    gaps: str = GAP_SPREAD
+    fill: float | None = 0.0
+
+# (integral of value over time, time covered by samples) in each bucket between the sorted borders (ms), in value*ms and ms
+# covered is only needed for a fill other than 0, without with_covered it is None
+def integrate(channel, borders, with_covered=True):
+    times = channel.timestamps
+    count = max(len(borders) - 1, 0)
+    if len(times) == 0 or count == 0 or times[-1] <= borders[0]:
+        return np.zeros(count), np.zeros(count) if with_covered else None
+
+    # samples that end in the borders, and the first one ending after them (it reaches back into the last bucket)
+    lo = np.searchsorted(times, borders[0], 'right')
+    hi = min(np.searchsorted(times, borders[-1], 'left') + 1, len(times))
+
+    timestamp = times[lo:hi].astype(np.float64)
+    value = np.asarray(channel.values[lo:hi], dtype=np.float64)
+
+    # start of each sample is the previous timestamp
+    prev = np.empty_like(timestamp)
+    prev[0] = times[lo - 1] if lo > 0 else times[0] - channel.sample_rate
+    prev[1:] = timestamp[:-1]
+
+    if channel.gap_thres is not None and channel.gaps != GAP_SPREAD:
+        gap_thres = channel.gap_thres
+        if np.ndim(gap_thres):
+            gap_thres = gap_thres[lo:hi]
+        after_gap = timestamp - prev > gap_thres
+        if channel.gaps == GAP_ZERO:
+            value = np.where(after_gap, 0.0, value)
+        else:
+            prev = np.where(after_gap, timestamp - channel.sample_rate, prev)
+
+    # integral and covered time at the end of each sample, borders in a sample are interpolated back from its end
+    # borders before a sample's start (in a GAP_MISSING gap or before the first sample) get the value at its start
+    duration = timestamp - prev
+    integral_ends = np.cumsum(value * duration)
+
+    borders = borders.astype(np.float64)
+    k = np.searchsorted(timestamp, borders, 'left') # sample the border falls into
+    after = k == len(timestamp) # borders after the last sample
+    k = np.minimum(k, len(timestamp) - 1)
+    rest = timestamp[k] - np.maximum(borders, prev[k])
+    integral = np.where(after, integral_ends[-1], integral_ends[k] - value[k] * rest)
+    if not with_covered:
+        return np.diff(integral), None
+
+    covered_ends = np.cumsum(duration)
+    covered = np.where(after, covered_ends[-1], covered_ends[k] - rest)
+    return np.diff(integral), np.diff(covered)
+
+# average per bucket of duration ms
+def average(integral, covered, duration, fill):
+    if fill == 0:
+        return integral / duration
+    if fill is None:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(covered > 0, integral / np.maximum(covered, 1e-9), np.nan)
+    return (integral + fill * (duration - covered)) / duration
+
+# Averages of the channels (name -> Channel) in the buckets [start + i*interval, start + (i+1)*interval) covering [start, end)
+# expressions: name -> function(series) -> array, computed from the averages of the channels (and of the expressions before it)
+#   with base (ms, interval a multiple of it) they are computed per base bucket and then averaged, eg. the clipping of
+#   max(meter + solar, 0) happens every 4 s instead of on the average of a whole day, NaN base buckets are left out
+# returns name -> array of averages per bucket for the channels and expressions
+def resample(channels, start, end, interval, base=None, expressions=None, chunk=CHUNK_BUCKETS):
+    expressions = expressions or {}
+    base = base or interval
+    if interval <= 0 or base <= 0:
+        raise ValueError(f"interval {interval} and base {base} must be positive")
+    if interval % base:
+        raise ValueError(f"interval {interval} is not a multiple of base {base}")
+    per = interval // base
+
+    count = max(-(-(end - start) // interval), 0)
+    res = { name: np.empty(count) for name in (*channels, *expressions) }
+
+    step = max(chunk // per, 1) # buckets per chunk
+    for b0 in range(0, count, step):
+        b1 = min(b0 + step, count)
+        borders = start + np.arange(b0*per, b1*per + 1, dtype=np.int64) * base
+
+        series = {}
+        for name, channel in channels.items():
+            integral, covered = integrate(channel, borders, with_covered=channel.fill != 0)
+            if expressions:
+                series[name] = average(integral, covered, base, channel.fill)
+            if per > 1:
+                integral = integral.reshape(-1, per).sum(axis=1)
+                if covered is not None:
+                    covered = covered.reshape(-1, per).sum(axis=1)
+            res[name][b0:b1] = average(integral, covered, interval, channel.fill)
+
+        for name, expression in expressions.items():
+            values = np.broadcast_to(expression(series), (b1 - b0) * per)
+            series[name] = values
+            if per > 1:
+                values = values.reshape(-1, per)
+                valid = ~np.isnan(values)
+                n = valid.sum(axis=1)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    res[name][b0:b1] = np.where(n > 0, np.where(valid, values, 0.0).sum(axis=1) / np.maximum(n, 1), np.nan)
+            else:
+                res[name][b0:b1] = values
+    return res
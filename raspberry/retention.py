@@ -0,0 +1,215 @@
+import asyncio
+import time
+import numpy as np
+import traceback
+import database as db
+import timestamps as ts
+import rollups
+import partitions
+
+# Raw data older than the retention period gets replaced by one row per 10 s (the mean, at the last sample timestamp of the bucket)
+# min/max stay available in the rollup tables, which are rebuilt from the raw data right before it is compacted
+# the mean rows still integrate to the same energy, so load/savings stay correct, the backend only needs a larger gap threshold there
+# deleted rows free up pages that mysql reuses for new data, so the table stops growing instead of shrinking on disk
+# with a partitioned data table (see partitions.py) whole months are rebuilt and swapped in instead, which does give the space back
+
+# channel name -> days of full resolution data, channels not listed are never compacted
+RETENTION = {
+    'solar_power': 30,
+    'meter_power': 30,
+    'load': 30, # derived channels (see derived.py)
+    'savings': 30,
+}
+
+COMPACT_RES, COMPACT_ROLLUP = rollups.ROLLUPS[0]
+COMPACTED_GAP_THRES = COMPACT_RES * 3 # like the raw data, missing if 3 times more elapsed time than the sample rate
+
+# Compacted history has a row every 10 s instead of every second,
+# so it needs a larger gap threshold, returns one per sample if the timestamps reach into it (gap_thres can be one per sample too)
+def gap_thres_for(timestamps, gap_thres, compacted_until):
+    if compacted_until is None or len(timestamps) == 0 or timestamps[0] >= compacted_until:
+        return gap_thres
+    return np.where(timestamps < compacted_until, np.maximum(gap_thres, COMPACTED_GAP_THRES), gap_thres)
+
+CHUNK = 60*60*1000 # compact an hour per transaction, to never lock the data table for long
+CHUNK_PAUSE = 1 # seconds between chunks, so the writer and backend get their turn on the pi
+RUN_INTERVAL = 60*60 # seconds
+
+def create_tables(cur):
+    # everything before compacted_until is compacted
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS retention (
+            channel_id INT(3) PRIMARY KEY NOT NULL,
+            compacted_until BIGINT(20) NOT NULL
+        )
+    """)
+
+def compact_chunk(conn, channel_id, start, end):
+    # make sure the rollups have the min/max of the raw data before it is gone
+    rollups.backfill(conn, channel_id, start, end)
+
+    cur = conn.cursor()
+    try:
+        cur.execute("DELETE FROM data WHERE channel_id = %s and timestamp >= %s and timestamp < %s", (channel_id, start, end))
+        deleted = cur.rowcount
+
+        cur.execute(f"""
+            INSERT INTO data (channel_id, timestamp, value)
+            SELECT channel_id, last_ts, sum_value / cnt
+                FROM {COMPACT_ROLLUP}
+                WHERE channel_id = %s and bucket >= %s and bucket < %s
+        """, (channel_id, start, end))
+        inserted = cur.rowcount
+
+        set_compacted_until(cur, channel_id, end)
+
+        conn.commit()
+        return deleted, inserted
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+
+def get_compacted_until(cur, channel_id):
+    cur.execute("SELECT compacted_until FROM retention WHERE channel_id = %s", (channel_id,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+def set_compacted_until(cur, channel_id, until):
+    cur.execute("""
+        INSERT INTO retention (channel_id, compacted_until) VALUES (%s, %s)
+        ON DUPLICATE KEY UPDATE compacted_until = GREATEST(compacted_until, VALUES(compacted_until))
+    """, (channel_id, until))
+
+# Partitioned layout: the rows that stay are copied into a plain table which is then exchanged with the month partition,
+# the old partition (now that table) is dropped, so nothing is deleted row by row
+# channels: [(channel_id, compacted_until)] to compact in this month
+# rows written into the month while it is copied are lost, months are only compacted long after they are over
+def compact_partition(conn, partition, start, end, channels):
+    for channel_id, compacted_until in channels:
+        rollups.backfill(conn, channel_id, max(start, compacted_until or start), end)
+
+    cur = conn.cursor()
+    try:
+        cur.execute("DROP TABLE IF EXISTS data_exchange")
+        cur.execute("CREATE TABLE data_exchange LIKE data")
+        cur.execute("ALTER TABLE data_exchange REMOVE PARTITIONING")
+
+        ids = ", ".join(str(int(channel_id)) for channel_id, compacted_until in channels)
+        cur.execute(f"INSERT INTO data_exchange SELECT * FROM data PARTITION ({partition}) WHERE channel_id NOT IN ({ids})")
+
+        inserted = 0
+        for channel_id, compacted_until in channels:
+            # already compacted part stays as is
+            compacted_until = max(start, compacted_until or start)
+            cur.execute(f"INSERT INTO data_exchange SELECT * FROM data PARTITION ({partition}) WHERE channel_id = %s and timestamp < %s",
+                        (channel_id, compacted_until))
+            cur.execute(f"""
+                INSERT INTO data_exchange (channel_id, timestamp, value)
+                SELECT channel_id, last_ts, sum_value / cnt
+                    FROM {COMPACT_ROLLUP}
+                    WHERE channel_id = %s and bucket >= %s and bucket < %s
+            """, (channel_id, compacted_until, end))
+            inserted += cur.rowcount
+
+        cur.execute(f"SELECT count(*) FROM data PARTITION ({partition}) WHERE channel_id IN ({ids})")
+        deleted = cur.fetchone()[0]
+
+        # marked first, if we crash before the exchange the month just stays raw, while compacting it twice would break the rollups
+        for channel_id, compacted_until in channels:
+            set_compacted_until(cur, channel_id, end)
+        conn.commit()
+
+        cur.execute(f"ALTER TABLE data EXCHANGE PARTITION {partition} WITH TABLE data_exchange")
+        cur.execute("DROP TABLE data_exchange")
+        return deleted, inserted
+    finally:
+        cur.close()
+
+# oldest month that has channels due for compaction, returns (start, deleted, inserted) or None
+def compact_next_partition(conn, cur, channel_ids, now):
+    partitions.ensure_partitions(cur, now)
+
+    for partition, start, end in partitions.get_partitions(cur):
+        channels = []
+        for name, days in RETENTION.items():
+            channel_id = channel_ids.get(name)
+            if channel_id is None or end > now - days*24*60*60*1000: continue
+
+            compacted_until = get_compacted_until(cur, channel_id)
+            if compacted_until is None or compacted_until < end:
+                channels.append((channel_id, compacted_until))
+
+        if channels:
+            return (start, *compact_partition(conn, partition, start, end, channels))
+    return None
+
+# compacts everything older than the retention period, one chunk (or month) at a time
+# returns list of (chunk start, deleted, inserted)
+def compact_chunks(now, max_chunks=None):
+    done = []
+
+    with db.get_conn() as conn:
+        cur = conn.cursor()
+        create_tables(cur)
+
+        cur.execute("SELECT name, channel_id FROM channels")
+        channel_ids = dict(cur.fetchall())
+
+        if partitions.is_partitioned(cur):
+            res = compact_next_partition(conn, cur, channel_ids, now)
+            cur.close()
+            return [res] if res else []
+
+        for name, days in RETENTION.items():
+            channel_id = channel_ids.get(name)
+            if channel_id is None: continue
+
+            until = (now - days*24*60*60*1000) // CHUNK * CHUNK
+
+            first = get_compacted_until(cur, channel_id)
+            if first is None:
+                cur.execute("SELECT min(timestamp) FROM data WHERE channel_id = %s", (channel_id,))
+                first = cur.fetchone()[0]
+                if first is None: continue
+            conn.commit() # don't keep a snapshot open
+
+            for chunk in range(first // CHUNK * CHUNK, until, CHUNK):
+                if max_chunks is not None and len(done) >= max_chunks: break
+                deleted, inserted = compact_chunk(conn, channel_id, chunk, chunk + CHUNK)
+                done.append((chunk, deleted, inserted))
+
+        cur.close()
+    return done
+
+# runs in measure.py, on_compacted(start) is called with the start of the compacted range (to invalidate caches)
+async def retention_loop(log, on_compacted=None):
+    log.info("Starting retention loop")
+
+    while True:
+        try:
+            total_deleted = 0
+            total_inserted = 0
+            t0 = time.perf_counter()
+
+            while True:
+                # in a thread, the blocking mysql calls can't run on the event loop
+                done = await asyncio.to_thread(compact_chunks, ts.get_volkzaehler_timestamp(), 1)
+                if not done: break
+
+                chunk, deleted, inserted = done[0]
+                total_deleted += deleted
+                total_inserted += inserted
+                if on_compacted:
+                    on_compacted(chunk)
+
+                await asyncio.sleep(CHUNK_PAUSE)
+
+            if total_deleted:
+                t1 = time.perf_counter()
+                log.info(f"Retention: compacted {total_deleted} rows into {total_inserted} in {t1 - t0:.1f} s")
+        except Exception:
+            log.error(f"Error in retention loop: {traceback.format_exc()}")
+
+        await asyncio.sleep(RUN_INTERVAL)
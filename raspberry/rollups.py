@@ -0,0 +1,233 @@
+import time
+import traceback
+import sampling
+
+# Pre-aggregated versions of the data table, so long ranges don't have to scan millions of raw rows
+# Each rollup stores count, sum, min, max and first/last timestamp per channel and bucket,
+# which can be combined into any coarser bucket size that is a multiple of the rollup size
+# (bucket size in ms, table name), finest first
+ROLLUPS = [
+    (10*1000,    'rollup_10s'),
+    (60*1000,    'rollup_1m'),
+    (15*60*1000, 'rollup_15m'),
+    (60*60*1000, 'rollup_1h'),
+]
+
+def create_tables(cur):
+    for res, table in ROLLUPS:
+        # bucket is the start timestamp of the bucket
+        cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                channel_id INT(3) NOT NULL,
+                bucket BIGINT(20) NOT NULL,
+                cnt INT NOT NULL,
+                sum_value DOUBLE NOT NULL,
+                min_value FLOAT NOT NULL,
+                max_value FLOAT NOT NULL,
+                first_ts BIGINT(20) NOT NULL,
+                last_ts BIGINT(20) NOT NULL,
+                PRIMARY KEY (channel_id, bucket)
+            )
+        """)
+
+    # the rollups of a channel hold every raw row from covered_from on, older ones only where backfill ran
+    # set by the writer with its first flush, moved back by backfills that reach it
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS rollup_coverage (
+            channel_id INT(3) PRIMARY KEY NOT NULL,
+            covered_from BIGINT(20) NOT NULL
+        )
+    """)
+
+# coarsest rollup that can be used to build buckets of size interval, None if raw data has to be used
+def pick_rollup(interval):
+    best = None
+    for res, table in ROLLUPS:
+        if res <= interval and interval % res == 0:
+            best = (res, table)
+    return best
+
+# rows of a channel in [start, end) with the samples they stand for (w), as a subquery: (sql, args)
+# rows of channels with irregular sampling (see sampling.py) are weighted by the time since the previous row, like the writer does,
+# so the rows before start are read too, for the time since the previous row of the first ones
+def weighted_rows(channel_id, start, end, channel_sampling):
+    if channel_sampling is None:
+        return """SELECT timestamp, value, 1 AS w
+            FROM data
+            WHERE channel_id = %s and timestamp >= %s and timestamp < %s""", (channel_id, start, end)
+
+    period, max_interval = channel_sampling
+    return """SELECT timestamp, value, w
+        FROM (
+            SELECT timestamp, value,
+                LEAST(GREATEST(ROUND((timestamp - LAG(timestamp, 1, timestamp) OVER (ORDER BY timestamp)) / %s), 1), %s) AS w
+                FROM data
+                WHERE channel_id = %s and timestamp >= %s and timestamp < %s
+        ) AS weighted
+        WHERE timestamp >= %s""", (float(period), sampling.max_weight(period, max_interval), channel_id, start - max_interval, end, start)
+
+# timestamp from which on the rollups of the channel are complete, None if not known
+async def get_covered_from(cur, channel_id):
+    await cur.execute("SELECT covered_from FROM rollup_coverage WHERE channel_id = %s", (channel_id,))
+    row = await cur.fetchone()
+    return row[0] if row else None
+
+# partial buckets can be added onto existing ones, so the writer can flush whenever it wants
+def upsert_sql(table):
+    return f"""INSERT INTO {table} (channel_id, bucket, cnt, sum_value, min_value, max_value, first_ts, last_ts)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE
+            cnt = cnt + VALUES(cnt),
+            sum_value = sum_value + VALUES(sum_value),
+            min_value = LEAST(min_value, VALUES(min_value)),
+            max_value = GREATEST(max_value, VALUES(max_value)),
+            first_ts = LEAST(first_ts, VALUES(first_ts)),
+            last_ts = GREATEST(last_ts, VALUES(last_ts))"""
+
+# Collects rollup buckets in memory for the values the writer inserts, flushed in one statement per rollup table
+class RollupAccumulator:
+    def __init__(self, flush_interval=10):
+        self.flush_interval = flush_interval
+        self.last_flush = time.monotonic()
+        # per rollup: (channel_id, bucket) -> [cnt, sum, min, max, first_ts, last_ts]
+        self.pending = [{} for _ in ROLLUPS]
+        self.covered = set() # channels whose coverage is recorded
+        self.covering = {} # channel_id -> covered_from, recorded with the flush not committed yet
+
+    # weight: samples the row stands for (see sampling.py), cnt counts samples, not rows
+    def add(self, timestamp, channel_id, value, weight=1):
+        for (res, table), pending in zip(ROLLUPS, self.pending):
+            key = (channel_id, timestamp // res * res)
+            b = pending.get(key)
+            if b is None:
+                pending[key] = [weight, value*weight, value, value, timestamp, timestamp]
+            else:
+                b[0] += weight
+                b[1] += value*weight
+                b[2] = min(b[2], value)
+                b[3] = max(b[3], value)
+                b[4] = min(b[4], timestamp)
+                b[5] = max(b[5], timestamp)
+
+    def should_flush(self):
+        return time.monotonic() - self.last_flush >= self.flush_interval
+
+    # call flushed() once the transaction is committed,
+    # buckets are kept until then so they are retried with the next flush if anything fails
+    async def flush(self, cursor):
+        self.last_flush = time.monotonic()
+
+        for (res, table), pending in zip(ROLLUPS, self.pending):
+            if not pending: continue
+
+            rows = [(channel_id, bucket, *b) for (channel_id, bucket), b in pending.items()]
+            await cursor.executemany(upsert_sql(table), rows)
+
+        # the first rows of a channel the writer adds are where its rollups start to be complete, kept if already known
+        self.covering = {}
+        for (channel_id, bucket), b in self.pending[0].items():
+            if channel_id not in self.covered:
+                self.covering[channel_id] = min(self.covering.get(channel_id, b[4]), b[4])
+        if self.covering:
+            await cursor.executemany("INSERT IGNORE INTO rollup_coverage (channel_id, covered_from) VALUES (%s, %s)",
+                                     list(self.covering.items()))
+
+    def flushed(self):
+        for pending in self.pending:
+            pending.clear()
+        self.covered.update(self.covering)
+        self.covering = {}
+
+# Recompute rollups from scratch for a range, in chunks to not lock the tables for too long
+# finest rollup is built from the raw data, the others from the finest rollup
+# a backfill reaching the start of the coverage moves it back to start (see rollup_coverage)
+def backfill(conn, channel_id, start, end, chunk=24*60*60*1000):
+    cur = conn.cursor()
+    coarsest = ROLLUPS[-1][0]
+    start = start // coarsest * coarsest # align so buckets never straddle chunks
+    res0, table0 = ROLLUPS[0]
+
+    sampling.create_tables(cur)
+    channel_sampling = sampling.get_sampling(cur, channel_id)
+
+    for chunk_start in range(start, end, chunk):
+        chunk_end = min(chunk_start + chunk, end)
+
+        rows, args = weighted_rows(channel_id, chunk_start, chunk_end, channel_sampling)
+        cur.execute(f"""
+            INSERT INTO {table0} (channel_id, bucket, cnt, sum_value, min_value, max_value, first_ts, last_ts)
+            SELECT %s, timestamp div %s * %s AS b, sum(w), sum(value * w), min(value), max(value), min(timestamp), max(timestamp)
+                FROM ({rows}) AS weighted_rows
+                GROUP BY b
+            ON DUPLICATE KEY UPDATE
+                cnt = VALUES(cnt), sum_value = VALUES(sum_value), min_value = VALUES(min_value),
+                max_value = VALUES(max_value), first_ts = VALUES(first_ts), last_ts = VALUES(last_ts)
+        """, (channel_id, res0, res0, *args))
+
+        for res, table in ROLLUPS[1:]:
+            cur.execute(f"""
+                INSERT INTO {table} (channel_id, bucket, cnt, sum_value, min_value, max_value, first_ts, last_ts)
+                SELECT channel_id, bucket div %s * %s, sum(cnt), sum(sum_value), min(min_value), max(max_value), min(first_ts), max(last_ts)
+                    FROM {table0}
+                    WHERE channel_id = %s and bucket >= %s and bucket < %s
+                    GROUP BY 1, 2
+                ON DUPLICATE KEY UPDATE
+                    cnt = VALUES(cnt), sum_value = VALUES(sum_value), min_value = VALUES(min_value),
+                    max_value = VALUES(max_value), first_ts = VALUES(first_ts), last_ts = VALUES(last_ts)
+            """, (res, res, channel_id, chunk_start, chunk_end))
+
+        conn.commit()
+
+    # a backfill that doesn't reach the coverage leaves a hole of rows before it that may not be in the rollups
+    if start < end:
+        cur.execute("UPDATE rollup_coverage SET covered_from = %s WHERE channel_id = %s and covered_from > %s and covered_from <= %s",
+                    (start, channel_id, start, end))
+        conn.commit()
+
+    cur.close()
+
+# python rollups.py backfill [days]
+# Builds the rollups from the existing raw data, without days all data is processed
+# Stops an hour before now, the measure.py writer keeps the rollups up to date from there
+# Starts after the compacted data (see retention.py), which no longer has the min/max the rollups were built from
+if __name__ == "__main__":
+    import sys
+    import database as db
+    import retention
+    import timestamps as ts
+
+    if len(sys.argv) < 2 or sys.argv[1] != "backfill":
+        print("usage: python rollups.py backfill [days]")
+        sys.exit(1)
+
+    coarsest = ROLLUPS[-1][0]
+    end = ts.get_volkzaehler_timestamp() // coarsest * coarsest - coarsest
+
+    with db.get_cursor() as cur:
+        create_tables(cur)
+        retention.create_tables(cur)
+        cur.execute("SELECT channel_id, name FROM channels")
+        channels = cur.fetchall()
+        cur.execute("SELECT channel_id, compacted_until FROM retention")
+        compacted = dict(cur.fetchall())
+
+    with db.get_conn() as conn:
+        cur = conn.cursor()
+
+        for channel_id, name in channels:
+            if len(sys.argv) >= 3:
+                start = end - int(sys.argv[2]) * 24*60*60*1000
+            else:
+                cur.execute("SELECT min(timestamp) FROM data WHERE channel_id = %s", (channel_id,))
+                start = cur.fetchone()[0]
+                if start is None: continue
+            start = max(start, compacted.get(channel_id, start))
+            if start >= end: continue
+
+            try:
+                t0 = time.perf_counter()
+                backfill(conn, channel_id, start, end)
+                t1 = time.perf_counter()
+                print(f"Backfilled rollups for {name} in {t1 - t0:.1f} s")
+            except Exception:
+                print(f"Error backfilling rollups for {name}: {traceback.format_exc()}")
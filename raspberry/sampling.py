@@ -0,0 +1,127 @@
+import math
+import numpy as np
+import timestamps as ts
+
+# How the polled channels are sampled, written by measure.py from devices.json (see devices.py), so the backend knows
+# how far apart rows can be (gap detection), rollups.backfill how many samples a row stands for
+# and resample.py how long a sample with nothing before it lasts
+# channels without an entry are plain ~1 Hz measurements
+# period:       ms between samples at the fastest poll rate, the unit of row weights, the sample rate
+# max_interval: ms rows can be apart while the device is measuring
+#               (max_hold with dead-band compression, the slowest poll period with adaptive polling)
+# max_interval_from: timestamp the max_interval was set at, older rows were stored every period (see gap_thres_for)
+def create_tables(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS channel_sampling (
+            channel_id INT(3) PRIMARY KEY NOT NULL,
+            period INT NOT NULL,
+            max_interval INT NOT NULL,
+            max_interval_from BIGINT(20) NOT NULL DEFAULT 0
+        )
+    """)
+
+    try:
+        cur.execute("SELECT max_interval_from FROM channel_sampling LIMIT 1")
+        cur.fetchall()
+    except Exception: # table from before the column existed, its max_interval is assumed to hold for all rows
+        cur.execute("ALTER TABLE channel_sampling ADD COLUMN max_interval_from BIGINT(20) NOT NULL DEFAULT 0")
+
+# max_interval_from only moves when max_interval changes, eg. once compression is turned on
+# (assigned first, mysql sees the updated columns in the assignments after)
+def set_sampling(cur, channel_id, period, max_interval):
+    cur.execute("""
+        INSERT INTO channel_sampling (channel_id, period, max_interval, max_interval_from) VALUES (%s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE
+            max_interval_from = CASE WHEN max_interval = VALUES(max_interval) THEN max_interval_from ELSE VALUES(max_interval_from) END,
+            period = VALUES(period), max_interval = VALUES(max_interval)
+    """, (channel_id, period, max_interval, ts.get_volkzaehler_timestamp()))
+
+# (period, max_interval) or None
+def get_sampling(cur, channel_id):
+    cur.execute("SELECT period, max_interval FROM channel_sampling WHERE channel_id = %s", (channel_id,))
+    row = cur.fetchone()
+    return tuple(row) if row else None
+
+def get_max_interval_from(cur, channel_id):
+    cur.execute("SELECT max_interval_from FROM channel_sampling WHERE channel_id = %s", (channel_id,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+# sample rate of channels without an entry
+PERIOD = 1000
+
+def sample_rate(channel_sampling):
+    return PERIOD if channel_sampling is None else channel_sampling[0]
+
+# assume missing data if 3 times more elapsed time than supposed sample rate
+GAP_THRES = PERIOD *3
+
+# gap threshold of a channel with sampling (period, max_interval) or None, bigger for rows that can be further apart
+def gap_thres(channel_sampling):
+    if channel_sampling is None: return GAP_THRES
+    period, max_interval = channel_sampling
+    return max(GAP_THRES, max_interval + 2*period)
+
+# samples a row of duration ms stands for, so rollup averages weight a row holding a minute like 60 single samples
+def weight(duration, period):
+    return max(round(duration / period), 1)
+
+# gap threshold per row (or one for all of them) of a channel whose max_interval holds from max_interval_from on,
+# rows from before were stored every period (eg. before dead-band compression was turned on), the larger threshold would hide their gaps
+def gap_thres_for(timestamps, channel_sampling, max_interval_from):
+    thres = gap_thres(channel_sampling)
+    if channel_sampling is None or not max_interval_from or len(timestamps) == 0 or timestamps[0] >= max_interval_from:
+        return thres
+    before = gap_thres((channel_sampling[0], channel_sampling[0]))
+    if before == thres:
+        return thres
+    return np.where(np.asarray(timestamps) < max_interval_from, before, thres)
+
+def max_weight(period, max_interval):
+    return math.ceil(max_interval / period)
+
+# Dead-band compression of a power channel: consecutive samples that stay within tolerance W of each other form a span,
+# of which only the first sample and the mean of the rest (at the time of the last sample) are stored
+# the stored curve (lines between rows, like the graph draws it) is within tolerance of every sample
+# and, as each row is the time weighted mean since the previous row, integrates to exactly the same energy
+# a span ends when a sample is out of tolerance, after max_hold ms, or with flush() (eg. before night)
+# tolerance None stores every sample, only the weights are computed (for adaptive polling)
+# add() and flush() return rows to write: [(timestamp, value, weight)]
+class DeadBand:
+    def __init__(self, tolerance, max_hold, period, max_duration):
+        self.tolerance = tolerance
+        self.max_hold = max_hold
+        self.period = period
+        self.max_duration = max_duration # a sample after a longer pause (outage, night) counts as this long
+
+        self.last = None # timestamp of the previous sample, written or not
+        self.span = None # [first timestamp, last timestamp, min, max, value * duration sum, duration sum] after the first sample
+
+    def duration(self, timestamp):
+        duration = self.period if self.last is None else min(timestamp - self.last, self.max_duration)
+        self.last = timestamp
+        return max(duration, 1)
+
+    def flush(self):
+        span = self.span
+        self.span = None
+        if span is None or span[5] == 0: return []
+        return [(span[1], span[4] / span[5], weight(span[5], self.period))]
+
+    def add(self, timestamp, value):
+        duration = self.duration(timestamp)
+        if self.tolerance is None:
+            return [(timestamp, value, weight(duration, self.period))]
+
+        span = self.span
+        if span is not None:
+            lo, hi = min(span[2], value), max(span[3], value)
+            if hi - lo <= self.tolerance and timestamp - span[0] <= self.max_hold:
+                span[1:] = [timestamp, lo, hi, span[4] + value*duration, span[5] + duration]
+                return []
+
+        # new span, its first sample is stored as is, so steps stay steps instead of becoming ramps to the next row
+        rows = self.flush()
+        rows.append((timestamp, value, weight(duration, self.period)))
+        self.span = [timestamp, timestamp, value, value, 0.0, 0]
+        return rows
@@ -0,0 +1,79 @@
+import mmap
+import os
+import struct
+import time
+
+# Append only file of fixed size records for measurements the writer could not take (queue full, database down)
+# The writer replays it in bulk once the database is reachable again, so memory use stays bounded no matter how long the outage
+# record: timestamp (int64, ms), channel_id (int32), combine (int32), value (float64), little endian
+# the combine field also holds the row weight (see sampling.py) above the lowest byte, 0 in files from before weights
+RECORD = struct.Struct('<qiid')
+
+def pack_combine(m):
+    return m.combine.value | (m.weight << 8 if m.weight != 1 else 0)
+
+# -> (combine, weight)
+def unpack_combine(combine):
+    return combine & 0xff, (combine >> 8) or 1
+
+class Spool:
+    SYNC_INTERVAL = 5 # seconds, don't fsync the sd card on every append
+
+    def __init__(self, path):
+        self.path = path
+        self.offset_path = path + '.offset'
+        self.last_sync = 0
+
+        self.f = open(path, 'ab+')
+        size = self.size()
+        if size % RECORD.size != 0:
+            # partially written record from a crash
+            self.f.truncate(size - size % RECORD.size)
+
+        # read offset is stored separately and only advanced once records are committed to the database
+        self.read_offset = 0
+        try:
+            with open(self.offset_path, 'r') as f:
+                self.read_offset = int(f.read().strip() or 0)
+        except FileNotFoundError:
+            pass
+        self.read_offset = min(self.read_offset - self.read_offset % RECORD.size, self.size())
+
+    def size(self):
+        return os.fstat(self.f.fileno()).st_size
+
+    def pending(self):
+        return (self.size() - self.read_offset) // RECORD.size
+
+    def append(self, measurements):
+        self.f.write(b''.join(RECORD.pack(m.timestamp, m.channel_id, pack_combine(m), m.value) for m in measurements))
+        self.f.flush()
+
+        if time.monotonic() - self.last_sync >= self.SYNC_INTERVAL:
+            os.fsync(self.f.fileno())
+            self.last_sync = time.monotonic()
+
+    # returns list of (timestamp, channel_id, combine, value) tuples from the read offset on
+    def read(self, max_records):
+        end = min(self.size(), self.read_offset + max_records * RECORD.size)
+        if end <= self.read_offset: return []
+
+        with mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return list(RECORD.iter_unpack(mm[self.read_offset:end]))
+
+    def consumed(self, count):
+        self.read_offset += count * RECORD.size
+
+        if self.read_offset >= self.size():
+            # everything replayed, start over with an empty file
+            # if we crash before the offset is saved, the stored offset gets clamped to the new size on load
+            self.f.truncate(0)
+            self.read_offset = 0
+
+        # write offset atomically
+        tmp = self.offset_path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(str(self.read_offset))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.offset_path)
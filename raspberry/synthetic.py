@@ -0,0 +1,95 @@
+import numpy as np
+
+# Synthetic measurements that look like the real ones, for benchmarks and tests without the devices
+# solar:         ~1 Hz from the shelly while the inverter produces, nothing at night
+# meter_power:   ~1 Hz from vzlogger, with push bursts: vzlogger sometimes stalls and then delivers the buffered
+#                samples within a fraction of a second, which get timestamped on arrival
+# meter_reading: one reading per minute (the backend stores the max per minute)
+# both power channels also lose a few seconds to a minute now and then (wifi)
+# timestamps are ms (int64), values float32 like the data table
+SOLAR_PEAK = 800 # W
+BASE_LOAD = 180 # W
+START_READING = 12345.6 # kWh
+
+DAY = 24*60*60*1000
+
+# (sunrise, sunset) in ms since midnight utc for a day, longer days in summer, noon at 11:30 utc (central europe)
+def daylight(day_start):
+    day_of_year = (day_start // DAY) % 365.25
+    hours = 12 + 4*np.sin(2*np.pi*(day_of_year - 80) / 365.25)
+    noon = 11.5*60*60*1000
+    return noon - hours/2*60*60*1000, noon + hours/2*60*60*1000
+
+# clear sky power at timestamps, 0 at night
+def clear_sky(timestamps):
+    day_start = timestamps // DAY * DAY
+    sunrise, sunset = daylight(day_start)
+    x = (timestamps - day_start - sunrise) / (sunset - sunrise)
+    return np.where((x > 0) & (x < 1), SOLAR_PEAK * np.sin(np.pi*np.clip(x, 0, 1))**1.5, 0.0)
+
+# smooth random factor in [lo, 1] per sample, changing over minutes
+def clouds(rng, timestamps, lo=0.15):
+    if len(timestamps) == 0: return np.zeros(0)
+    minutes = np.arange(timestamps[0] // 60000, timestamps[-1] // 60000 + 2) * 60000
+    walk = np.cumsum(rng.normal(0, 0.08, len(minutes)))
+    walk = (np.sin(walk) + 1) / 2 # keeps it bounded without getting stuck at the edges
+    return lo + (1 - lo) * np.interp(timestamps, minutes, walk)
+
+# ~1 Hz timestamps from start to end with jitter and dropouts, optionally with push bursts
+def sample_times(rng, start, end, jitter=20, dropouts=0.0003, bursts=0.0):
+    n = int((end - start) // 1000) + 1
+    steps = 1000 + rng.integers(-jitter, jitter + 1, n)
+
+    drop = np.flatnonzero(rng.random(n) < dropouts)
+    steps[drop] += rng.integers(5000, 60000, len(drop))
+
+    # stall for k samples, then deliver them 100-300 ms apart
+    for i in np.flatnonzero(rng.random(n) < bursts):
+        k = int(rng.integers(5, 20))
+        if i + k >= n: continue
+        steps[i] = k*1000
+        steps[i + 1:i + k] = rng.integers(100, 300, k - 1)
+
+    timestamps = start + np.cumsum(steps)
+    return timestamps[timestamps < end].astype(np.int64)
+
+# house consumption: base load, fridge cycling and random appliances
+def household_load(rng, timestamps):
+    if len(timestamps) == 0: return np.zeros(0)
+    load = BASE_LOAD + rng.normal(0, 8, len(timestamps))
+    load += np.where((timestamps // 60000) % 45 < 15, 110, 0) # fridge
+
+    # (power, minutes, events per day)
+    appliances = [(2000, 3, 4), (800, 60, 0.8), (1500, 20, 1.5), (120, 180, 2)]
+    days = (timestamps[-1] - timestamps[0]) / DAY
+    for power, minutes, per_day in appliances:
+        for start in rng.uniform(timestamps[0], timestamps[-1], rng.poisson(per_day * days)):
+            lo, hi = np.searchsorted(timestamps, [start, start + minutes*60000])
+            load[lo:hi] += power * rng.uniform(0.8, 1.1)
+    return load
+
+# {channel name: (timestamps, values)} for days days from start
+def generate(start, days, seed=1):
+    rng = np.random.default_rng(seed)
+    end = start + days*DAY
+
+    solar_t = sample_times(rng, start, end)
+    solar_t = solar_t[clear_sky(solar_t) > 0] # inverter is off at night
+    solar_v = clear_sky(solar_t) * clouds(rng, solar_t) + rng.normal(0, 2, len(solar_t))
+    solar_v = np.maximum(solar_v, 0)
+
+    meter_t = sample_times(rng, start, end, jitter=40, bursts=0.0005)
+    # the meter sees the same clouds, interpolated between the solar samples (0 at night)
+    solar_at_meter = np.interp(meter_t, solar_t, solar_v, left=0, right=0) if len(solar_t) else np.zeros(len(meter_t))
+    solar_at_meter[clear_sky(meter_t) == 0] = 0
+    meter_v = household_load(rng, meter_t) - solar_at_meter
+
+    reading_t = (np.arange(start // 60000 + 1, end // 60000) * 60000 + rng.integers(0, 5000)).astype(np.int64)
+    imported = np.interp(reading_t, meter_t, np.cumsum(np.maximum(meter_v, 0) * np.r_[1000, np.diff(meter_t)])) / (60*60*1000*1000)
+    reading_v = START_READING + imported
+
+    return {
+        'solar_power': (solar_t, solar_v.astype(np.float32)),
+        'meter_power': (meter_t, meter_v.astype(np.float32)),
+        'meter_reading': (reading_t, reading_v.astype(np.float32)),
+    }
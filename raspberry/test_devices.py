@@ -0,0 +1,105 @@
+import asyncio
+import aiohttp
+from aiohttp import web
+import devices
+import fake_shelly
+
+# DevicePoller against fake_shelly.FakeShelly: samples, outages, slow devices and errors of the sample handler
+# python -m pytest test_devices.py
+class Log:
+    def __init__(self):
+        self.errors = []
+        self.infos = []
+
+    def error(self, msg): self.errors.append(msg)
+    def info(self, msg): self.infos.append(msg)
+    def debug(self, msg): pass
+
+# runs test(poller, shelly, samples, log) with a poller of a fake shelly on a free port
+def with_shelly(test, on_sample=None, **config):
+    async def run():
+        shelly = fake_shelly.FakeShelly(seed=1)
+        runner = web.AppRunner(fake_shelly.make_app(shelly))
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+
+        samples = []
+        log = Log()
+        device = { **devices.DEFAULTS, 'name': 'fake', 'type': 'shelly', 'url': f"http://127.0.0.1:{port}/rpc/Switch.GetStatus?id=0",
+                    'channel': 'solar_power', 'invert': True, **config }
+        poller = devices.DevicePoller(device, on_sample or (lambda poller, timestamp, sample: samples.append((timestamp, sample))), log)
+        try:
+            async with aiohttp.ClientSession() as session:
+                await test(poller, session, shelly, samples, log)
+        finally:
+            await runner.cleanup()
+    asyncio.run(run())
+
+def test_samples():
+    async def test(poller, session, shelly, samples, log):
+        for i in range(3):
+            await poller.poll(session, 1000 + i)
+        assert [timestamp for timestamp, sample in samples] == [1000, 1001, 1002]
+        assert all(sample.power >= 0 for timestamp, sample in samples) # inverted, the plug reports solar power as negative
+        # the minute average only comes with the first sample of a minute
+        assert samples[0][1].by_minute is not None
+        assert samples[1][1].by_minute is None or samples[1][1].by_minute[0] != samples[0][1].by_minute[0]
+        assert not log.errors
+    with_shelly(test)
+
+def test_outage_logged_once():
+    async def test(poller, session, shelly, samples, log):
+        shelly.failure_rate = 1
+        for i in range(5):
+            await poller.poll(session, 1000 + i)
+        assert samples == []
+        assert poller.poll_errors.value == 5
+        assert len(log.errors) == 1
+
+        shelly.failure_rate = 0
+        await poller.poll(session, 2000)
+        assert len(samples) == 1
+        assert any('is back' in msg for msg in log.infos)
+
+        # a new outage is logged again
+        shelly.failure_rate = 1
+        await poller.poll(session, 3000)
+        assert len(log.errors) == 2
+    with_shelly(test)
+
+def test_slow_device_skips_polls():
+    async def test(poller, session, shelly, samples, log):
+        shelly.delay = 400 # ms, +-50%, every poll takes a few periods
+        try:
+            await asyncio.wait_for(poller.run(session), 1.5)
+        except asyncio.TimeoutError:
+            pass
+        # one request at a time, the ticks meanwhile are skipped instead of piling up requests
+        assert poller.skipped.value > 0
+        assert 1 <= len(samples) <= 1.5 / 0.2 + 1
+        assert len(samples) + poller.skipped.value >= 1.5 / 0.1 - 2
+        assert not log.errors
+    with_shelly(test, period=0.1)
+
+def test_timeout_counts_as_error():
+    async def test(poller, session, shelly, samples, log):
+        shelly.delay = 1000
+        await poller.poll(session, 1000)
+        assert samples == []
+        assert poller.poll_errors.value == 1
+        assert len(log.errors) == 1
+    with_shelly(test, timeout=0.2)
+
+def test_handler_error_logged():
+    def on_sample(poller, timestamp, sample):
+        raise RuntimeError("writer queue broken")
+
+    async def test(poller, session, shelly, samples, log):
+        await poller.poll(session, 1000)
+        await poller.poll(session, 1001)
+        assert poller.sample_errors.value == 2
+        assert poller.poll_errors.value == 0
+        assert len(log.errors) == 2 and 'writer queue broken' in log.errors[0]
+    with_shelly(test, on_sample)
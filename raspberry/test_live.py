@@ -0,0 +1,60 @@
+import asyncio
+import json
+import hot
+import live
+
+# A subscriber that falls behind must notice it missed messages (the connection is closed) instead of silently losing them
+# python -m pytest test_live.py
+START = 1751320800000
+
+async def burst(count):
+    publisher = live.LivePublisher()
+    server = await asyncio.start_server(publisher.handle, live.LIVE_HOST, 0)
+    async with server:
+        reader, writer = await asyncio.open_connection(live.LIVE_HOST, server.sockets[0].getsockname()[1])
+        while not publisher.subscribers:
+            await asyncio.sleep(0.01)
+
+        # like a vzlogger catch-up push, all published before the subscriber gets to read anything
+        for i in range(count):
+            publisher.publish('solar', START + i*1000, float(i))
+
+        # until everything arrived or the publisher closed the connection
+        messages = []
+        closed = False
+        while len(messages) < count and not closed:
+            line = await asyncio.wait_for(reader.readline(), 5)
+            if line:
+                messages.append(json.loads(line))
+            else:
+                closed = True
+        writer.close()
+        return publisher, messages, closed
+
+def test_burst_within_queue():
+    publisher, messages, closed = asyncio.run(burst(live.QUEUE_SIZE))
+    assert not closed
+    assert [msg['t'] for msg in messages] == [START + i*1000 for i in range(live.QUEUE_SIZE)]
+
+def test_overflow_disconnects():
+    publisher, messages, closed = asyncio.run(burst(5000))
+    assert closed
+    assert not publisher.subscribers
+    # what arrived is everything up to the overflow, so a sync after the last row fills the rest
+    assert [msg['t'] for msg in messages] == [START + i*1000 for i in range(len(messages))]
+    assert len(messages) < 5000
+
+def test_hot_resync_after_disconnect():
+    data = hot.HotData(capacity=100)
+    for name in data.buffers:
+        data.buffers[name].covered_from = START
+    data.synced = True
+    for i in range(10):
+        data.on_message({ 'series': 'solar', 't': START + i*1000, 'v': 1.0 })
+        data.on_message({ 'series': 'load', 't': START + i*1000, 'v': 1.0 })
+
+    data.on_disconnect()
+    assert data.covered_from('solar_power') is None
+    # raw channels continue after their last row, load/savings may have missed invalidates and are loaded again
+    assert data.buffers['solar_power'].covered_from == START
+    assert data.buffers['load'].covered_from is None
@@ -0,0 +1,165 @@
+import numpy as np
+import database as db
+import derived
+
+# Regression test of the vectorized load/savings computation (derived.load_and_savings, see resample.py)
+# against the loop version of filter_and_sum_meter_and_solar it replaced
+# python -m pytest test_load_and_savings.py
+INTERVAL = derived.LOAD_INTERVAL
+GAP_THRES = 3000
+
+# the loop divides ms timestamps (~1.7e12) by the interval, which costs it about 1e-7 of the durations
+TOLERANCE = 1e-3 # W
+
+# the old process_results: None markers at gaps, with gap_fill_fix zero points around them
+def process_results_loop(rows, gap_thres, gap_fill_fix):
+    timestamps = []
+    values = []
+    if len(rows) == 0: return timestamps, values
+
+    prev_row = rows[0]
+    for row in rows:
+        if row[0] - prev_row[0] > gap_thres:
+            if gap_fill_fix:
+                timestamps += [None, prev_row[0], row[0], None]
+                values += [None, 0, 0, None]
+            else:
+                timestamps.append(None)
+                values.append(None)
+        timestamps.append(row[0])
+        values.append(row[1])
+        prev_row = row
+    return timestamps, values
+
+# the old filter_and_sum_meter_and_solar, on the output of process_results_loop
+def filter_and_sum_loop(meter_data, solar_data, start, end):
+    if len(meter_data['timestamps']) == 0 or len(solar_data['timestamps']) == 0:
+        return [], [], []
+
+    start = max(start, min(meter_data['timestamps'][0], solar_data['timestamps'][0]))
+    end   = min(end  , max(meter_data['timestamps'][-1], solar_data['timestamps'][-1]))
+
+    interval = INTERVAL
+    sample_rate = 1000
+
+    start_i = start // interval
+    end_i   = end // interval
+    count   = end_i+1 - start_i
+
+    res_tim = [i*interval - interval//2 for i in range(start_i, end_i+1)]
+
+    def accumulate(data):
+        times = data['timestamps']
+        values = data['values']
+        buf = [0]*count
+
+        prev_timestamp = (times[0] - sample_rate) / interval
+
+        for i in range(0, len(times)):
+            timestamp = times[i]
+            if timestamp is None: continue
+            timestamp = timestamp / interval
+
+            dur = timestamp - prev_timestamp
+            weighted_value = values[i] * dur
+            tmp = int(timestamp)
+            interval_ts = float(tmp)
+            right_idx = tmp - start_i
+
+            if prev_timestamp >= interval_ts:
+                if right_idx >= 0 and right_idx < count:
+                    buf[right_idx] += weighted_value
+            else:
+                right_dur = timestamp - interval_ts
+                right_value = weighted_value * (right_dur / dur)
+                left_value = weighted_value - right_value
+
+                left_idx = right_idx - 1
+                if left_idx  >= 0 and right_idx < count:  buf[left_idx ] += left_value
+                if right_idx >= 0 and right_idx < count:  buf[right_idx] += right_value
+
+            prev_timestamp = timestamp
+        return buf
+
+    meter_buf = accumulate(meter_data)
+    solar_buf = accumulate(solar_data)
+    load = [max(m + s, 0.0) for m, s in zip(meter_buf, solar_buf)]
+    savings = [max(min(m, 0.0) + s, 0.0) for m, s in zip(meter_buf, solar_buf)]
+    return res_tim, load, savings
+
+def run_loop(meter, solar, start, end):
+    meter_data = dict(zip(('timestamps', 'values'), process_results_loop(list(zip(*meter)), GAP_THRES, False)))
+    solar_data = dict(zip(('timestamps', 'values'), process_results_loop(list(zip(*solar)), GAP_THRES, True)))
+    return filter_and_sum_loop(meter_data, solar_data, start, end)
+
+def run_vectorized(meter, solar, start, end):
+    return derived.load_and_savings(derived.meter_channel(meter, db.VZ_METER_SAMPLING), derived.solar_channel(solar, None), start, end)
+
+def arrays(timestamps, values):
+    return np.asarray(timestamps, dtype=np.int64), np.asarray(values, dtype=np.float64)
+
+# ~1 Hz samples with jitter, with gaps (spacing) put in at some positions
+def samples(rng, start, count, gaps, lo, hi):
+    spacing = rng.integers(900, 1100, count)
+    for i, gap in gaps.items():
+        spacing[i] = gap
+    return arrays(start + np.cumsum(spacing), rng.uniform(lo, hi, count))
+
+def assert_same(meter, solar, start, end):
+    expected = run_loop(meter, solar, start, end)
+    timestamps, load, savings = run_vectorized(meter, solar, start, end)
+    assert timestamps.tolist() == expected[0]
+    np.testing.assert_allclose(load, expected[1], rtol=0, atol=TOLERANCE)
+    np.testing.assert_allclose(savings, expected[2], rtol=0, atol=TOLERANCE)
+
+START = 1751320800000
+
+def test_regular():
+    rng = np.random.default_rng(1)
+    meter = samples(rng, START, 3000, {}, -800, 2500)
+    solar = samples(rng, START + 300, 3000, {}, 0, 600)
+    assert_same(meter, solar, START, START + 4000*1000)
+
+def test_solar_gaps():
+    # solar samples after a gap count as 0, the old zero points of gap_fill_fix
+    rng = np.random.default_rng(2)
+    meter = samples(rng, START, 3000, {}, -800, 2500)
+    solar = samples(rng, START + 300, 2000, { 100: 3500, 500: 60*1000, 1200: 15*60*1000 }, 0, 600)
+    assert_same(meter, solar, START, START + 4000*1000)
+
+def test_short_meter_gaps():
+    # meter gaps shorter than an interval are spread over the intervals they touch like before
+    rng = np.random.default_rng(3)
+    meter = samples(rng, START, 3000, { 10: 3200, 700: 3900, 2000: 3500 }, -800, 2500)
+    solar = samples(rng, START + 300, 3000, {}, 0, 600)
+    assert_same(meter, solar, START, START + 4000*1000)
+
+def test_long_meter_gaps():
+    # the first meter sample after a longer gap used to go into just the two intervals at its end,
+    # now it is spread over the whole gap, same energy
+    rng = np.random.default_rng(4)
+    meter = samples(rng, START, 3000, { 500: 60*1000, 1500: 10*60*1000 }, 200, 2500)
+    solar = arrays([], [])
+    expected = run_loop(meter, arrays([START], [0.0]), START, START + 4000*1000)
+    timestamps, load, savings = run_vectorized(meter, solar, START, START + 4000*1000)
+    np.testing.assert_allclose(np.sum(load), np.sum(expected[1]), rtol=0, atol=TOLERANCE*len(load))
+
+    gap_end = int(meter[0][1500])
+    in_gap = (timestamps > gap_end - 10*60*1000 + 2*INTERVAL) & (timestamps < gap_end - 2*INTERVAL)
+    np.testing.assert_allclose(load[in_gap], meter[1][1500])
+
+def test_empty():
+    empty = arrays([], [])
+    timestamps, load, savings = run_vectorized(empty, empty, START, START + 60*1000)
+    assert len(timestamps) == len(load) == len(savings) == 0
+    assert run_loop(empty, empty, START, START + 60*1000) == ([], [], [])
+
+def test_one_sample():
+    meter = arrays([START + 5500], [-300.0])
+    solar = arrays([START + 5700], [500.0])
+    assert_same(meter, solar, START, START + 60*1000)
+
+def test_one_sample_at_interval_border():
+    meter = arrays([START + 8000], [1000.0])
+    solar = arrays([START + 8000], [250.0])
+    assert_same(meter, solar, START, START + 60*1000)
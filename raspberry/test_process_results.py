@@ -0,0 +1,91 @@
+import numpy as np
+import backend
+import retention
+import sampling
+
+# Equivalence test of the vectorized gap marking (backend.process_results / to_series) against the loop version it replaced,
+# extended like the vectorized one by per-row thresholds and the row before the update (prev_timestamp)
+# python -m pytest test_process_results.py
+START = 1751320800000
+
+# the old process_results: NaN markers at gaps (None in json), with gap_fill_fix zero points around them
+# gap_thres: one threshold or one per row, prev_timestamp: timestamp of the row before these, None for no gap on the first row
+def process_results_loop(timestamps, values, gap_thres, gap_fill_fix, prev_timestamp=None):
+    out_timestamps = []
+    out_values = []
+    thres = np.broadcast_to(gap_thres, len(timestamps))
+
+    prev = timestamps[0] if len(timestamps) and prev_timestamp is None else prev_timestamp
+    for t, v, row_thres in zip(timestamps, values, thres):
+        if t - prev > row_thres:
+            if gap_fill_fix:
+                out_timestamps += [np.nan, prev, t, np.nan]
+                out_values += [np.nan, 0, 0, np.nan]
+            else:
+                out_timestamps.append(np.nan)
+                out_values.append(np.nan)
+        out_timestamps.append(t)
+        out_values.append(v)
+        prev = t
+    return np.array(out_timestamps, dtype=np.float64), np.array(out_values, dtype=np.float64)
+
+def assert_same(timestamps, values, gap_thres, gap_fill_fix, prev_timestamp=None):
+    expected = process_results_loop(timestamps, values, gap_thres, gap_fill_fix, prev_timestamp)
+    res = backend.process_results(timestamps, values, gap_thres, gap_fill_fix, prev_timestamp)
+    np.testing.assert_array_equal(res[0], expected[0])
+    np.testing.assert_array_equal(res[1], expected[1])
+    return res
+
+# ~1 Hz rows with jitter, with gaps (spacing) put in at some positions
+def rows(rng, start, count, gaps, spacing=1000):
+    steps = rng.integers(spacing*9//10, spacing*11//10, count)
+    for i, gap in gaps.items():
+        steps[i] = gap
+    return start + np.cumsum(steps), rng.uniform(0, 600, count)
+
+def test_fixed_thres():
+    rng = np.random.default_rng(1)
+    timestamps, values = rows(rng, START, 3000, { 10: 3100, 500: 2900, 700: 60*1000, 2999: 15*60*1000 })
+    for gap_fill_fix in (False, True):
+        res = assert_same(timestamps, values, backend.GAP_THRES_POWER, gap_fill_fix)
+        assert np.isnan(res[0]).sum() == (6 if gap_fill_fix else 3)
+
+def test_empty_and_one_row():
+    for gap_fill_fix in (False, True):
+        assert_same(np.empty(0, dtype=np.int64), np.empty(0), 3000, gap_fill_fix)
+        assert_same(np.array([START]), np.array([1.0]), 3000, gap_fill_fix)
+        assert_same(np.array([START]), np.array([1.0]), 3000, gap_fill_fix, prev_timestamp=START - 10*1000)
+
+def test_prev_timestamp():
+    # since-polls continue after the last row the frontend has, a gap to it is marked before the first new row
+    rng = np.random.default_rng(2)
+    timestamps, values = rows(rng, START, 100, { 50: 10*1000 })
+    for gap_fill_fix in (False, True):
+        for prev_timestamp in (START - 500, START - 20*1000, int(timestamps[0])):
+            assert_same(timestamps, values, 3000, gap_fill_fix, prev_timestamp)
+    res = assert_same(timestamps, values, 3000, True, START - 20*1000)
+    assert res[0][1] == START - 20*1000
+
+def test_sampling_and_retention_thres():
+    # compacted 10 s means, then every 1 s sample, then dead-band rows up to a minute apart after compression was turned on
+    rng = np.random.default_rng(3)
+    compacted = rows(rng, START, 500, { 100: 25*1000, 200: 45*1000 }, spacing=10*1000)
+    raw = rows(rng, int(compacted[0][-1]), 1000, { 100: 5*1000, 400: 50*1000 })
+    compressed = rows(rng, int(raw[0][-1]), 500, { 100: 90*1000, 300: 2*60*1000 }, spacing=20*1000)
+    timestamps = np.concatenate((compacted[0], raw[0], compressed[0]))
+    values = np.concatenate((compacted[1], raw[1], compressed[1]))
+
+    channel_sampling = (1000, 60*1000)
+    max_interval_from = int(raw[0][-1]) + 1
+    compacted_until = int(compacted[0][-1]) + 1
+    gap_thres = lambda timestamps: sampling.gap_thres_for(timestamps, channel_sampling, max_interval_from)
+    thres = retention.gap_thres_for(timestamps, gap_thres(timestamps), compacted_until)
+    assert len(np.unique(thres)) == 3
+
+    for gap_fill_fix in (False, True):
+        expected = process_results_loop(timestamps, values, thres, gap_fill_fix, START - 60*1000)
+        res = backend.to_series((timestamps, values), gap_thres, gap_fill_fix, START - 60*1000, compacted_until)
+        np.testing.assert_array_equal(res['timestamps'], expected[0])
+        np.testing.assert_array_equal(res['values'], expected[1])
+        # the gaps: to prev_timestamp, 45 s compacted, 5 s and 50 s raw, 90 s and 2 min compressed
+        assert np.isnan(expected[0]).sum() == 6 * (2 if gap_fill_fix else 1)